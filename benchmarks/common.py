@@ -0,0 +1,170 @@
+import io
+import json
+import math
+import multiprocessing
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from PIL import Image, ImageChops, ImageStat
+
+def parse_size(value):
+    width, height = value.lower().split('x')
+    return (int(width), int(height))
+
+def seeded_noise(size, seed):
+    # Image.effect_noise draws from libc's rand(), which cannot be seeded, so
+    # the same corpus would differ between runs. Noise at a quarter of the
+    # resolution, upscaled, also looks more like photographic texture.
+    rng = random.Random(seed)
+    small = (max(1, size[0] // 4), max(1, size[1] // 4))
+    count = small[0] * small[1]
+    noise = Image.frombytes('L', small, rng.getrandbits(8 * count).to_bytes(count, 'little'))
+    return noise.resize(size, Image.BILINEAR)
+
+def synthetic_image(size, seed=0):
+    # Noise plus gradients, so encoders and decoders see realistic detail
+    # rather than a flat colour they can compress to nothing.
+    red = seeded_noise(size, seed)
+    green = Image.linear_gradient('L').resize(size)
+    blue = Image.radial_gradient('L').resize(size)
+    return Image.merge('RGB', (red, green, blue))
+
+def encode(img, format='JPEG', **options):
+    output = io.BytesIO()
+    img.save(output, format, **options)
+    return output.getvalue()
+
+def synthetic_source(size, format='JPEG', seed=0):
+    img = synthetic_image(size, seed)
+    return encode(img, format, quality=90) if format == 'JPEG' else encode(img, format)
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def peak_rss_kb():
+    # ru_maxrss survives exec on Linux, so a spawned child would report its
+    # parent's peak; VmHWM belongs to the child's own address space.
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, int(math.ceil(pct / 100.0 * len(ordered))) - 1)
+    return ordered[max(index, 0)]
+
+def summarize(latencies):
+    return {
+        'count': len(latencies),
+        'mean_ms': round(1000 * sum(latencies) / len(latencies), 3) if latencies else None,
+        'p50_ms': round(1000 * percentile(latencies, 50), 3) if latencies else None,
+        'p99_ms': round(1000 * percentile(latencies, 99), 3) if latencies else None,
+    }
+
+def timed(fn, iterations):
+    latencies = []
+    result = None
+    for _ in range(iterations):
+        started = time.perf_counter()
+        result = fn()
+        latencies.append(time.perf_counter() - started)
+    return result, latencies
+
+def run_child(queue, fn, args):
+    try:
+        queue.put((True, fn(*args)))
+    except BaseException as ex:
+        queue.put((False, '{}: {}'.format(type(ex).__name__, ex)))
+        raise
+
+def run_isolated(fn, *args):
+    # A fresh interpreter per measurement keeps the reported peak RSS honest:
+    # the peak of one variant never leaks into the next. A plain Process
+    # rather than a Pool worker, because Pool workers are daemonic and may
+    # not start the consumer's own process pool.
+    context = multiprocessing.get_context('spawn')
+    queue = context.SimpleQueue()
+    process = context.Process(target=run_child, args=(queue, fn, args))
+    process.start()
+    succeeded, result = queue.get()
+    process.join()
+    if not succeeded:
+        raise RuntimeError('Benchmark child failed: {}'.format(result))
+    return result
+
+def psnr(expected, actual):
+    expected = Image.open(io.BytesIO(expected)).convert('RGB')
+    actual = Image.open(io.BytesIO(actual)).convert('RGB')
+    if expected.size != actual.size:
+        return None
+    stat = ImageStat.Stat(ImageChops.difference(expected, actual))
+    mse = sum(rms ** 2 for rms in stat.rms) / len(stat.rms)
+    if mse == 0:
+        return float('inf')
+    return round(10 * math.log10(255 ** 2 / mse), 2)
+
+def report(name, results, **meta):
+    payload = { 'benchmark': name, 'revision': git_revision(), 'pillow': Image.__version__, 'python': sys.version.split()[0] }
+    payload.update(meta)
+    payload['results'] = results
+    json.dump(payload, sys.stdout, indent=2, default=str)
+    sys.stdout.write('\n')
+
+class StaticHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        # Stand-in for the TCP + TLS handshake cost of a fresh connection.
+        time.sleep(self.server.connect_latency)
+        super().setup()
+
+    def log_message(self, format, *args):
+        return
+
+    def do_GET(self):
+        body = self.server.files.get(self.path)
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Content-Type', 'image/jpeg')
+        self.end_headers()
+        self.wfile.write(body)
+
+class StaticServer(object):
+    """Serves a dict of path -> bytes over keep-alive HTTP/1.1 on localhost."""
+
+    def __init__(self, files, connect_latency=0.0):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StaticHandler)
+        self.server.daemon_threads = True
+        self.server.files = files
+        self.server.connect_latency = connect_latency
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.server.server_address[1], path)
@@ -0,0 +1,64 @@
+"""Compare two benchmark reports, e.g. from the base and head of a branch.
+
+    python -m benchmarks.compare base.json head.json --threshold 10
+
+Results are matched on every non-measurement field (scenario, variant, format,
+size, source, profile, ...). Exits with 1 when a throughput (photos, requests
+or rows per second) drops, or p99 latency, peak RSS or bytes written grows, by
+more than --threshold percent.
+"""
+import argparse
+import json
+import sys
+
+# Higher is better for the first, lower for the rest.
+MEASUREMENTS = (('photos_per_second', 1), ('requests_per_second', 1), ('rows_per_second', 1), ('p50_ms', -1), ('p99_ms', -1), ('peak_rss_kb', -1), ('bytes', -1))
+GATED = ('photos_per_second', 'requests_per_second', 'rows_per_second', 'p99_ms', 'peak_rss_kb', 'bytes')
+IGNORED = set(name for name, direction in MEASUREMENTS) | set(['count', 'mean_ms', 'baseline_rss_kb', 'stages_mean_ms', 'failed', 'psnr_vs_full_db',
+    'bytes', 'bytes_vs_first', 'psnr_db', 'errors', 'encoded_bytes'])
+
+def result_key(result):
+    return tuple(sorted((name, str(value)) for name, value in result.items() if name not in IGNORED))
+
+def change(before, after):
+    if before in (None, 0) or after is None:
+        return None
+    return 100.0 * (after - before) / before
+
+def compare(base, head, threshold):
+    base_results = dict((result_key(result), result) for result in base['results'])
+    rows = []
+    regressions = []
+    for result in head['results']:
+        key = result_key(result)
+        if key not in base_results:
+            continue
+        label = ' '.join(value for name, value in key if value != 'None')
+        for name, direction in MEASUREMENTS:
+            delta = change(base_results[key].get(name), result.get(name))
+            if delta is None:
+                continue
+            rows.append((label, name, base_results[key][name], result[name], delta))
+            if threshold is not None and name in GATED and -direction * delta > threshold:
+                regressions.append((label, name, delta))
+    return rows, regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base')
+    parser.add_argument('head')
+    parser.add_argument('--threshold', type=float, default=None, help='percent change treated as a regression')
+    args = parser.parse_args()
+
+    with open(args.base) as base_file, open(args.head) as head_file:
+        base, head = json.load(base_file), json.load(head_file)
+    rows, regressions = compare(base, head, args.threshold)
+    print('{} ({}) -> {} ({})'.format(args.base, base.get('revision'), args.head, head.get('revision')))
+    for label, name, before, after, delta in rows:
+        print('{:<48} {:<18} {:>12} {:>12} {:>+8.1f}%'.format(label, name, before, after, delta))
+    for label, name, delta in regressions:
+        print('REGRESSION {} {} {:+.1f}%'.format(label, name, delta))
+    sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""Compare full-resolution decoding against draft-mode JPEG decoding.
+
+    python -m benchmarks.draft_decode --sizes 6000x4000,3000x2000 --iterations 5
+"""
+import argparse
+import io
+from PIL import Image
+from benchmarks.common import parse_size, synthetic_source, timed, summarize, peak_rss_kb, run_isolated, psnr, report
+from src.services.image_service import ImageService
+
+def full_decode(dimensions, data):
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    img.thumbnail(dimensions, Image.LANCZOS)
+    output = io.BytesIO()
+    img.save(output, 'JPEG')
+    return output.getvalue()
+
+def measure(variant, dimensions, data, iterations, reducing_gap):
+    baseline_rss_kb = peak_rss_kb()
+    if variant == 'full':
+        resize = lambda: full_decode(dimensions, data)
+    elif variant == 'thumbnail':
+        resize = lambda: ImageService(reducing_gap=None).resize_bytes(dimensions, data)
+    else:
+        resize = lambda: ImageService(reducing_gap=reducing_gap).resize_bytes(dimensions, data)
+    thumbnail, latencies = timed(resize, iterations)
+    result = summarize(latencies)
+    result['baseline_rss_kb'] = baseline_rss_kb
+    result['peak_rss_kb'] = peak_rss_kb()
+    return result, thumbnail
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default='6000x4000,3000x2000')
+    parser.add_argument('--dimensions', default='320x320')
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--reducing-gap', type=float, default=2.0)
+    args = parser.parse_args()
+
+    dimensions = parse_size(args.dimensions)
+    results = []
+    for size in args.sizes.split(','):
+        data = synthetic_source(parse_size(size))
+        reference = None
+        for variant in ('full', 'thumbnail', 'draft'):
+            result, thumbnail = run_isolated(measure, variant, dimensions, data, args.iterations, args.reducing_gap)
+            if reference is None:
+                reference = thumbnail
+            result.update({ 'source': size, 'variant': variant, 'psnr_vs_full_db': psnr(reference, thumbnail) })
+            results.append(result)
+    report('draft_decode', results, dimensions=args.dimensions, reducing_gap=args.reducing_gap)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Encode time against bytes written for thumbnail encoder profiles.
+
+    python -m benchmarks.encode_profiles --sizes 4000x3000 --profiles default,small,webp --iterations 20
+
+Each source is decoded and resized once; only encoding the renditions is
+timed. Profiles are THUMBNAIL_PROFILE values, so options can be tried before
+they are deployed, e.g. "jpeg:quality=70,progressive". psnr_db is measured
+against the unencoded renditions, so it shows what the smaller files cost in
+fidelity.
+"""
+import argparse
+import io
+from benchmarks.common import parse_size, synthetic_source, timed, summarize, psnr, report
+from src.services.image_service import open_for_thumbnail, render_thumbnails, bounding_box, parse_profile
+
+def encode_renditions(renditions, profile):
+    encoded = []
+    for rendition in renditions:
+        output = io.BytesIO()
+        profile.save(rendition, output)
+        encoded.append(output.getvalue())
+    return encoded
+
+def lossless(rendition):
+    output = io.BytesIO()
+    rendition.save(output, 'PNG')
+    return output.getvalue()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1600x1200,4000x3000')
+    parser.add_argument('--thumbnail-sizes', default='320x320,1024x1024')
+    parser.add_argument('--profiles', default='default,small,high,webp', help='semicolon separated when options use commas')
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    sizes = [parse_size(size) for size in args.thumbnail_sizes.split(',')]
+    separator = ';' if ';' in args.profiles else ','
+    profiles = [(name, parse_profile(name)) for name in args.profiles.split(separator)]
+    results = []
+    for size in args.sizes.split(','):
+        img = open_for_thumbnail(io.BytesIO(synthetic_source(parse_size(size))), bounding_box(sizes))
+        renditions = render_thumbnails(img, sizes)
+        references = [lossless(rendition) for rendition in renditions]
+        default_bytes = None
+        for name, profile in profiles:
+            encoded, latencies = timed(lambda: encode_renditions(renditions, profile), args.iterations)
+            written = sum(len(data) for data in encoded)
+            if default_bytes is None:
+                default_bytes = written
+            result = { 'source': size, 'profile': name }
+            result.update(summarize(latencies))
+            result['bytes'] = written
+            result['bytes_vs_first'] = round(written / default_bytes, 3)
+            result['psnr_db'] = min(psnr(reference, data) for reference, data in zip(references, encoded))
+            results.append(result)
+    report('encode_profiles', results, thumbnail_sizes=args.thumbnail_sizes, iterations=args.iterations)
+
+if __name__ == '__main__':
+    main()
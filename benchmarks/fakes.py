@@ -0,0 +1,147 @@
+"""In-memory stand-ins for Postgres and RabbitMQ, so the consumer and the
+web process can be driven end to end without either running.
+
+install() must run before `consumer` or `web` is imported: both take their
+services from the flat `db_service` and `messaging_service` modules.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from src.services.db_service import encode_after
+from src.services.json_encoding import stdlib_dumps
+
+CREATED_AT = datetime(2019, 4, 22, 10, 32, 52, tzinfo=timezone.utc)
+
+SERVICES_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'services')
+
+class FakeDbService(object):
+    # Answers the calls the consumer makes, sleeping `latency` seconds per
+    # call to stand in for the round trip.
+    urls = {}
+    latency = 0.0
+
+    def __init__(self, *args, **kwargs):
+        self.lock = threading.Lock()
+        self.version = (1, True)
+        # (width, height, url) rows by id, as get_thumbnails_for returns them.
+        self.thumbnails = {}
+        self.completed = {}
+        self.failed = []
+
+    def round_trip(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def rows(self, status):
+        return [{ 'uuid': id, 'url': url, 'status': status, 'created_at': CREATED_AT + timedelta(seconds=index) }
+            for index, (id, url) in enumerate(sorted(self.urls.items()))]
+
+    def get_version(self):
+        # Nothing here changes the rows; a test that changes urls bumps it.
+        self.round_trip()
+        return self.version
+
+    def get_page_by_status(self, status, limit, after=None):
+        self.round_trip()
+        rows = [row for row in self.rows(status) if after is None or (row['created_at'], row['uuid']) > after]
+        return rows[:limit]
+
+    def stream_by_status(self, status, after=None, chunk_size=1000):
+        self.round_trip()
+        for row in self.rows(status):
+            if after is None or (row['created_at'], row['uuid']) > after:
+                yield row
+
+    # The JSON variants encode in Python what PHOTO_JSON builds in Postgres.
+
+    def get_page_json_by_status(self, status, limit, after=None):
+        rows = self.get_page_by_status(status, limit, after)
+        next_after = encode_after(rows[-1]) if len(rows) == limit else None
+        return ([stdlib_dumps(row).decode('utf-8') for row in rows], next_after)
+
+    def stream_json_by_status(self, status, after=None, chunk_size=1000):
+        for row in self.stream_by_status(status, after, chunk_size):
+            yield stdlib_dumps(row).decode('utf-8')
+
+    def get_thumbnails_for(self, ids):
+        self.round_trip()
+        return dict((id, list(self.thumbnails.get(id, []))) for id in ids)
+
+    def claim(self, ids, statuses=None, lease_seconds=None):
+        self.round_trip()
+        return [{ 'uuid': id, 'url': self.urls[id], 'status': 'processing', 'created_at': None } for id in ids if id in self.urls]
+
+    def complete(self, thumbnails_by_id):
+        self.round_trip()
+        with self.lock:
+            self.completed.update(thumbnails_by_id)
+
+    def renew(self, ids, lease_seconds):
+        self.round_trip()
+
+    def fail(self, ids, error_classes=None):
+        self.round_trip()
+        with self.lock:
+            self.failed.extend(ids)
+
+    def set_status(self, id, status):
+        self.round_trip()
+
+class FakeMessagingService(object):
+    # Delivers a fixed list of messages, recording when each was delivered
+    # and settled, then returns like a consumer whose connection closed.
+    messages = []
+    latency = 0.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.delivered_at = {}
+        self.settled = {}
+        self.all_settled = threading.Event()
+        FakeMessagingService.instance = self
+
+    def settle(self, tag, result):
+        with self.lock:
+            self.settled[tag] = (result, time.perf_counter())
+            if len(self.settled) == len(self.messages):
+                self.all_settled.set()
+
+    def consume(self, callback):
+        for tag, message in enumerate(self.messages):
+            self.delivered_at[tag] = time.perf_counter()
+            self.settle(tag, callback(json.loads(json.dumps(message))))
+
+    def consume_concurrently(self, dispatch, prefetch_count):
+        window = threading.Semaphore(prefetch_count)
+        def done(result, tag):
+            self.settle(tag, result)
+            window.release()
+        for tag, message in enumerate(self.messages):
+            window.acquire()
+            self.delivered_at[tag] = time.perf_counter()
+            dispatch(json.loads(json.dumps(message)), lambda result, tag=tag: done(result, tag))
+        self.all_settled.wait()
+
+    def push_uuids(self, uuids, per_message=1, force=False, batch_size=1000):
+        # One publish and confirm round trip, as for a single batch.
+        if self.latency:
+            time.sleep(self.latency)
+        return [True] * len(uuids)
+
+    def latencies(self):
+        return [self.settled[tag][1] - self.delivered_at[tag] for tag in sorted(self.settled)]
+
+def install(urls, messages, db_latency=0.0, publish_latency=0.0):
+    if SERVICES_PATH not in sys.path:
+        sys.path.insert(0, SERVICES_PATH)
+    import db_service
+    import messaging_service
+    FakeDbService.urls = urls
+    FakeDbService.latency = db_latency
+    FakeMessagingService.messages = messages
+    FakeMessagingService.latency = publish_latency
+    db_service.DbService = FakeDbService
+    messaging_service.MessagingService = FakeMessagingService
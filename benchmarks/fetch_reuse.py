@@ -0,0 +1,75 @@
+"""Per-photo fetch latency with and without connection reuse.
+
+    python -m benchmarks.fetch_reuse --photos 200 --connect-latency 0.02
+
+--connect-latency adds a delay to every new connection on the local stand-in
+server, approximating the TCP + TLS handshake to S3.
+"""
+import argparse
+import asyncio
+import sys
+import time
+from benchmarks.common import StaticServer, synthetic_source, parse_size, summarize, report
+from benchmarks.fakes import SERVICES_PATH
+
+# async_fetch_service imports its siblings flat, as the consumers run it.
+sys.path.insert(0, SERVICES_PATH)
+from fetch_service import FetchService
+from async_fetch_service import AsyncFetchService
+
+def urllib_fetch(urls):
+    fetch_service = FetchService()
+    latencies = []
+    for url in urls:
+        started = time.perf_counter()
+        fetch_service.fetch(url)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+def pooled_fetch(urls, concurrency):
+    async def _fetch_all():
+        service = AsyncFetchService(per_host_limit=concurrency)
+        latencies = []
+        async def _fetch(url):
+            started = time.perf_counter()
+            await service.fetch(url)
+            latencies.append(time.perf_counter() - started)
+        try:
+            if concurrency == 1:
+                for url in urls:
+                    await _fetch(url)
+            else:
+                await asyncio.gather(*[_fetch(url) for url in urls])
+        finally:
+            await service.close()
+        return latencies
+    return asyncio.run(_fetch_all())
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--photos', type=int, default=200)
+    parser.add_argument('--size', default='1600x1200')
+    parser.add_argument('--connect-latency', type=float, default=0.02)
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+
+    files = { '/{}.jpg'.format(index): synthetic_source(parse_size(args.size)) for index in range(8) }
+    results = []
+    with StaticServer(files, args.connect_latency) as server:
+        urls = [server.url('/{}.jpg'.format(index % len(files))) for index in range(args.photos)]
+        variants = (
+            ('urllib', lambda: urllib_fetch(urls)),
+            ('pooled', lambda: pooled_fetch(urls, 1)),
+            ('pooled_concurrent', lambda: pooled_fetch(urls, args.concurrency)),
+        )
+        for name, run in variants:
+            started = time.perf_counter()
+            latencies = run()
+            elapsed = time.perf_counter() - started
+            result = summarize(latencies)
+            result.update({ 'variant': name, 'photos_per_second': round(len(urls) / elapsed, 2) })
+            results.append(result)
+    report('fetch_reuse', results, photos=args.photos, size=args.size, connect_latency=args.connect_latency)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""Rows/sec and peak memory of encoding the /photos/pending listing.
+
+    python -m benchmarks.json_rows --rows 200000
+
+Each variant streams --rows photos into JSON chunks, as the web process does,
+in a fresh process:
+
+  flask-dicts     a dict per row, encoded by Flask's json.dumps (the listing
+                  before PHOTO_JSON)
+  stdlib-dicts    a dict per row, encoded by json_encoding.stdlib_dumps
+  orjson-dicts    the same through orjson, when it is installed
+  postgres-json   rows arrive as JSON text and are only joined
+
+Offline, the rows are generated in the shape psycopg2 returns them: a str
+UUID and an aware datetime per row, or one str per row for PHOTO_JSON. So
+the figures cover the Python side only. With --live, rows come from
+DbService against PG_CONNECTION_URI, and the time Postgres spends building
+the JSON is included.
+"""
+import argparse
+import time
+from datetime import datetime, timedelta, timezone
+from uuid import UUID
+from benchmarks.common import peak_rss_kb, run_isolated, report
+
+CREATED_AT = datetime(2019, 4, 22, 10, 32, 52, 123456, tzinfo=timezone.utc)
+PHOTO_JSON_TEMPLATE = '{{"created_at" : "{}", "status" : "pending", "url" : "https://s3.amazonaws.com/waldo-thumbs-dev/large/{}.jpg", "uuid" : "{}"}}'
+
+def driver_rows(count):
+    for index in range(count):
+        id = str(UUID(int=index))
+        yield (id, 'https://s3.amazonaws.com/waldo-thumbs-dev/large/{}.jpg'.format(id), 'pending', CREATED_AT + timedelta(seconds=index))
+
+def driver_json_rows(count):
+    created_at = CREATED_AT.strftime('%a, %d %b %Y %H:%M:%S GMT')
+    for index in range(count):
+        id = str(UUID(int=index))
+        yield PHOTO_JSON_TEMPLATE.format(created_at, id, id)
+
+def dict_rows(rows):
+    from src.services.db_service import COLUMNS
+    for row in rows:
+        yield dict(zip(COLUMNS, row))
+
+def encoded_chunks(variant, count, live):
+    # The chunks stream_json_array would send for this variant.
+    if variant == 'postgres-json':
+        if live:
+            from src.services.db_service import DbService
+            rows = DbService(max_connections=1).stream_json_by_status('pending')
+        else:
+            rows = driver_json_rows(count)
+        for row in rows:
+            yield row
+        return
+    if live:
+        from src.services.db_service import DbService
+        rows = DbService(max_connections=1).stream_by_status('pending')
+    else:
+        rows = dict_rows(driver_rows(count))
+    if variant == 'flask-dicts':
+        from flask import Flask, json
+        with Flask(__name__).app_context():
+            for row in rows:
+                yield json.dumps(row)
+        return
+    from src.services.json_encoding import select_dumps
+    dumps = select_dumps('orjson' if variant == 'orjson-dicts' else 'stdlib')
+    for row in rows:
+        yield dumps(row)
+
+def measure(variant, count, live):
+    baseline_rss_kb = peak_rss_kb()
+    encoded_rows = 0
+    encoded_bytes = 0
+    started = time.perf_counter()
+    for chunk in encoded_chunks(variant, count, live):
+        encoded_rows += 1
+        encoded_bytes += len(chunk)
+    elapsed = time.perf_counter() - started
+    return {
+        'count': encoded_rows,
+        'rows_per_second': round(encoded_rows / elapsed, 2),
+        'encoded_bytes': encoded_bytes,
+        'baseline_rss_kb': baseline_rss_kb,
+        'peak_rss_kb': peak_rss_kb(),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=200000, help='photos encoded per variant (offline)')
+    parser.add_argument('--variants', default='flask-dicts,stdlib-dicts,orjson-dicts,postgres-json')
+    parser.add_argument('--live', action='store_true', help='read the pending photos from PG_CONNECTION_URI instead')
+    args = parser.parse_args()
+
+    from src.services.json_encoding import orjson
+    results = []
+    for variant in args.variants.split(','):
+        if variant == 'orjson-dicts' and orjson is None:
+            continue
+        result = { 'scenario': 'listing', 'variant': variant, 'live': args.live }
+        result.update(run_isolated(measure, variant, args.rows, args.live))
+        results.append(result)
+    report('json_rows', results, rows=args.rows, live=args.live)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""Offline benchmark of the thumbnail pipeline over a synthetic corpus.
+
+    python -m benchmarks.pipeline --sizes 1600x1200,4000x3000 --formats JPEG,PNG --photos 20 > head.json
+
+Every (scenario, format, size) runs in a fresh process against originals
+served from a local stand-in server:
+
+  resize    ImageService.resize from an in-memory original
+  download  FetchService.download to a temporary file
+  consumer  consumer.app() end to end, once per --fetch-modes entry, with
+            in-memory fakes for Postgres and RabbitMQ (see benchmarks.fakes)
+
+The corpus is seeded, so two runs on different commits process identical
+bytes; compare them with benchmarks.compare.
+"""
+import argparse
+import io
+import os
+import tempfile
+import time
+import uuid
+from contextlib import redirect_stdout
+from benchmarks.common import StaticServer, parse_size, synthetic_source, summarize, peak_rss_kb, run_isolated, report
+
+EXTENSIONS = { 'JPEG': 'jpg', 'PNG': 'png' }
+
+def build_corpus(size, format, distinct):
+    return dict(('/{}.{}'.format(seed, EXTENSIONS[format]), synthetic_source(size, format, seed)) for seed in range(distinct))
+
+def photo_paths(files, photos):
+    paths = sorted(files)
+    return [paths[index % len(paths)] for index in range(photos)]
+
+def finish(result, latencies, elapsed, baseline_rss_kb):
+    result.update(summarize(latencies))
+    result['photos_per_second'] = round(len(latencies) / elapsed, 2)
+    result['baseline_rss_kb'] = baseline_rss_kb
+    result['peak_rss_kb'] = peak_rss_kb()
+    return result
+
+def measure_resize(files, photos, dimensions):
+    from src.services.image_service import ImageService
+    baseline_rss_kb = peak_rss_kb()
+    image_service = ImageService()
+    latencies = []
+    with tempfile.TemporaryDirectory() as directory:
+        output_path = os.path.join(directory, 'thumbnail.jpeg')
+        started = time.perf_counter()
+        for path in photo_paths(files, photos):
+            photo_started = time.perf_counter()
+            image_service.resize(dimensions, io.BytesIO(files[path]), output_path)
+            latencies.append(time.perf_counter() - photo_started)
+        elapsed = time.perf_counter() - started
+    return finish({}, latencies, elapsed, baseline_rss_kb)
+
+def measure_download(files, photos, connect_latency):
+    from src.services.fetch_service import FetchService
+    baseline_rss_kb = peak_rss_kb()
+    fetch_service = FetchService()
+    latencies = []
+    with tempfile.TemporaryDirectory() as directory, StaticServer(files, connect_latency) as server:
+        destination = os.path.join(directory, 'original')
+        started = time.perf_counter()
+        for path in photo_paths(files, photos):
+            photo_started = time.perf_counter()
+            fetch_service.download(server.url(path), destination)
+            latencies.append(time.perf_counter() - photo_started)
+        elapsed = time.perf_counter() - started
+    return finish({}, latencies, elapsed, baseline_rss_kb)
+
+def measure_consumer(files, photos, connect_latency, settings, db_latency):
+    from benchmarks import fakes
+    baseline_rss_kb = peak_rss_kb()
+    with tempfile.TemporaryDirectory() as directory, StaticServer(files, connect_latency) as server:
+        ids = [str(uuid.UUID(int=index + 1)) for index in range(photos)]
+        urls = dict((id, server.url(path)) for id, path in zip(ids, photo_paths(files, photos)))
+        os.environ.update(settings)
+        os.environ.update({ 'THUMBNAIL_DIR': directory, 'METRICS_PORT': '0', 'COMPLETION_CACHE_SIZE': '0' })
+        fakes.install(urls, ids, db_latency)
+        # The consumer logs a line per photo; keep stdout for the report.
+        with redirect_stdout(io.StringIO()):
+            import consumer
+            started = time.perf_counter()
+            consumer.app()
+            elapsed = time.perf_counter() - started
+        broker = fakes.FakeMessagingService.instance
+        result = { 'failed': len(consumer.db_service.failed) }
+        result['stages_mean_ms'] = dict(
+            (stage, round(1000 * total / count, 3)) for (stage,), (counts, total, count) in sorted(consumer.stage_seconds.values.items()))
+        if hasattr(consumer.image_service, 'shutdown'):
+            consumer.image_service.shutdown()
+    return finish(result, broker.latencies(), elapsed, baseline_rss_kb)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1600x1200,4000x3000')
+    parser.add_argument('--formats', default='JPEG,PNG')
+    parser.add_argument('--photos', type=int, default=20, help='photos processed per scenario')
+    parser.add_argument('--distinct', type=int, default=4, help='distinct originals per format and size')
+    parser.add_argument('--scenarios', default='resize,download,consumer')
+    parser.add_argument('--thumbnail-sizes', default='320x320')
+    parser.add_argument('--fetch-modes', default='stream,file')
+    parser.add_argument('--consumer-mode', default='blocking', help='blocking or pipelined')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--image-backend', default='inline')
+    parser.add_argument('--connect-latency', type=float, default=0.0)
+    parser.add_argument('--db-latency', type=float, default=0.0, help='seconds added to every fake database call')
+    args = parser.parse_args()
+
+    scenarios = args.scenarios.split(',')
+    dimensions = parse_size(args.thumbnail_sizes.split(',')[0])
+    results = []
+    for format in args.formats.upper().split(','):
+        for size in args.sizes.split(','):
+            files = build_corpus(parse_size(size), format, args.distinct)
+            variants = []
+            if 'resize' in scenarios:
+                variants.append(('resize', None, measure_resize, (files, args.photos, dimensions)))
+            if 'download' in scenarios:
+                variants.append(('download', None, measure_download, (files, args.photos, args.connect_latency)))
+            if 'consumer' in scenarios:
+                for fetch_mode in args.fetch_modes.split(','):
+                    settings = {
+                        'CONSUMER_MODE': args.consumer_mode,
+                        'FETCH_MODE': fetch_mode,
+                        'IMAGE_BACKEND': args.image_backend,
+                        'CONSUMER_WORKERS': str(args.workers),
+                        'THUMBNAIL_SIZES': args.thumbnail_sizes,
+                    }
+                    variants.append(('consumer', fetch_mode, measure_consumer, (files, args.photos, args.connect_latency, settings, args.db_latency)))
+            for scenario, variant, measure, measure_args in variants:
+                result = { 'scenario': scenario, 'variant': variant, 'format': format, 'size': size,
+                    'source_kb': round(sum(len(data) for data in files.values()) / len(files) / 1024, 1) }
+                result.update(run_isolated(measure, *measure_args))
+                results.append(result)
+    report('pipeline', results, photos=args.photos, thumbnail_sizes=args.thumbnail_sizes,
+        consumer_mode=args.consumer_mode, workers=args.workers, image_backend=args.image_backend, connect_latency=args.connect_latency, db_latency=args.db_latency)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""Request throughput and latency of the web process under concurrent load.
+
+    python -m benchmarks.web_load --servers development,gunicorn --concurrency 16 --requests 2000
+
+Every (server, endpoint) starts web.create_app() in a fresh server process
+with in-memory fakes for Postgres and RabbitMQ (see benchmarks.fakes), then
+drives it from --concurrency client threads, each on its own keep-alive
+connection:
+
+  pending      GET /photos/pending?limit=--page-size
+  revalidate   the same, sending back the last ETag in If-None-Match, as a
+               polling dashboard would
+  process      POST /photos/process with --uuids-per-request UUIDs
+
+Set PENDING_CACHE_TTL=0 to measure the listing without the response cache.
+
+--db-latency and --publish-latency add a delay to every fake database call
+and broker publish, which is what the handlers mostly wait on in production.
+"""
+import argparse
+import http.client
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from benchmarks.common import summarize, report
+
+ENDPOINTS = {
+    'pending': lambda args: ('GET', '/photos/pending?limit={}'.format(args.page_size), None),
+    'revalidate': lambda args: ('GET', '/photos/pending?limit={}'.format(args.page_size), None),
+    'process': lambda args: ('POST', '/photos/process', json.dumps([str(uuid.uuid4()) for _ in range(args.uuids_per_request)])),
+}
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+def serve(args):
+    # Runs in the server process: the fakes are installed before anything
+    # imports `web`, and gunicorn's workers inherit them through the fork.
+    from benchmarks import fakes
+    ids = [str(uuid.UUID(int=index + 1)) for index in range(args.photos)]
+    fakes.install(dict((id, 'http://127.0.0.1/{}.jpg'.format(id)) for id in ids), [], args.db_latency, args.publish_latency)
+    os.environ['REAPER_INTERVAL'] = '0'
+    if args.serve == 'development':
+        import web
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        web.create_app().run(host='127.0.0.1', port=args.port)
+        return
+    from gunicorn.app.base import BaseApplication
+    class Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', '127.0.0.1:{}'.format(args.port))
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('workers', args.workers)
+            self.cfg.set('threads', args.threads)
+            self.cfg.set('loglevel', 'warning')
+
+        def load(self):
+            # Called in each worker after the fork, like "web:create_app()".
+            import web
+            return web.create_app()
+    Server().run()
+
+def start_server(server, port, args):
+    command = [sys.executable, '-m', 'benchmarks.web_load', '--serve', server, '--port', str(port),
+        '--workers', str(args.workers), '--threads', str(args.threads), '--photos', str(args.photos),
+        '--db-latency', str(args.db_latency), '--publish-latency', str(args.publish_latency)]
+    process = subprocess.Popen(command, env=dict(os.environ, PYTHONPATH=os.getcwd()), stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            connection.request('GET', '/metrics')
+            connection.getresponse().read()
+            connection.close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('{} server did not start on port {}'.format(server, port))
+
+def run_client(port, requests, build_request, revalidate, latencies, errors):
+    # The development server answers HTTP/1.0 and closes every connection,
+    # so the client reconnects whenever it has to.
+    connection = None
+    etag = None
+    for _ in range(requests):
+        method, path, body = build_request()
+        headers = { 'Content-Type': 'application/json' }
+        if revalidate and etag is not None:
+            headers['If-None-Match'] = etag
+        started = time.perf_counter()
+        try:
+            if connection is None:
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            if response.status >= 400:
+                errors.append(response.status)
+            etag = response.getheader('ETag') or etag
+            if response.will_close:
+                connection.close()
+                connection = None
+        except (OSError, http.client.HTTPException) as ex:
+            errors.append(type(ex).__name__)
+            connection = None
+            continue
+        latencies.append(time.perf_counter() - started)
+    if connection is not None:
+        connection.close()
+
+def measure(port, endpoint, args):
+    build_request = lambda: ENDPOINTS[endpoint](args)
+    revalidate = endpoint == 'revalidate'
+    # Warm every worker's connections and code paths first.
+    run_client(port, args.concurrency, build_request, revalidate, [], [])
+    latencies = []
+    errors = []
+    per_client = args.requests // args.concurrency
+    threads = [threading.Thread(target=run_client, args=(port, per_client, build_request, revalidate, latencies, errors)) for _ in range(args.concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    result = summarize(latencies)
+    result['requests_per_second'] = round(len(latencies) / elapsed, 2)
+    result['errors'] = len(errors)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--servers', default='development,gunicorn')
+    parser.add_argument('--endpoints', default='pending,revalidate,process')
+    parser.add_argument('--requests', type=int, default=2000, help='requests per (server, endpoint)')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn worker processes')
+    parser.add_argument('--threads', type=int, default=4, help='threads per gunicorn worker')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--uuids-per-request', type=int, default=10)
+    parser.add_argument('--photos', type=int, default=1000, help='pending photos the fake database holds')
+    parser.add_argument('--db-latency', type=float, default=0.002, help='seconds added to every fake database call')
+    parser.add_argument('--publish-latency', type=float, default=0.005, help='seconds added to every fake broker publish')
+    parser.add_argument('--serve', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+    results = []
+    for server in args.servers.split(','):
+        for endpoint in args.endpoints.split(','):
+            port = free_port()
+            process = start_server(server, port, args)
+            try:
+                result = { 'scenario': endpoint, 'variant': server }
+                result.update(measure(port, endpoint, args))
+                results.append(result)
+            finally:
+                process.terminate()
+                process.wait()
+    report('web_load', results, requests=args.requests, concurrency=args.concurrency, workers=args.workers, threads=args.threads,
+        db_latency=args.db_latency, publish_latency=args.publish_latency)
+
+if __name__ == '__main__':
+    main()
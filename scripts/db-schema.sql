@@ -3,20 +3,40 @@ CREATE EXTENSION IF NOT EXISTS pgcrypto;
 DROP TABLE IF EXISTS photo_thumbnails;
 DROP TABLE IF EXISTS photos;
 DROP TYPE IF EXISTS photo_status;
+DROP SEQUENCE IF EXISTS photos_version_seq;
 
 CREATE TYPE photo_status as enum('pending', 'completed', 'processing', 'failed');
 CREATE TABLE photos (
     uuid uuid DEFAULT gen_random_uuid() PRIMARY KEY,
     url text NOT NULL,
     status photo_status DEFAULT 'pending' NOT NULL,
-    created_at timestamp with time zone DEFAULT now() NOT NULL
+    created_at timestamp with time zone DEFAULT now() NOT NULL,
+    lease_expires_at timestamp with time zone,
+    error_class text
 );
+CREATE INDEX photos__status__created_at__uuid_idx ON photos (status, created_at, uuid);
+CREATE INDEX photos__lease_expires_at_idx ON photos (lease_expires_at) WHERE status = 'processing';
+
+-- Version token for cached listings: bumped once per statement that could
+-- change what they return. Lease renewals only set lease_expires_at and do
+-- not bump it.
+CREATE SEQUENCE photos_version_seq;
+CREATE OR REPLACE FUNCTION bump_photos_version() RETURNS trigger AS $$
+BEGIN
+    PERFORM nextval('photos_version_seq');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER photos__bump_version_trg
+AFTER INSERT OR DELETE OR UPDATE OF status, url OR TRUNCATE ON photos
+FOR EACH STATEMENT EXECUTE PROCEDURE bump_photos_version();
 CREATE TABLE photo_thumbnails (
     uuid uuid DEFAULT gen_random_uuid() PRIMARY KEY,
     photo_uuid uuid REFERENCES photos(uuid) NOT NULL,
     width SMALLINT NOT NULL,
     height SMALLINT NOT NULL,
     url TEXT NOT NULL,
+    format TEXT DEFAULT 'jpeg' NOT NULL,
     created_at timestamp with time zone DEFAULT now() NOT NULL
 );
 
@@ -0,0 +1,33 @@
+import threading
+from contextlib import contextmanager
+
+class AdmissionController(object):
+    # A semaphore counted in bytes: admit(cost) blocks while the work already
+    # admitted plus cost would pass the budget. Work larger than the whole
+    # budget is still let through on its own once nothing else is running,
+    # so callers that want it refused have to check against budget first.
+    def __init__(self, budget):
+        self.budget = budget
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+
+    @contextmanager
+    def admit(self, cost):
+        with self.condition:
+            self.waiting += 1
+            try:
+                self.condition.wait_for(lambda: self.in_flight == 0 or self.in_flight + cost <= self.budget)
+            finally:
+                self.waiting -= 1
+            self.in_flight += cost
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_flight -= cost
+                self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return { 'in_flight': self.in_flight, 'waiting': self.waiting, 'budget': self.budget }
@@ -0,0 +1,150 @@
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import aioamqp
+import consumer
+from async_fetch_service import AsyncFetchService
+from messaging_service import QUEUE_NAME, Retry, parse_retry_delays, retry_topology, republications
+
+class AsyncConsumer(object):
+    # One event loop keeps up to prefetch_count messages in flight: downloads
+    # overlap on pooled keep-alive connections, resizes and database calls run
+    # on executor threads, and each message is acked as soon as it is done.
+    def __init__(self, amqp_uri, prefetch_count, fetch_service, resize_workers, retry_delays):
+        self.amqp_uri = amqp_uri
+        self.prefetch_count = prefetch_count
+        self.retry_delays = retry_delays
+        self.fetch_service = fetch_service
+        self.resize_executor = ThreadPoolExecutor(max_workers=resize_workers)
+        self.tasks = set()
+
+    async def run(self):
+        transport, protocol = await aioamqp.from_url(self.amqp_uri)
+        try:
+            channel = await protocol.channel()
+            await channel.queue_declare(queue_name=QUEUE_NAME, durable=True)
+            for queue_name, arguments in retry_topology(self.retry_delays):
+                await channel.queue_declare(queue_name=queue_name, durable=True, arguments=arguments)
+            await channel.basic_qos(prefetch_count=self.prefetch_count, prefetch_size=0, connection_global=False)
+            await channel.basic_consume(self.on_message, queue_name=QUEUE_NAME)
+            await protocol.wait_closed()
+        finally:
+            transport.close()
+
+    async def on_message(self, channel, body, envelope, properties):
+        # aioamqp awaits this before reading the next delivery, so the work
+        # is handed to its own task.
+        task = asyncio.ensure_future(self.settle(channel, body, envelope.delivery_tag, properties))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def settle(self, channel, body, delivery_tag, properties):
+        try:
+            result = await self.callback(json.loads(body))
+        except Exception as ex:
+            print('[async_consumer] Callback raised: {}'.format(ex))
+            result = False
+        try:
+            # As in MessagingService.settle: failures go through the retry
+            # queues, published before the delivery is acked.
+            headers = getattr(properties, 'headers', None)
+            for routing_key, payload, outgoing in republications(result, body, headers, self.retry_delays):
+                await channel.basic_publish(payload, exchange_name='', routing_key=routing_key,
+                    properties={ 'delivery_mode': 2, 'headers': outgoing })
+            await channel.basic_client_ack(delivery_tag)
+        except aioamqp.AioamqpException as ex:
+            # The broker redelivers anything left unacked on a closed channel.
+            print('[async_consumer] Could not settle message {}: {}'.format(delivery_tag, ex))
+
+    async def callback(self, message):
+        with consumer.message_seconds.time():
+            return await self.process(message)
+
+    async def process(self, message):
+        loop = asyncio.get_event_loop()
+        ids, force = consumer.parse_message(message)
+        records = await loop.run_in_executor(None, consumer.claim_records, ids, force)
+        if records is None:
+            return Retry(error_class='db')
+        results = await asyncio.gather(*[self.render_record(record) for record in records])
+        completed = {}
+        failures = {}
+        for record, result in zip(records, results):
+            id = str(record['uuid'])
+            if isinstance(result, consumer.Failure):
+                consumer.report_failure(id, result)
+                failures[id] = result
+            else:
+                completed[id] = result
+        failures = await loop.run_in_executor(None, consumer.finish_records, completed, failures)
+        return consumer.verdict(failures, force)
+
+    async def render_record(self, record):
+        # Returns the thumbnail rows, or a consumer.Failure naming the stage
+        # that failed.
+        loop = asyncio.get_event_loop()
+        renditions = consumer.build_renditions(record)
+        try:
+            with consumer.stage_seconds.time(stage='fetch'):
+                source = await self.fetch_service.fetch(record['url'])
+        except Exception as ex:
+            return consumer.classify_failure(ex, 'fetch')
+        try:
+            thumbnails = await loop.run_in_executor(self.resize_executor, consumer.image_service.encode_renditions, consumer.thumbnail_sizes, source)
+        except Exception as ex:
+            return consumer.classify_failure(ex, 'resize')
+        try:
+            await loop.run_in_executor(None, consumer.image_service.write_renditions, thumbnails, [path for dimensions, path in renditions])
+        except Exception as ex:
+            return consumer.classify_failure(ex, 'write')
+        return consumer.thumbnail_rows(renditions)
+
+    async def close(self):
+        if len(self.tasks) > 0:
+            await asyncio.wait(list(self.tasks))
+        await self.fetch_service.close()
+        self.resize_executor.shutdown()
+
+def build_async_consumer():
+    fetch_service = AsyncFetchService(
+        per_host_limit=int(os.environ.get('ASYNC_FETCH_PER_HOST') or 16),
+        max_bytes=consumer.fetch_service.max_bytes,
+        cache=consumer.fetch_service.cache)
+    return AsyncConsumer(
+        os.environ['AMQP_URI'],
+        int(os.environ.get('CONSUMER_PREFETCH') or 100),
+        fetch_service,
+        int(os.environ.get('CONSUMER_WORKERS') or os.cpu_count() or 1),
+        parse_retry_delays(os.environ.get('RETRY_DELAYS')))
+
+async def consume():
+    async_consumer = build_async_consumer()
+    retries = 0
+    try:
+        while True:
+            try:
+                await async_consumer.run()
+                retries = 0
+            except (aioamqp.AmqpClosedConnection, OSError) as ex:
+                retries += 1
+                if retries == 3:
+                    raise ex
+                print('[async_consumer] Reconnecting after: {}'.format(ex))
+            await asyncio.sleep(1)
+    finally:
+        await async_consumer.close()
+
+def app():
+    try:
+        print('[async_consumer] Starting app!')
+        consumer.start_metrics_server()
+        consumer.lease_keeper.start()
+        asyncio.get_event_loop().run_until_complete(consume())
+        print('[async_consumer] Consumer has exited!')
+    except Exception as ex:
+        print('[async_consumer] FAILED starting app: {}'.format(ex))
+        return
+
+if __name__ == '__main__':
+    app()
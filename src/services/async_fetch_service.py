@@ -0,0 +1,243 @@
+import asyncio
+import io
+import ssl
+import time
+from urllib.parse import urlsplit, urljoin
+
+from fetch_service import DownloadTooLarge, CHUNK_SIZE
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+class HttpStatusError(Exception):
+    def __init__(self, url, status):
+        super().__init__('{} responded with HTTP {}'.format(url, status))
+        self.url = url
+        self.status = status
+
+class Response(object):
+    def __init__(self, url, status, headers, body):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+class PooledConnection(object):
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.released_at = time.monotonic()
+
+    def close(self):
+        self.writer.close()
+
+class HostPool(object):
+    def __init__(self, limit):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.idle = []
+        self.connections_opened = 0
+
+    def checkout(self, idle_timeout):
+        while len(self.idle) > 0:
+            connection = self.idle.pop()
+            if connection.reader.at_eof() or time.monotonic() - connection.released_at > idle_timeout:
+                connection.close()
+                continue
+            return connection
+        return None
+
+    def checkin(self, connection):
+        connection.released_at = time.monotonic()
+        self.idle.append(connection)
+
+    def close(self):
+        for connection in self.idle:
+            connection.close()
+        self.idle = []
+
+class AsyncFetchService(object):
+    def __init__(self, per_host_limit=8, connect_timeout=5.0, read_timeout=30.0, retries=3, backoff=0.5, max_bytes=None, idle_timeout=30.0, max_redirects=5, cache=None):
+        self.per_host_limit = per_host_limit
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_bytes = max_bytes
+        self.idle_timeout = idle_timeout
+        self.max_redirects = max_redirects
+        self.cache = cache
+        self.ssl_context = ssl.create_default_context()
+        self.pools = {}
+
+    async def fetch(self, url):
+        headers = {}
+        if self.cache is not None:
+            cached = self.cache.fresh(url)
+            if cached is not None:
+                return cached
+            headers = self.cache.validators(url)
+        response = await self.request(url, headers)
+        if response.status == 304 and self.cache is not None:
+            cached = self.cache.not_modified(url)
+            if cached is not None:
+                return cached
+            response = await self.request(url)
+        if response.status >= 300:
+            raise HttpStatusError(response.url, response.status)
+        if self.cache is not None:
+            self.cache.store(url, response.body.getvalue(), response.headers.get('etag'), response.headers.get('last-modified'))
+        return response.body
+
+    async def fetch_bytes(self, url):
+        return (await self.fetch(url)).getvalue()
+
+    async def request(self, url, headers=None):
+        attempt = 0
+        while True:
+            try:
+                response = await self.follow_redirects(url, headers or {})
+                if response.status not in RETRY_STATUSES or attempt >= self.retries:
+                    return response
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as ex:
+                if attempt >= self.retries:
+                    raise ex
+            await asyncio.sleep(self.backoff * (2 ** attempt))
+            attempt += 1
+
+    async def follow_redirects(self, url, headers):
+        for _ in range(self.max_redirects + 1):
+            response = await self.request_once(url, headers)
+            if response.status not in REDIRECT_STATUSES or 'location' not in response.headers:
+                return response
+            url = urljoin(url, response.headers['location'])
+        raise HttpStatusError(url, response.status)
+
+    async def request_once(self, url, headers):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        if key not in self.pools:
+            self.pools[key] = HostPool(self.per_host_limit)
+        pool = self.pools[key]
+        async with pool.semaphore:
+            connection = pool.checkout(self.idle_timeout)
+            if connection is not None:
+                try:
+                    return await self.exchange(pool, connection, url, parts, headers)
+                except (OSError, asyncio.IncompleteReadError):
+                    # The server may have dropped an idle keep-alive
+                    # connection; a GET is safe to replay on a fresh one.
+                    pass
+            connection = await self.connect(pool, parts)
+            return await self.exchange(pool, connection, url, parts, headers)
+
+    async def connect(self, pool, parts):
+        secure = parts.scheme == 'https'
+        port = parts.port or (443 if secure else 80)
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(parts.hostname, port, ssl=self.ssl_context if secure else None),
+            self.connect_timeout)
+        pool.connections_opened += 1
+        return PooledConnection(reader, writer)
+
+    async def exchange(self, pool, connection, url, parts, headers):
+        try:
+            connection.writer.write(self.build_request(parts, headers))
+            await asyncio.wait_for(connection.writer.drain(), self.read_timeout)
+            status, response_headers, keep_alive = await self.read_head(connection.reader)
+            body = await self.read_body(connection.reader, status, response_headers)
+        except BaseException:
+            connection.close()
+            raise
+        # Only a body with an explicit length can leave the socket reusable.
+        framed = status in (204, 304) or 'content-length' in response_headers or is_chunked(response_headers)
+        if keep_alive and framed:
+            pool.checkin(connection)
+        else:
+            connection.close()
+        return Response(url, status, response_headers, body)
+
+    def build_request(self, parts, headers):
+        path = parts.path or '/'
+        if parts.query:
+            path = '{}?{}'.format(path, parts.query)
+        # Credentials in the URL are not sent, in Host or otherwise.
+        host = parts.netloc.rpartition('@')[2]
+        lines = ['GET {} HTTP/1.1'.format(path), 'Host: {}'.format(host), 'Connection: keep-alive', 'Accept-Encoding: identity']
+        for name, value in headers.items():
+            lines.append('{}: {}'.format(name, value))
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    async def readline(self, reader):
+        line = await asyncio.wait_for(reader.readline(), self.read_timeout)
+        if not line:
+            raise asyncio.IncompleteReadError(b'', None)
+        return line
+
+    async def read_head(self, reader):
+        while True:
+            status_line = (await self.readline(reader)).decode('latin-1').rstrip('\r\n').split(' ', 2)
+            version, status = status_line[0], status_line[1]
+            headers = {}
+            while True:
+                line = (await self.readline(reader)).decode('latin-1').rstrip('\r\n')
+                if line == '':
+                    break
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            if not status.startswith('1'):
+                break
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+        return (int(status), headers, keep_alive)
+
+    async def read_body(self, reader, status, headers):
+        body = io.BytesIO()
+        if status in (204, 304):
+            return body
+        if is_chunked(headers):
+            while True:
+                size = int((await self.readline(reader)).split(b';', 1)[0], 16)
+                if size == 0:
+                    while (await self.readline(reader)) not in (b'\r\n', b'\n'):
+                        pass
+                    break
+                await self.read_exactly(reader, body, size)
+                await self.readline(reader)
+        elif 'content-length' in headers:
+            length = int(headers['content-length'])
+            self.check_size(length)
+            await self.read_exactly(reader, body, length)
+        else:
+            while True:
+                chunk = await asyncio.wait_for(reader.read(CHUNK_SIZE), self.read_timeout)
+                if not chunk:
+                    break
+                body.write(chunk)
+                self.check_size(body.tell())
+        body.seek(0)
+        return body
+
+    async def read_exactly(self, reader, body, length):
+        remaining = length
+        while remaining > 0:
+            chunk = await asyncio.wait_for(reader.read(min(remaining, CHUNK_SIZE)), self.read_timeout)
+            if not chunk:
+                raise asyncio.IncompleteReadError(b'', remaining)
+            body.write(chunk)
+            remaining -= len(chunk)
+            self.check_size(body.tell())
+
+    def check_size(self, size):
+        if self.max_bytes and size > self.max_bytes:
+            raise DownloadTooLarge('response exceeded the {} byte limit'.format(self.max_bytes))
+
+    def connections_opened(self):
+        return sum(pool.connections_opened for pool in self.pools.values())
+
+    async def close(self):
+        for pool in self.pools.values():
+            pool.close()
+        self.pools = {}
+
+def is_chunked(headers):
+    return 'chunked' in headers.get('transfer-encoding', '').lower()
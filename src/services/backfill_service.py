@@ -0,0 +1,227 @@
+import argparse
+import fcntl
+import json
+import os
+import threading
+import time
+
+from db_service import encode_after, decode_after
+
+class BackfillInterrupted(Exception):
+    pass
+
+class BackfillRunning(Exception):
+    pass
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst or rate
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.burst
+        self.updated_at = clock()
+
+    def take(self, count):
+        # Blocks until `count` tokens are available; a batch larger than the
+        # burst is let through once enough time has passed to pay for it.
+        if not self.rate:
+            return
+        while True:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= min(count, self.burst):
+                self.tokens -= count
+                return
+            self.sleep((min(count, self.burst) - self.tokens) / self.rate)
+
+class Checkpoint(object):
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, status):
+        if not self.path or not os.path.exists(self.path):
+            return None
+        with open(self.path) as checkpoint_file:
+            saved = json.load(checkpoint_file)
+        if saved.get('status') != status:
+            return None
+        return saved
+
+    def save(self, status, after, published):
+        if not self.path:
+            return
+        temporary_path = '{}.tmp'.format(self.path)
+        with open(temporary_path, 'w') as checkpoint_file:
+            json.dump({ 'status': status, 'after': after, 'published': published }, checkpoint_file)
+        os.replace(temporary_path, self.path)
+
+    def clear(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+class RunLock(object):
+    # An exclusive flock on a file beside the checkpoint. Every web worker
+    # has its own BackfillService; the lock lets only one of them run a
+    # backfill at a time, and lets the others tell that one is running.
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def acquire(self):
+        if not self.path:
+            return True
+        lock_file = open(self.path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.file = lock_file
+        return True
+
+    def release(self):
+        # Closing the file drops the lock, as does the process exiting.
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def held_elsewhere(self):
+        if not self.path or self.file is not None:
+            return False
+        if not self.acquire():
+            return True
+        self.release()
+        return False
+
+class BackfillService(object):
+    def __init__(self, db_service, messaging_service, batch_size=1000, rate=None, checkpoint_path=None, uuids_per_message=1):
+        self.db_service = db_service
+        self.messaging_service = messaging_service
+        self.batch_size = batch_size
+        self.uuids_per_message = uuids_per_message
+        self.rate = rate
+        self.checkpoint = Checkpoint(checkpoint_path)
+        self.run_lock = RunLock('{}.lock'.format(checkpoint_path) if checkpoint_path else None)
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.state = { 'running': False }
+
+    def run(self, status='pending'):
+        # Streams UUIDs from a server-side cursor and publishes them in
+        # confirmed batches. After every confirmed batch its last row is
+        # written to the checkpoint, so a rerun resumes from there.
+        saved = self.checkpoint.load(status)
+        after = saved['after'] if saved is not None else None
+        published = saved['published'] if saved is not None else 0
+        bucket = TokenBucket(self.rate)
+        self.update(status=status, after=after, published=published, error=None)
+        rows = self.db_service.stream_by_status(status, decode_after(after) if after else None, self.batch_size)
+        try:
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) == self.batch_size:
+                    after, published = self.publish(status, batch, bucket, published)
+                    batch = []
+            if len(batch) > 0:
+                after, published = self.publish(status, batch, bucket, published)
+        finally:
+            rows.close()
+        self.checkpoint.clear()
+        return published
+
+    def run_exclusively(self, status='pending', restart=False):
+        # run() for the command line, under the same lock start() takes, so
+        # it never publishes alongside a backfill a web worker is running.
+        if not self.run_lock.acquire():
+            raise BackfillRunning('A backfill is already running, see {}'.format(self.run_lock.path))
+        try:
+            if restart:
+                self.checkpoint.clear()
+            return self.run(status)
+        finally:
+            self.run_lock.release()
+
+    def publish(self, status, batch, bucket, published):
+        if self.stopping.is_set():
+            raise BackfillInterrupted('Backfill stopped after {} photos'.format(published))
+        bucket.take(len(batch))
+        confirmed = self.messaging_service.push_uuids([row['uuid'] for row in batch], self.uuids_per_message, batch_size=self.batch_size)
+        if not all(confirmed):
+            # Resuming republishes this whole batch; the consumer skips
+            # photos that have already been processed.
+            raise BackfillInterrupted('The message broker did not confirm {} of {} photos'.format(confirmed.count(False), len(batch)))
+        after = encode_after(batch[-1])
+        published += len(batch)
+        self.checkpoint.save(status, after, published)
+        self.update(after=after, published=published)
+        return (after, published)
+
+    def start(self, status='pending'):
+        with self.lock:
+            if self.state['running'] or not self.run_lock.acquire():
+                return False
+            self.state = { 'running': True, 'started_at': time.time() }
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run_in_background, args=(status,), daemon=True)
+        self.thread.start()
+        return True
+
+    def run_in_background(self, status):
+        try:
+            self.run(status)
+        except Exception as ex:
+            print('[backfill_service] Backfill failed: {}'.format(ex))
+            self.update(error=str(ex))
+        finally:
+            self.run_lock.release()
+            self.update(running=False, finished_at=time.time())
+
+    def stop(self):
+        self.stopping.set()
+
+    def update(self, **changes):
+        with self.lock:
+            self.state.update(changes)
+
+    def status(self):
+        with self.lock:
+            state = dict(self.state)
+        if not state['running'] and self.run_lock.held_elsewhere():
+            # Another process is running it; its checkpoint says how far.
+            state = { 'running': True, 'elsewhere': True }
+            saved = self.checkpoint.load('pending')
+            if saved is not None:
+                state.update(after=saved['after'], published=saved['published'])
+        return state
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Enqueue every photo with the given status for processing.')
+    parser.add_argument('--status', default='pending')
+    parser.add_argument('--batch-size', type=int, default=int(os.environ.get('BACKFILL_BATCH_SIZE') or 1000))
+    parser.add_argument('--rate', type=float, default=float(os.environ.get('BACKFILL_RATE') or 0),
+        help='maximum photos published per second (0 for no limit)')
+    parser.add_argument('--checkpoint', default=os.environ.get('BACKFILL_CHECKPOINT') or '/tmp/photo-processor-backfill.json')
+    parser.add_argument('--uuids-per-message', type=int, default=int(os.environ.get('UUIDS_PER_MESSAGE') or 1),
+        help='photos carried by each message (1 keeps the single UUID format)')
+    parser.add_argument('--restart', action='store_true', help='ignore a saved checkpoint and start from the beginning')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    from db_service import DbService
+    from messaging_service import MessagingService
+    args = parse_args()
+    service = BackfillService(DbService(max_connections=2), MessagingService(), args.batch_size, args.rate, args.checkpoint, args.uuids_per_message)
+    try:
+        published = service.run_exclusively(args.status, args.restart)
+        print('[backfill_service] Published {} photos'.format(published))
+    except BackfillRunning as ex:
+        print('[backfill_service] {}; not starting another'.format(ex))
+        raise SystemExit(1)
+    except (BackfillInterrupted, KeyboardInterrupt):
+        state = service.status()
+        print('[backfill_service] Stopped after {} photos; rerun to resume from {}'.format(state.get('published'), state.get('after')))
+        raise SystemExit(1)
@@ -0,0 +1,31 @@
+import threading
+from collections import OrderedDict
+
+class CompletionCache(object):
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def contains(self, id):
+        with self.lock:
+            if id not in self.entries:
+                return False
+            self.entries.move_to_end(id)
+            return True
+
+    def add(self, id):
+        if self.capacity <= 0:
+            return
+        with self.lock:
+            self.entries[id] = True
+            self.entries.move_to_end(id)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def discard(self, id):
+        with self.lock:
+            self.entries.pop(id, None)
+
+    def __len__(self):
+        return len(self.entries)
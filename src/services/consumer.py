@@ -1,56 +1,400 @@
+import asyncio
 import os
+import socket
 import sys
+import time
+from collections import namedtuple
+from uuid import UUID
 from db_service import DbService
-from messaging_service import MessagingService
-from image_service import ImageService
-from fetch_service import FetchService
+from messaging_service import MessagingService, Retry, Reject
+from image_service import ImageService, ProcessPoolImageService, ImageRejected, ImageUndecodable, DEFAULT_REDUCING_GAP, parse_profile
+from admission_controller import AdmissionController
+from fetch_service import FetchService, DownloadTooLarge
+from source_cache import SourceCache
+from worker_pool import WorkerPool
+from staged_pipeline import StagedPipeline
+from completion_cache import CompletionCache
+from lease_keeper import LeaseKeeper
+from metrics import Registry, start_http_server
+
+registry = Registry()
+stage_seconds = registry.histogram('photo_processor_stage_seconds', 'Time spent per processing stage.', ('stage',))
+photos_total = registry.counter('photo_processor_photos_total', 'Photos handled by the consumer, by outcome.', ('outcome',))
+message_seconds = registry.histogram('photo_processor_message_seconds', 'Time from delivery to settling a message.')
+rejected_total = registry.counter('photo_processor_images_rejected_total', 'Originals refused before decoding for their size.')
+
+def observe_stage(stage, seconds):
+    stage_seconds.observe(seconds, stage=stage)
+
+def build_admission_controller():
+    budget = int(os.environ.get('IMAGE_MEMORY_BUDGET') or 1024 * 1024 * 1024)
+    if budget <= 0:
+        return None
+    admission = AdmissionController(budget)
+    registry.callback_gauge('photo_processor_admission_bytes', 'Estimated decode memory of the images being processed.', (),
+        lambda: { (): admission.stats()['in_flight'] })
+    registry.callback_gauge('photo_processor_admission_waiting', 'Images waiting for decode memory.', (),
+        lambda: { (): admission.stats()['waiting'] })
+    return admission
+
+def build_image_service():
+    reducing_gap = float(os.environ.get('IMAGE_REDUCING_GAP') or DEFAULT_REDUCING_GAP) or None
+    # Pillow's own decompression bomb warning threshold.
+    max_pixels = int(os.environ.get('IMAGE_MAX_PIXELS') or 89478485) or None
+    admission = build_admission_controller()
+    profile = parse_profile(os.environ.get('THUMBNAIL_PROFILE') or 'default')
+    if os.environ.get('IMAGE_BACKEND') == 'process':
+        return ProcessPoolImageService(int(os.environ.get('IMAGE_PROCESSES') or 0), reducing_gap, observe_stage, max_pixels, admission, profile)
+    return ImageService(reducing_gap, observe_stage, max_pixels, admission, profile)
+
+SOURCE_CACHE_OUTCOMES = ('hits', 'revalidations', 'misses', 'evictions')
+
+def build_source_cache():
+    directory = os.environ.get('SOURCE_CACHE_DIR')
+    if not directory:
+        return None
+    max_bytes = int(os.environ.get('SOURCE_CACHE_MAX_BYTES') or 1024 * 1024 * 1024)
+    cache = SourceCache(directory, max_bytes, int(os.environ.get('SOURCE_CACHE_FRESH_SECONDS') or 0))
+    registry.callback_counter('photo_processor_source_cache_total', 'Originals looked up in the source cache, and entries evicted, by outcome.', ('outcome',),
+        lambda: dict(((outcome,), count) for outcome, count in cache.stats().items() if outcome in SOURCE_CACHE_OUTCOMES))
+    registry.callback_gauge('photo_processor_source_cache_bytes', 'Size of the originals in the source cache.', (),
+        lambda: { (): cache.stats()['bytes'] })
+    return cache
 
 db_service = DbService()
-image_service = ImageService()
-fetch_service = FetchService()
+image_service = build_image_service()
+fetch_service = FetchService(max_bytes=int(os.environ.get('FETCH_MAX_BYTES') or 0) or None, cache=build_source_cache())
+fetch_mode = os.environ.get('FETCH_MODE') or 'stream'
+completion_cache = CompletionCache(int(os.environ.get('COMPLETION_CACHE_SIZE') or 10000))
+# Claimed photos stay leased while this process works on them; see
+# reaper_service for what happens to the ones whose lease runs out.
+lease_seconds = int(os.environ.get('LEASE_SECONDS') or 300)
+lease_keeper = LeaseKeeper(db_service.renew, lease_seconds)
+
+def parse_sizes(value):
+    sizes = []
+    for size in value.split(','):
+        width, height = size.strip().lower().split('x')
+        sizes.append((int(width), int(height),))
+    return sizes
+
+# The first size keeps the original <uuid>.<extension> name; the others are
+# suffixed.
+thumbnail_sizes = parse_sizes(os.environ.get('THUMBNAIL_SIZES') or '320x320')
+thumbnail_dir = os.environ.get('THUMBNAIL_DIR') or '/waldo-app-thumbs'
+consumer_mode = os.environ.get('CONSUMER_MODE') or 'blocking'
+workers = int(os.environ.get('CONSUMER_WORKERS') or 1)
+prefetch_count = int(os.environ.get('CONSUMER_PREFETCH') or workers)
+pipeline_capacity = int(os.environ.get('PIPELINE_CAPACITY') or 2)
+pipeline_fetchers = int(os.environ.get('PIPELINE_FETCHERS') or 1)
+pipeline_resizers = int(os.environ.get('PIPELINE_RESIZERS') or 1)
+metrics_port = int(os.environ.get('METRICS_PORT') or 9100)
 
-dimensions = (320, 320,)
+def build_thumbnail_paths(id):
+    thumbnail_paths = []
+    for index, (width, height) in enumerate(thumbnail_sizes):
+        suffix = '' if index == 0 else '_{}x{}'.format(width, height)
+        thumbnail_paths.append(os.path.join(thumbnail_dir, '{}{}.{}'.format(id, suffix, image_service.profile.extension)))
+    return thumbnail_paths
 
 def build_names_and_paths(record):
     file_name = record['url'].split('/')[-1]
-    download_path = '/tmp/{}'.format(file_name)
-    thumbnail_path = '/waldo-app-thumbs/{}.jpeg'.format(record['uuid'])
-    return (file_name, download_path, thumbnail_path)
-
-def process_record(record):
-    file_name, download_path, thumbnail_path = build_names_and_paths(record)
-    db_service.set_status(record['uuid'], 'processing')
-    fetch_service.download(record['url'], download_path)
-    image_service.resize(dimensions, download_path, thumbnail_path)
-    db_service.add_thumbnail(record['uuid'], dimensions[0], dimensions[1], thumbnail_path)
-    db_service.set_status(record['uuid'], 'completed')
-
-def callback(_id):
-    id = str(_id)
-    record = None
+    download_path = '/tmp/{}-{}'.format(record['uuid'], file_name)
+    return (file_name, download_path, build_thumbnail_paths(record['uuid']))
+
+def normalize_id(id):
+    # Postgres returns UUIDs lowercased and the web process accepts either
+    # case, so ids are compared, cached and reported in Postgres' form.
+    # Anything that is not a UUID is left for the claim to turn away.
+    try:
+        return str(UUID(str(id)))
+    except ValueError:
+        return str(id)
+
+def parse_message(message):
+    # Accepts "<uuid>", { "uuid": ..., "force": ... } and the batched
+    # { "uuids": [...], "force": ... }; always returns a list of ids.
+    if isinstance(message, dict):
+        force = message.get('force', False) == True
+        if 'uuids' in message:
+            return ([normalize_id(id) for id in message['uuids']], force)
+        return ([normalize_id(message['uuid'])], force)
+    return ([normalize_id(message)], False)
+
+def find_already_processed(ids):
+    # Cheapest checks first: memory, then one indexed SELECT for the whole
+    # batch, then the disk.
+    processed = set(id for id in ids if completion_cache.contains(id))
+    remaining = [id for id in ids if id not in processed]
+    if len(remaining) == 0:
+        return processed
+    with stage_seconds.time(stage='db_lookup'):
+        thumbnails_by_id = db_service.get_thumbnails_for(remaining)
+    for id, thumbnails in thumbnails_by_id.items():
+        # A rendition only counts if it is where this profile would write it,
+        # so switching THUMBNAIL_PROFILE's format re-renders old photos.
+        existing = dict(((width, height), url) for width, height, url in thumbnails)
+        if all(existing.get(dimensions) == path and os.path.exists(path) for dimensions, path in zip(thumbnail_sizes, build_thumbnail_paths(id))):
+            completion_cache.add(id)
+            processed.add(id)
+    return processed
+
+def build_renditions(record):
+    return list(zip(thumbnail_sizes, build_thumbnail_paths(record['uuid'])))
+
+def thumbnail_rows(renditions):
+    return [(width, height, path, image_service.profile.extension) for (width, height), path in renditions]
+
+def remove_download(download_path):
+    if os.path.exists(download_path):
+        os.remove(download_path)
+
+def fetch_record(record):
+    # Returns the original as a BytesIO, or as a path under /tmp in file mode.
+    file_name, download_path, thumbnail_paths = build_names_and_paths(record)
+    with stage_seconds.time(stage='fetch'):
+        if fetch_mode == 'file':
+            try:
+                fetch_service.download(record['url'], download_path)
+            except Exception:
+                remove_download(download_path)
+                raise
+            return download_path
+        return fetch_service.fetch(record['url'])
+
+def resize_record(source):
+    try:
+        return image_service.encode_renditions(thumbnail_sizes, source)
+    finally:
+        if fetch_mode == 'file':
+            remove_download(source)
+
+def write_record(record, thumbnails):
+    renditions = build_renditions(record)
+    image_service.write_renditions(thumbnails, [path for dimensions, path in renditions])
+    return thumbnail_rows(renditions)
 
+# Why a photo failed: error_class is stored on its row and sent along as a
+# retry header; transient failures are retried, the rest dead-lettered.
+Failure = namedtuple('Failure', ['error_class', 'transient', 'error'])
+
+TRANSIENT_HTTP_STATUSES = (408, 429)
+TIMEOUT_ERRORS = (socket.timeout, TimeoutError, asyncio.TimeoutError)
+
+def classify_failure(error, stage):
+    if isinstance(error, ImageRejected):
+        return Failure('rejected', False, error)
+    if isinstance(error, ImageUndecodable):
+        # The same bytes will not decode any better next time.
+        return Failure('decode', False, error)
+    if stage == 'resize':
+        # e.g. MemoryError or a broken process pool.
+        return Failure('resize', True, error)
+    if stage == 'write':
+        return Failure('write', True, error)
+    if isinstance(error, DownloadTooLarge):
+        return Failure('too_large', False, error)
+    # urllib's HTTPError has a code, async_fetch_service's a status.
+    status = getattr(error, 'code', None) or getattr(error, 'status', None)
+    if isinstance(status, int):
+        return Failure('http_{}'.format(status), status in TRANSIENT_HTTP_STATUSES or status >= 500, error)
+    if isinstance(error, TIMEOUT_ERRORS) or isinstance(getattr(error, 'reason', None), TIMEOUT_ERRORS):
+        return Failure('timeout', True, error)
+    return Failure('network', True, error)
+
+def retry_message(ids, force):
+    # The message a retry publishes for just these ids, in parse_message's
+    # format.
+    if len(ids) == 1:
+        return { 'uuid': ids[0], 'force': True } if force else ids[0]
+    message = { 'uuids': list(ids) }
+    if force:
+        message['force'] = True
+    return message
+
+def verdict(failures, force):
+    # True when every photo succeeded; otherwise a Retry for the transient
+    # failures and a Reject for the permanent ones.
+    verdicts = []
+    for transient, outcome in ((True, Retry), (False, Reject)):
+        ids = sorted(id for id, failure in failures.items() if failure.transient == transient)
+        if len(ids) > 0:
+            error_classes = ','.join(sorted(set(failures[id].error_class for id in ids)))
+            verdicts.append(outcome(retry_message(ids, force), error_classes))
+    return verdicts or True
+
+def claim_records(ids, force):
+    # Returns None when the database could not be reached, so the message
+    # is retried as a whole.
     try:
-        record = db_service.get_by_id(id)
-        if record is None:
-            print('[consumer] Record with id \"{}\" does not exist.'.format(id))
+        if force:
+            for id in ids:
+                completion_cache.discard(id)
+        else:
+            processed = find_already_processed(ids)
+            for id in processed:
+                print('[consumer] Skipping \"{}\", already processed.'.format(id))
+            photos_total.inc(len(processed), outcome='skipped')
+            ids = [id for id in ids if id not in processed]
+        with stage_seconds.time(stage='db_claim'):
+            records = db_service.claim(ids, lease_seconds=lease_seconds)
+        claimed = set(str(record['uuid']) for record in records)
+        lease_keeper.hold(claimed)
+        for id in ids:
+            if id not in claimed:
+                photos_total.inc(outcome='unclaimed')
+                print('[consumer] Record with id \"{}\" does not exist or is already being processed.'.format(id))
+        return records
     except Exception as ex:
-        print('[consumer] Could not fetch id \"{}\": {}'.format(id, ex))
-        record = None
+        print('[consumer] Could not fetch ids {}: {}'.format(ids, ex))
+        return None
 
-    if record is not None:
+def finish_records(completed, failures):
+    # Each photo succeeds or fails on its own; the outcomes are then written
+    # back in one statement each. Their leases stop being renewed either way:
+    # a photo whose outcome could not be written is reaped once it expires.
+    # Returns the failures, including photos that could not be completed.
+    try:
         try:
-            process_record(record)
-            print('[consumer] Processed \"{}\"'.format(id))
+            with stage_seconds.time(stage='db_complete'):
+                db_service.complete(completed)
+            for id in completed:
+                completion_cache.add(id)
+                print('[consumer] Processed \"{}\"'.format(id))
+            photos_total.inc(len(completed), outcome='processed')
         except Exception as ex:
-            print('[consumer] Could not process id \"{}\": {}'.format(id, ex))
-            db_service.set_status(id, 'failed')
+            print('[consumer] Could not complete ids {}: {}'.format(list(completed), ex))
+            failures = dict(failures)
+            failures.update((id, Failure('db', True, ex)) for id in completed)
+        if len(failures) > 0:
+            ids = list(failures)
+            with stage_seconds.time(stage='db_fail'):
+                db_service.fail(ids, [failures[id].error_class for id in ids])
+            photos_total.inc(len(failures), outcome='failed')
+        return failures
+    finally:
+        lease_keeper.release(list(completed) + list(failures))
+
+def report_failure(id, failure):
+    if failure.error_class == 'rejected':
+        rejected_total.inc()
+        print('[consumer] Rejected id \"{}\": {}'.format(id, failure.error))
+    else:
+        print('[consumer] Could not process id \"{}\" ({}): {}'.format(id, failure.error_class, failure.error))
+
+# The stages below carry a message's photos as (force, jobs), each job a
+# (record, value, failure) tuple, so a photo that fails in one stage just
+# passes through the rest. jobs is None when the records could not be
+# claimed.
+
+def fetch_job(record):
+    try:
+        return (record, fetch_record(record), None)
+    except Exception as ex:
+        return (record, None, classify_failure(ex, 'fetch'))
+
+def resize_jobs(jobs):
+    resized = []
+    for record, source, failure in jobs:
+        thumbnails = None
+        if failure is None:
+            try:
+                thumbnails = resize_record(source)
+            except Exception as ex:
+                failure = classify_failure(ex, 'resize')
+        resized.append((record, thumbnails, failure))
+    return resized
+
+def fetch_stage(message):
+    ids, force = parse_message(message)
+    records = claim_records(ids, force)
+    if records is None:
+        return (force, None)
+    return (force, [fetch_job(record) for record in records])
+
+def resize_stage(batch):
+    force, jobs = batch
+    if jobs is None:
+        return batch
+    return (force, resize_jobs(jobs))
+
+def write_stage(batch):
+    force, jobs = batch
+    if jobs is None:
+        return Retry(error_class='db')
+    completed = {}
+    failures = {}
+    for record, thumbnails, failure in jobs:
+        id = str(record['uuid'])
+        if failure is None:
+            try:
+                completed[id] = write_record(record, thumbnails)
+                continue
+            except Exception as ex:
+                failure = classify_failure(ex, 'write')
+        report_failure(id, failure)
+        failures[id] = failure
+    return verdict(finish_records(completed, failures), force)
+
+def callback(message):
+    # One photo at a time: only a single original is held in memory.
+    with message_seconds.time():
+        ids, force = parse_message(message)
+        records = claim_records(ids, force)
+        if records is None:
+            return Retry(error_class='db')
+        jobs = []
+        for record in records:
+            jobs.extend(resize_jobs([fetch_job(record)]))
+        return write_stage((force, jobs))
+
+def build_pipeline():
+    pipeline = StagedPipeline([
+        ('fetch', fetch_stage, pipeline_fetchers),
+        ('resize', resize_stage, pipeline_resizers),
+        ('write', write_stage, 1),
+    ], pipeline_capacity)
+    registry.callback_gauge('photo_processor_stage_queue_depth', 'Messages waiting for each pipeline stage.', ('stage',),
+        lambda: dict(((name,), depth) for name, depth in pipeline.depths().items()))
+    registry.callback_gauge('photo_processor_pipeline_in_flight', 'Messages dispatched to the pipeline and not yet settled.', (),
+        lambda: { (): pipeline.in_flight() })
+    return pipeline
+
+def pipeline_prefetch_count():
+    # Enough deliveries to fill every queue and stage thread; beyond that the
+    # broker holds them, so dispatch never blocks the connection's thread.
+    return int(os.environ.get('CONSUMER_PREFETCH') or 0) or 3 * pipeline_capacity + pipeline_fetchers + pipeline_resizers + 1
+
+def timed_dispatch(dispatch):
+    def _dispatch(parsed, done):
+        started = time.perf_counter()
+        def _done(result):
+            message_seconds.observe(time.perf_counter() - started)
+            done(result)
+        dispatch(parsed, _done)
+    return _dispatch
 
-    return True
+def start_metrics_server():
+    if metrics_port:
+        start_http_server(metrics_port, registry)
+        print('[consumer] Serving metrics on port {}'.format(metrics_port))
 
 def app():
     try:
         print('[consumer] Starting app!')
-        MessagingService().consume(callback)
+        start_metrics_server()
+        lease_keeper.start()
+        messaging_service = MessagingService()
+        if consumer_mode == 'pipelined':
+            print('[consumer] Running staged pipeline, prefetch {}'.format(pipeline_prefetch_count()))
+            pipeline = build_pipeline()
+            messaging_service.consume_concurrently(timed_dispatch(pipeline.dispatch), pipeline_prefetch_count())
+        elif workers > 1:
+            print('[consumer] Running {} workers, prefetch {}'.format(workers, prefetch_count))
+            pool = WorkerPool(callback, workers)
+            messaging_service.consume_concurrently(pool.dispatch, prefetch_count)
+        else:
+            messaging_service.consume(callback)
         print('[consumer] Consumer has exited!')
     except Exception as ex:
         print('[consumer] FAILED starting app: {}'.format(ex))
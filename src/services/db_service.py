@@ -1,35 +1,212 @@
 import sys
 import os
+import time
+import base64
+import threading
 import psycopg2
 import uuid
+from contextlib import contextmanager, closing
+from datetime import datetime
 from urllib.parse import urlparse
+from psycopg2 import OperationalError, InterfaceError
+
+COLUMNS = ('uuid', 'url', 'status', 'created_at')
+# A photo as JSON text built by Postgres, with the values Flask's jsonify
+# gives a row dict (created_at as an HTTP date). Listings pass it straight
+# through instead of building a dict, UUID and datetime per row only to
+# encode them again.
+PHOTO_JSON = """json_build_object(
+    'created_at', to_char(created_at AT TIME ZONE 'UTC', 'Dy, DD Mon YYYY HH24:MI:SS "GMT"'),
+    'status', status, 'url', url, 'uuid', uuid)::text"""
+# Anything not already claimed by another worker may be claimed, as may a
+# photo whose claim's lease has run out.
+CLAIMABLE_STATUSES = ('pending', 'completed', 'failed')
+DEFAULT_LEASE_SECONDS = 300
+# Thumbnails are (width, height, url) or (width, height, url, format); rows
+# written before the format column existed are JPEG.
+DEFAULT_THUMBNAIL_FORMAT = 'jpeg'
+# Re-rendering a size (e.g. after changing the encoder profile) replaces the
+# previous rendition's row.
+ON_THUMBNAIL_CONFLICT = """ON CONFLICT(photo_uuid,width,height)
+DO UPDATE SET url = EXCLUDED.url, format = EXCLUDED.format;"""
+
+class PoolTimeout(Exception):
+    pass
+
+def thumbnail_row(id, thumbnail):
+    width, height, url = thumbnail[:3]
+    return (id, width, height, url, thumbnail[3] if len(thumbnail) > 3 else DEFAULT_THUMBNAIL_FORMAT)
+
+def encode_after(row):
+    # Opaque keyset token for the (created_at, uuid) of the last row seen.
+    value = '{}|{}'.format(row['created_at'].isoformat(), row['uuid'])
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii')
+
+def decode_after(token):
+    # Every malformed token surfaces as a ValueError.
+    created_at, id = base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8').split('|')
+    return (datetime.fromisoformat(created_at), str(uuid.UUID(id)))
+
+def select_by_status(columns, status, after=None, limit=None):
+    # Keyset pagination served by photos__status__created_at__uuid_idx;
+    # unlike OFFSET, later pages cost the same as the first.
+    query = 'SELECT {} FROM photos WHERE status = %s'.format(columns)
+    args = [status]
+    if after is not None:
+        query += ' AND (created_at, uuid) > (%s, %s::uuid)'
+        args.extend(after)
+    query += ' ORDER BY created_at, uuid'
+    if limit is not None:
+        query += ' LIMIT %s'
+        args.append(limit)
+    return (query, tuple(args))
+
+class ConnectionPool(object):
+    def __init__(self, connect, min_size=1, max_size=10, health_check_after=30.0, checkout_timeout=30.0):
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size, 1)
+        self.health_check_after = health_check_after
+        self.checkout_timeout = checkout_timeout
+        self.condition = threading.Condition()
+        self.idle = []
+        self.size = 0
+        for _ in range(min_size):
+            self.idle.append((self.create(), time.monotonic()))
+            self.size += 1
+
+    def create(self):
+        connection = self.connect()
+        connection.autocommit = True
+        return connection
+
+    def checkout(self):
+        deadline = time.monotonic() + self.checkout_timeout
+        while True:
+            with self.condition:
+                while len(self.idle) == 0 and self.size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self.condition.wait(remaining):
+                        raise PoolTimeout('No database connection available after {}s'.format(self.checkout_timeout))
+                if len(self.idle) > 0:
+                    connection, released_at = self.idle.pop()
+                else:
+                    connection, released_at = None, None
+                    self.size += 1
+            if connection is None:
+                try:
+                    return self.create()
+                except Exception:
+                    self.discard(None)
+                    raise
+            if self.is_healthy(connection, released_at):
+                return connection
+            self.discard(connection)
+
+    def is_healthy(self, connection, released_at):
+        if connection.closed:
+            return False
+        if time.monotonic() - released_at < self.health_check_after:
+            return True
+        try:
+            cursor = connection.cursor()
+            cursor.execute('SELECT 1', ())
+            cursor.close()
+            return True
+        except (OperationalError, InterfaceError):
+            return False
+
+    def checkin(self, connection):
+        if connection.closed:
+            self.discard(connection)
+            return
+        with self.condition:
+            self.idle.append((connection, time.monotonic()))
+            self.condition.notify()
+
+    def discard(self, connection):
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                pass
+        with self.condition:
+            self.size -= 1
+            self.condition.notify()
+
+    @contextmanager
+    def connection(self):
+        connection = self.checkout()
+        try:
+            yield connection
+        except (OperationalError, InterfaceError):
+            self.discard(connection)
+            raise
+        except BaseException:
+            self.checkin(connection)
+            raise
+        self.checkin(connection)
+
+    def flush_idle(self):
+        # Closes every idle connection, so the next checkout opens a new
+        # one. A Postgres restart drops them all at once, and those idle for
+        # less than health_check_after would be handed out unprobed.
+        with self.condition:
+            idle, self.idle = self.idle, []
+        for connection, released_at in idle:
+            self.discard(connection)
+
+    def close(self):
+        self.flush_idle()
 
 class DbService:
-    def __init__(self):
+    def __init__(self, min_connections=None, max_connections=None):
         parameters = urlparse(os.environ['PG_CONNECTION_URI'])
-        self.db = psycopg2.connect(
-            database = parameters.path[1:],
-            user = parameters.username,
-            password = parameters.password,
-            host = parameters.hostname)
-        self.db.autocommit = True
+        def connect():
+            return psycopg2.connect(
+                database = parameters.path[1:],
+                user = parameters.username,
+                password = parameters.password,
+                host = parameters.hostname)
+        self.pool = ConnectionPool(
+            connect,
+            min_connections or int(os.environ.get('PG_POOL_MIN') or 1),
+            max_connections or int(os.environ.get('PG_POOL_MAX') or 10))
+
+    def with_connection(self, work):
+        # A dropped connection (e.g. a Postgres restart) is discarded by the
+        # pool along with every idle one, and the work replayed once on a
+        # freshly opened connection.
+        try:
+            with self.pool.connection() as connection:
+                return work(connection)
+        except (OperationalError, InterfaceError) as ex:
+            print('[db_service] Reconnecting after: {}'.format(ex))
+            self.pool.flush_idle()
+        with self.pool.connection() as connection:
+            return work(connection)
 
     def execute_sql(self, query, *args):
-        cursor = self.db.cursor()
-        cursor.execute(query, tuple(args))
-        cursor.close()
+        def _execute(connection):
+            cursor = connection.cursor()
+            cursor.execute(query, tuple(args))
+            cursor.close()
+        self.with_connection(_execute)
         return
 
     def execute_sql_with_response(self, query, *args):
-        cursor = self.db.cursor()
-        cursor.execute(query, tuple(args))
-        return cursor.fetchall()
+        def _execute(connection):
+            cursor = connection.cursor()
+            cursor.execute(query, tuple(args))
+            rows = cursor.fetchall()
+            cursor.close()
+            return rows
+        return self.with_connection(_execute)
 
     def fetch_by(self, col, val):
-        columns = ('uuid', 'url', 'status', 'created_at')
         query = 'SELECT uuid, url, status, created_at FROM photos WHERE {} = %s'.format(col)
         rows = self.execute_sql_with_response(query, val)
-        return [dict(zip(columns, row)) for row in rows]
+        return [dict(zip(COLUMNS, row)) for row in rows]
 
     def get_by_id(self, id):
         rows = self.fetch_by('uuid', id)
@@ -40,19 +217,188 @@ class DbService:
     def get_by_status(self, status):
         return self.fetch_by('status', status)
 
-    def add_thumbnail(self, id, width, height, path):
-        statement = """
-INSERT INTO photo_thumbnails (photo_uuid, width, height, url)
-VALUES (%s, %s, %s, %s)
-ON CONFLICT(photo_uuid,width,height)
-DO NOTHING;
+    def get_version(self):
+        # A token that changes whenever the rows of `photos` could have: a
+        # trigger bumps the sequence on every statement inserting, deleting
+        # or changing the status or url of photos (see db-schema.sql).
+        # Reading it touches no table. is_called is part of the token: a new
+        # sequence reads last_value 1 both before and after its first bump.
+        rows = self.execute_sql_with_response('SELECT last_value, is_called FROM photos_version_seq;')
+        return tuple(rows[0])
+
+    def get_page_by_status(self, status, limit, after=None):
+        query, args = select_by_status('uuid, url, status, created_at', status, after, limit)
+        rows = self.execute_sql_with_response(query, *args)
+        return [dict(zip(COLUMNS, row)) for row in rows]
+
+    def get_page_json_by_status(self, status, limit, after=None):
+        # The page as PHOTO_JSON texts, and the token for the next page (None
+        # on the last one).
+        query, args = select_by_status(PHOTO_JSON + ', created_at, uuid', status, after, limit)
+        rows = self.execute_sql_with_response(query, *args)
+        next_after = None
+        if len(rows) == limit:
+            next_after = encode_after({ 'created_at': rows[-1][1], 'uuid': rows[-1][2] })
+        return ([row[0] for row in rows], next_after)
+
+    def stream_by_status(self, status, after=None, chunk_size=1000):
+        with closing(self.stream_rows('uuid, url, status, created_at', status, after, chunk_size)) as rows:
+            for row in rows:
+                yield dict(zip(COLUMNS, row))
+
+    def stream_json_by_status(self, status, after=None, chunk_size=1000):
+        # stream_by_status, each row as PHOTO_JSON text.
+        with closing(self.stream_rows(PHOTO_JSON, status, after, chunk_size)) as rows:
+            for row in rows:
+                yield row[0]
+
+    def stream_rows(self, columns, status, after=None, chunk_size=1000):
+        # Yields rows from a server-side cursor, chunk_size at a time, so the
+        # result set is never held in memory. The pooled connection stays
+        # checked out until the generator is exhausted or closed.
+        with self.pool.connection() as connection:
+            connection.autocommit = False
+            try:
+                cursor = connection.cursor(name='photos_by_status_{}'.format(uuid.uuid4().hex))
+                query, args = select_by_status(columns, status, after)
+                cursor.execute(query, args)
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if len(rows) == 0:
+                        break
+                    for row in rows:
+                        yield row
+                cursor.close()
+            finally:
+                # Named cursors live in a transaction; end it before the
+                # connection goes back to the pool.
+                if not connection.closed:
+                    connection.rollback()
+                    connection.autocommit = True
+
+    def get_thumbnails(self, id):
+        query = 'SELECT width, height, url FROM photo_thumbnails WHERE photo_uuid = %s'
+        return [tuple(row) for row in self.execute_sql_with_response(query, id)]
+
+    def get_thumbnails_for(self, ids):
+        thumbnails = dict((id, []) for id in ids)
+        if len(ids) == 0:
+            return thumbnails
+        query = 'SELECT photo_uuid, width, height, url FROM photo_thumbnails WHERE photo_uuid = ANY(%s::uuid[])'
+        for photo_uuid, width, height, url in self.execute_sql_with_response(query, list(ids)):
+            thumbnails.setdefault(str(photo_uuid), []).append((width, height, url))
+        return thumbnails
+
+    def claim(self, ids, statuses=CLAIMABLE_STATUSES, lease_seconds=DEFAULT_LEASE_SECONDS):
+        if len(ids) == 0:
+            return []
+        query = """
+UPDATE photos SET status = 'processing', lease_expires_at = now() + %s * interval '1 second'
+WHERE uuid = ANY(%s::uuid[]) AND (status IN %s OR (status = 'processing' AND lease_expires_at < now()))
+RETURNING uuid, url, status, created_at;
 """
+        rows = self.execute_sql_with_response(query, lease_seconds, list(ids), tuple(statuses))
+        return [dict(zip(COLUMNS, row)) for row in rows]
+
+    def renew(self, ids, lease_seconds=DEFAULT_LEASE_SECONDS):
+        # The heartbeat: extends the leases of photos still being processed.
+        if len(ids) == 0:
+            return
+        self.execute_sql("""
+UPDATE photos SET lease_expires_at = now() + %s * interval '1 second'
+WHERE uuid = ANY(%s::uuid[]) AND status = 'processing';""", lease_seconds, list(ids))
+
+    def reap_expired(self, limit, publish):
+        # Finds photos whose lease ran out, i.e. whose consumer died, passes
+        # them to publish, and puts back to pending those it returns True
+        # for. The rows stay locked until then, so several reapers skip each
+        # other's (SKIP LOCKED); the rest, or all of them if publish raises,
+        # keep their expired lease for the next pass. Returns the rows and
+        # what publish returned.
+        with self.pool.connection() as connection:
+            connection.autocommit = False
+            try:
+                cursor = connection.cursor()
+                cursor.execute("""
+SELECT uuid, url, status, created_at FROM photos
+WHERE status = 'processing' AND lease_expires_at < now()
+ORDER BY lease_expires_at
+LIMIT %s
+FOR UPDATE SKIP LOCKED;""", (limit,))
+                rows = [dict(zip(COLUMNS, row)) for row in cursor.fetchall()]
+                confirmed = publish(rows) if len(rows) > 0 else []
+                ids = [str(row['uuid']) for row, ok in zip(rows, confirmed) if ok]
+                if len(ids) > 0:
+                    cursor.execute("""
+UPDATE photos SET status = 'pending', lease_expires_at = NULL
+WHERE uuid = ANY(%s::uuid[]);""", (ids,))
+                cursor.close()
+                connection.commit()
+                return rows, confirmed
+            finally:
+                if not connection.closed:
+                    connection.rollback()
+                    connection.autocommit = True
+
+    def complete(self, thumbnails_by_id):
+        if len(thumbnails_by_id) == 0:
+            return
+        rows = []
+        for id, thumbnails in thumbnails_by_id.items():
+            rows.extend(thumbnail_row(id, thumbnail) for thumbnail in thumbnails)
+        statements = []
+        args = []
+        if len(rows) > 0:
+            statements.append("""
+INSERT INTO photo_thumbnails (photo_uuid, width, height, url, format)
+VALUES {}
+{}""".format(', '.join(['(%s, %s, %s, %s, %s)'] * len(rows)), ON_THUMBNAIL_CONFLICT))
+            for row in rows:
+                args.extend(row)
+        statements.append("""
+UPDATE photos SET status = 'completed', lease_expires_at = NULL, error_class = NULL WHERE uuid = ANY(%s::uuid[]);""")
+        args.append(list(thumbnails_by_id.keys()))
+        # Postgres runs a multi-statement query string as one implicit
+        # transaction, so the whole batch lands in a single round-trip.
+        self.execute_sql('\n'.join(statements), *args)
+
+    def fail(self, ids, error_classes=None):
+        # error_classes, aligned with ids, records why each photo failed.
+        if len(ids) == 0:
+            return
+        statement = """
+UPDATE photos SET status = 'failed', lease_expires_at = NULL, error_class = failures.error_class
+FROM (SELECT unnest(%s::uuid[]) AS uuid, unnest(%s::text[]) AS error_class) AS failures
+WHERE photos.uuid = failures.uuid;"""
+        self.execute_sql(statement, list(ids), list(error_classes) if error_classes is not None else [None] * len(ids))
+
+    def add_thumbnail(self, id, width, height, path, format=DEFAULT_THUMBNAIL_FORMAT):
+        statement = """
+INSERT INTO photo_thumbnails (photo_uuid, width, height, url, format)
+VALUES (%s, %s, %s, %s, %s)
+{}
+""".format(ON_THUMBNAIL_CONFLICT)
         self.execute_sql(
             statement,
             id,
             width,
             height,
-            path)
+            path,
+            format)
+
+    def add_thumbnails(self, id, thumbnails):
+        if len(thumbnails) == 0:
+            return
+        values = ', '.join(['(%s, %s, %s, %s, %s)'] * len(thumbnails))
+        statement = """
+INSERT INTO photo_thumbnails (photo_uuid, width, height, url, format)
+VALUES {}
+{}
+""".format(values, ON_THUMBNAIL_CONFLICT)
+        args = []
+        for thumbnail in thumbnails:
+            args.extend(thumbnail_row(id, thumbnail))
+        self.execute_sql(statement, *args)
 
     def set_status(self, id, new_status):
         self.execute_sql('UPDATE photos SET status = %s WHERE uuid = %s;',
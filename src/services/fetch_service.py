@@ -1,8 +1,63 @@
+import io
+import urllib.error
 import urllib.request
 
+CHUNK_SIZE = 64 * 1024
+
+class DownloadTooLarge(Exception):
+    pass
+
 class FetchService(object):
-    def __init__(self):
-        pass
+    def __init__(self, max_bytes=None, timeout=None, cache=None):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.cache = cache
 
     def download(self, url, dst):
-        urllib.request.urlretrieve(url, dst)
+        if self.cache is None:
+            urllib.request.urlretrieve(url, dst)
+            return
+        with open(dst, 'wb') as destination:
+            destination.write(self.fetch(url).getbuffer())
+
+    def fetch(self, url):
+        headers = {}
+        if self.cache is not None:
+            cached = self.cache.fresh(url)
+            if cached is not None:
+                return cached
+            headers = self.cache.validators(url)
+        try:
+            response = urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=self.timeout)
+        except urllib.error.HTTPError as ex:
+            if ex.code == 304 and self.cache is not None:
+                cached = self.cache.not_modified(url)
+                if cached is not None:
+                    return cached
+                return self.fetch_uncached(url)
+            raise ex
+        buffer = self.read_response(url, response)
+        if self.cache is not None:
+            self.cache.store(url, buffer.getvalue(), response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return buffer
+
+    def fetch_uncached(self, url):
+        return self.read_response(url, urllib.request.urlopen(url, timeout=self.timeout))
+
+    def read_response(self, url, response):
+        with response:
+            length = response.headers.get('Content-Length')
+            if self.max_bytes and length is not None and int(length) > self.max_bytes:
+                raise DownloadTooLarge('{} is {} bytes, over the {} byte limit'.format(url, length, self.max_bytes))
+            buffer = io.BytesIO()
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                buffer.write(chunk)
+                # Content-Length can be missing or wrong; enforce the cap on
+                # what actually arrives too.
+                if self.max_bytes and buffer.tell() > self.max_bytes:
+                    raise DownloadTooLarge('{} exceeded the {} byte limit'.format(url, self.max_bytes))
+        buffer.seek(0)
+        return buffer
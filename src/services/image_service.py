@@ -1,10 +1,344 @@
-from PIL import Image
+import io
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from PIL import Image, features
+
+DEFAULT_REDUCING_GAP = 2.0
+# Pillow keeps 1, L and P images at a byte per pixel and pads everything else
+# (RGB included) to four.
+BYTES_PER_PIXEL = { '1': 1, 'L': 1, 'P': 1, 'I;16': 2 }
+
+# Pillow format name to file extension, which is also what photo_thumbnails
+# records as the format.
+EXTENSIONS = { 'JPEG': 'jpeg', 'WEBP': 'webp' }
+SUBSAMPLING = ('4:4:4', '4:2:2', '4:2:0')
+
+class ImageRejected(Exception):
+    pass
+
+class ImageUndecodable(Exception):
+    # The source is not an image Pillow can decode, e.g. truncated or not an
+    # image at all.
+    pass
+
+class EncoderProfile(object):
+    # How renditions are encoded. optimize, progressive and subsampling only
+    # apply to JPEG and method only to WebP. ICC profiles and EXIF are dropped
+    # unless keep_icc / keep_exif are set; the defaults are exactly the
+    # original img.save(path, 'JPEG').
+    def __init__(self, format='JPEG', quality=None, optimize=False, progressive=False, subsampling=None, method=None, keep_icc=False, keep_exif=False):
+        format = format.upper()
+        if format not in EXTENSIONS:
+            raise ValueError('Unsupported thumbnail format {}, expected one of {}'.format(format, sorted(EXTENSIONS)))
+        if format == 'WEBP' and not features.check_module('webp'):
+            raise ValueError('Pillow was built without WebP support')
+        if quality is not None and not 1 <= quality <= 100:
+            raise ValueError('quality must be between 1 and 100, got {}'.format(quality))
+        if subsampling is not None and subsampling not in SUBSAMPLING:
+            raise ValueError('subsampling must be one of {}, got {}'.format(SUBSAMPLING, subsampling))
+        if method is not None and not 0 <= method <= 6:
+            raise ValueError('method must be between 0 and 6, got {}'.format(method))
+        self.format = format
+        self.quality = quality
+        self.optimize = optimize
+        self.progressive = progressive
+        self.subsampling = subsampling
+        self.method = method
+        self.keep_icc = keep_icc
+        self.keep_exif = keep_exif
+
+    @property
+    def extension(self):
+        return EXTENSIONS[self.format]
+
+    def replace(self, **changes):
+        return EncoderProfile(**dict(vars(self), **changes))
+
+    def options(self, img):
+        options = {}
+        if self.quality is not None:
+            options['quality'] = self.quality
+        if self.format == 'JPEG':
+            if self.optimize:
+                options['optimize'] = True
+            if self.progressive:
+                options['progressive'] = True
+            if self.subsampling is not None:
+                options['subsampling'] = self.subsampling
+        elif self.method is not None:
+            options['method'] = self.method
+        if self.keep_icc and img.info.get('icc_profile'):
+            options['icc_profile'] = img.info['icc_profile']
+        if self.keep_exif and img.info.get('exif'):
+            options['exif'] = img.info['exif']
+        return options
+
+    def save(self, img, output):
+        img.save(output, self.format, **self.options(img))
+
+    def __repr__(self):
+        return 'EncoderProfile({})'.format(', '.join('{}={!r}'.format(name, value) for name, value in sorted(vars(self).items())))
+
+DEFAULT_PROFILE = EncoderProfile()
+PROFILES = {
+    'default': DEFAULT_PROFILE,
+    'small': EncoderProfile(quality=75, optimize=True, progressive=True, subsampling='4:2:0'),
+    'high': EncoderProfile(quality=90, optimize=True, subsampling='4:4:4'),
+    'webp': EncoderProfile('WEBP', quality=75, method=4),
+}
+
+def parse_profile(value):
+    # "<profile or format>[:option,...]", e.g. "small", "webp:quality=70" or
+    # "jpeg:quality=85,progressive,subsampling=4:4:4". Bare options are flags.
+    name, _, options = value.strip().partition(':')
+    name = name.strip().lower()
+    changes = {}
+    for option in options.split(','):
+        if option.strip() == '':
+            continue
+        key, _, setting = option.strip().partition('=')
+        if key in ('quality', 'method'):
+            changes[key] = int(setting)
+        elif key == 'subsampling':
+            changes[key] = setting
+        elif key in ('optimize', 'progressive', 'keep_icc', 'keep_exif'):
+            changes[key] = setting.lower() not in ('0', 'false', 'no')
+        else:
+            raise ValueError('Unknown encoder option {}'.format(key))
+    if name in PROFILES:
+        return PROFILES[name].replace(**changes)
+    return EncoderProfile(name, **changes)
+
+def apply_draft(img, dimensions, reducing_gap):
+    if reducing_gap and img.format == 'JPEG':
+        # Let libjpeg downscale in the DCT domain while decoding, but never
+        # below reducing_gap times the target so LANCZOS still has detail.
+        img.draft(img.mode, (int(dimensions[0] * reducing_gap), int(dimensions[1] * reducing_gap)))
+    return img
+
+@contextmanager
+def decoding():
+    # Pillow reports bytes it cannot decode as an OSError without an errno
+    # (UnidentifiedImageError, "image file is truncated", ...) or, from some
+    # plugins, a SyntaxError. OSErrors from the system, e.g. a missing file,
+    # have an errno and pass through, as does anything else.
+    try:
+        yield
+    except SyntaxError as ex:
+        raise ImageUndecodable(str(ex)) from ex
+    except OSError as ex:
+        if ex.errno is not None:
+            raise
+        raise ImageUndecodable(str(ex)) from ex
+
+def open_for_thumbnail(source, dimensions, reducing_gap=DEFAULT_REDUCING_GAP):
+    return apply_draft(Image.open(source), dimensions, reducing_gap)
+
+def bounding_box(sizes):
+    return (max(size[0] for size in sizes), max(size[1] for size in sizes))
+
+def render_thumbnails(img, sizes):
+    # Renditions are produced largest scale first, each one downscaled from
+    # the previous rendition rather than from the full-size decode.
+    width, height = img.size
+    scale = lambda size: min(1.0, size[0] / width, size[1] / height)
+    renditions = {}
+    current = None
+    for dimensions in sorted(set(sizes), key=scale, reverse=True):
+        current = img if current is None else current.copy()
+        current.thumbnail(dimensions, Image.LANCZOS)
+        renditions[dimensions] = current
+    return [renditions[dimensions] for dimensions in sizes]
+
+def measure(img, sizes, reducing_gap):
+    pixels = img.size[0] * img.size[1]
+    width, height = apply_draft(img, bounding_box(sizes), reducing_gap).size
+    decoded = width * height * BYTES_PER_PIXEL.get(img.mode, 4)
+    scale = lambda size: min(1.0, size[0] / width, size[1] / height)
+    renditions = sum(int(width * scale(size)) * int(height * scale(size)) * 4 for size in sizes)
+    return (pixels, decoded + renditions)
+
+def inspect(source, sizes, reducing_gap=DEFAULT_REDUCING_GAP):
+    # Reads only the header. Returns the pixel count of the original and an
+    # estimate of the bytes encode_all holds at its peak: the decode, after
+    # any JPEG draft scaling, plus the renditions.
+    try:
+        if hasattr(source, 'read'):
+            position = source.tell()
+            try:
+                with decoding():
+                    return measure(Image.open(source), sizes, reducing_gap)
+            finally:
+                source.seek(position)
+        with open(source, 'rb') as input_file:
+            with decoding():
+                return measure(Image.open(input_file), sizes, reducing_gap)
+    except Image.DecompressionBombError as ex:
+        raise ImageRejected(str(ex))
+
+def resize_bytes(dimensions, data, profile=DEFAULT_PROFILE, reducing_gap=DEFAULT_REDUCING_GAP):
+    with decoding():
+        img = open_for_thumbnail(io.BytesIO(data), dimensions, reducing_gap)
+        img.thumbnail(dimensions, Image.LANCZOS)
+    output = io.BytesIO()
+    profile.save(img, output)
+    return output.getvalue()
+
+def encode_all(source, sizes, profile=DEFAULT_PROFILE, reducing_gap=DEFAULT_REDUCING_GAP, durations=None):
+    # Accumulates the seconds spent per stage into durations; the work is the
+    # same with or without it.
+    durations = {} if durations is None else durations
+    started = time.perf_counter()
+    with decoding():
+        img = open_for_thumbnail(source, bounding_box(sizes), reducing_gap)
+        img.load()
+    decoded = time.perf_counter()
+    renditions = render_thumbnails(img, sizes)
+    resized = time.perf_counter()
+    encoded = []
+    for rendition in renditions:
+        output = io.BytesIO()
+        profile.save(rendition, output)
+        encoded.append(output.getvalue())
+    finished = time.perf_counter()
+    for stage, seconds in (('decode', decoded - started), ('resize', resized - decoded), ('encode', finished - resized)):
+        durations[stage] = durations.get(stage, 0.0) + seconds
+    return encoded
+
+def resize_all_bytes(sizes, data, profile=DEFAULT_PROFILE, reducing_gap=DEFAULT_REDUCING_GAP):
+    return encode_all(io.BytesIO(data), sizes, profile, reducing_gap)
+
+def resize_all_bytes_timed(sizes, data, profile=DEFAULT_PROFILE, reducing_gap=DEFAULT_REDUCING_GAP):
+    durations = {}
+    return (encode_all(io.BytesIO(data), sizes, profile, reducing_gap, durations), durations)
+
+def write_atomically(output_path, data):
+    # Written to a hidden file beside the destination and renamed over it, so
+    # a consumer killed mid-write leaves the previous thumbnail (or none), not
+    # a truncated one. The name is unique per thread; a killed write leaves
+    # only a `.<name>.<pid>.<thread>.tmp` file behind.
+    directory, name = os.path.split(output_path)
+    temporary_path = os.path.join(directory, '.{}.{}.{}.tmp'.format(name, os.getpid(), threading.get_ident()))
+    try:
+        with open(temporary_path, 'wb') as destination:
+            destination.write(data)
+        os.replace(temporary_path, output_path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+def write_all(thumbnails, output_paths, durations):
+    started = time.perf_counter()
+    for thumbnail, output_path in zip(thumbnails, output_paths):
+        write_atomically(output_path, thumbnail)
+    durations['write'] = durations.get('write', 0.0) + time.perf_counter() - started
 
 class ImageService(object):
-    def __init__(self):
-        pass
+    def __init__(self, reducing_gap=DEFAULT_REDUCING_GAP, observe=None, max_pixels=None, admission=None, profile=DEFAULT_PROFILE):
+        if reducing_gap and reducing_gap < 1.0:
+            raise ValueError('reducing_gap must be at least 1.0, got {}'.format(reducing_gap))
+        self.reducing_gap = reducing_gap
+        # Optional observe(stage, seconds) hook for the admit, decode, resize,
+        # encode and write stages of resize_all.
+        self.observe = observe
+        # With either set, encode_renditions reads the header first: sources
+        # over max_pixels, or estimated to need more than the admission
+        # controller's whole budget, raise ImageRejected before decoding.
+        self.max_pixels = max_pixels
+        self.admission = admission
+        self.profile = profile
+
+    @contextmanager
+    def admit(self, sizes, source):
+        if self.max_pixels is None and self.admission is None:
+            yield
+            return
+        pixels, cost = inspect(source, sizes, self.reducing_gap)
+        if self.max_pixels and pixels > self.max_pixels:
+            raise ImageRejected('{} pixels, over the limit of {}'.format(pixels, self.max_pixels))
+        if self.admission is None:
+            yield
+            return
+        if cost > self.admission.budget:
+            raise ImageRejected('decoding needs about {} bytes, over the budget of {}'.format(cost, self.admission.budget))
+        started = time.perf_counter()
+        with self.admission.admit(cost):
+            self.report({ 'admit': time.perf_counter() - started })
+            yield
+
+    def report(self, durations):
+        if self.observe is not None:
+            for stage, seconds in durations.items():
+                self.observe(stage, seconds)
+
+    def resize(self, dimensions, source, output_path):
+        with decoding():
+            img = open_for_thumbnail(source, dimensions, self.reducing_gap)
+            img.thumbnail(dimensions, Image.LANCZOS)
+        output = io.BytesIO()
+        self.profile.save(img, output)
+        write_atomically(output_path, output.getvalue())
+
+    def resize_all(self, renditions, source):
+        thumbnails = self.encode_renditions([dimensions for dimensions, output_path in renditions], source)
+        self.write_renditions(thumbnails, [output_path for dimensions, output_path in renditions])
+
+    def encode_renditions(self, sizes, source):
+        durations = {}
+        with self.admit(sizes, source):
+            thumbnails = encode_all(source, sizes, self.profile, self.reducing_gap, durations)
+        self.report(durations)
+        return thumbnails
+
+    def write_renditions(self, thumbnails, output_paths):
+        durations = {}
+        write_all(thumbnails, output_paths, durations)
+        self.report(durations)
+
+    def resize_bytes(self, dimensions, data):
+        return resize_bytes(dimensions, data, self.profile, self.reducing_gap)
+
+    def resize_all_bytes(self, sizes, data):
+        return resize_all_bytes(sizes, data, self.profile, self.reducing_gap)
+
+class ProcessPoolImageService(ImageService):
+    def __init__(self, processes=None, reducing_gap=DEFAULT_REDUCING_GAP, observe=None, max_pixels=None, admission=None, profile=DEFAULT_PROFILE):
+        super().__init__(reducing_gap, observe, max_pixels, admission, profile)
+        self.processes = processes or os.cpu_count()
+        self.executor = ProcessPoolExecutor(max_workers=self.processes)
+
+    def read_source(self, source):
+        if hasattr(source, 'read'):
+            return source.read()
+        with open(source, 'rb') as input_file:
+            return input_file.read()
+
+    def resize(self, dimensions, source, output_path):
+        write_atomically(output_path, self.resize_bytes(dimensions, self.read_source(source)))
+
+    def encode_renditions(self, sizes, source):
+        # Stage timings are measured in the worker and travel back with the
+        # thumbnails.
+        data = self.read_source(source)
+        with self.admit(sizes, io.BytesIO(data)):
+            future = self.executor.submit(resize_all_bytes_timed, sizes, data, self.profile, self.reducing_gap)
+            thumbnails, durations = future.result()
+        self.report(durations)
+        return thumbnails
+
+    def resize_bytes(self, dimensions, data):
+        # Only the encoded source and thumbnail cross the process boundary;
+        # decoded pixels never leave the worker.
+        future = self.executor.submit(resize_bytes, dimensions, data, self.profile, self.reducing_gap)
+        return future.result()
+
+    def resize_all_bytes(self, sizes, data):
+        future = self.executor.submit(resize_all_bytes, sizes, data, self.profile, self.reducing_gap)
+        return future.result()
 
-    def resize(self, dimensions, input_path, output_path):
-        img = Image.open(input_path)
-        img.thumbnail(dimensions, Image.ANTIALIAS)
-        img.save(output_path, 'JPEG')
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
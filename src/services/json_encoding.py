@@ -0,0 +1,44 @@
+import json
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from uuid import UUID
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ENCODERS = ('auto', 'orjson', 'stdlib')
+
+def http_date(value):
+    # How Flask's jsonify writes datetimes, e.g. "Mon, 22 Apr 2019 10:32:52 GMT".
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return format_datetime(value.astimezone(timezone.utc), usegmt=True)
+
+def default(value):
+    if isinstance(value, datetime):
+        return http_date(value)
+    if isinstance(value, UUID):
+        return str(value)
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(value).__name__))
+
+def stdlib_dumps(value):
+    return json.dumps(value, default=default, separators=(',', ':')).encode('utf-8')
+
+def orjson_dumps(value):
+    # orjson would write datetimes as RFC 3339; passing them through to
+    # default() keeps the output the same as stdlib_dumps'.
+    return orjson.dumps(value, default=default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+def select_dumps(name=None):
+    # Returns a function encoding a value to UTF-8 JSON bytes. 'auto' (the
+    # default) uses orjson when it is installed.
+    name = name or 'auto'
+    if name not in ENCODERS:
+        raise ValueError('Unknown JSON encoder {!r}, expected one of {}'.format(name, ', '.join(ENCODERS)))
+    if name == 'auto':
+        name = 'stdlib' if orjson is None else 'orjson'
+    if name == 'orjson' and orjson is None:
+        raise ValueError('The orjson JSON encoder was asked for but is not installed')
+    return orjson_dumps if name == 'orjson' else stdlib_dumps
@@ -0,0 +1,53 @@
+import threading
+
+class LeaseKeeper(object):
+    # Tracks the photos this process has claimed and, every interval,
+    # extends all of their leases with a single renew(ids, lease_seconds)
+    # call. A consumer that dies stops renewing, so its photos expire one
+    # lease later and only those are reaped.
+    def __init__(self, renew, lease_seconds, interval=None):
+        self.renew = renew
+        self.lease_seconds = lease_seconds
+        self.interval = interval or lease_seconds / 3.0
+        self.lock = threading.Lock()
+        self.held = set()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def hold(self, ids):
+        with self.lock:
+            self.held.update(ids)
+
+    def release(self, ids):
+        with self.lock:
+            self.held.difference_update(ids)
+
+    def renew_once(self):
+        with self.lock:
+            ids = sorted(self.held)
+        if len(ids) == 0:
+            return 0
+        try:
+            self.renew(ids, self.lease_seconds)
+        except Exception as ex:
+            # Missing one beat is fine; the lease outlasts several of them.
+            print('[lease_keeper] Could not renew {} leases: {}'.format(len(ids), ex))
+            return 0
+        return len(ids)
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.renew_once()
+
+    def start(self):
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name='lease-keeper', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __len__(self):
+        return len(self.held)
@@ -4,6 +4,75 @@ import time
 import pika, pika.exceptions
 import json
 import threading
+import functools
+
+QUEUE_NAME = 'photo-processor'
+DEAD_LETTER_QUEUE_NAME = QUEUE_NAME + '.dead'
+# Seconds before each retry; a delivery that has failed once more than there
+# are delays goes to the dead-letter queue.
+DEFAULT_RETRY_DELAYS = (15, 60, 240, 960)
+
+class Retry(object):
+    # A consumer callback's verdict: republish `message` (the delivered body
+    # when None) through the next retry delay, or to the dead-letter queue
+    # once the delays are used up. error_class travels as a header.
+    def __init__(self, message=None, error_class=None):
+        self.message = message
+        self.error_class = error_class
+
+class Reject(Retry):
+    # Like Retry, but straight to the dead-letter queue: the failure is
+    # permanent.
+    pass
+
+def parse_retry_delays(value):
+    if not value:
+        return DEFAULT_RETRY_DELAYS
+    return tuple(int(delay) for delay in value.split(',') if delay.strip() != '')
+
+def retry_queue_name(delay):
+    return '{}.retry.{}s'.format(QUEUE_NAME, delay)
+
+def retry_topology(retry_delays):
+    # Every queue besides the main one, as (name, arguments). A retry queue
+    # holds each message for its delay, then the broker dead-letters it back
+    # onto the main queue. The delay is part of the name, so changing the
+    # delays declares new queues rather than clashing with the old ones.
+    queues = []
+    for delay in retry_delays:
+        queues.append((retry_queue_name(delay), {
+            'x-message-ttl': delay * 1000,
+            'x-dead-letter-exchange': '',
+            'x-dead-letter-routing-key': QUEUE_NAME,
+        }))
+    queues.append((DEAD_LETTER_QUEUE_NAME, None))
+    return queues
+
+def republications(result, body, headers, retry_delays):
+    # What settling a delivery with a callback's result publishes before
+    # the delivery is acked, as [(routing key, body, headers)]. True
+    # publishes nothing; a Retry, a Reject or a list of them publishes one
+    # message each; anything else (False, an exception) retries the
+    # delivery as it was. x-attempts counts the failed deliveries so far.
+    if result == True:
+        return []
+    if isinstance(result, Retry):
+        result = [result]
+    elif not isinstance(result, list):
+        result = [Retry()]
+    attempts = int((headers or {}).get('x-attempts', 0)) + 1
+    publications = []
+    for outcome in result:
+        outgoing = dict(headers or {})
+        outgoing['x-attempts'] = attempts
+        if outcome.error_class:
+            outgoing['x-error-class'] = outcome.error_class
+        payload = body if outcome.message is None else json.dumps(outcome.message)
+        if not isinstance(outcome, Reject) and attempts <= len(retry_delays):
+            publications.append((retry_queue_name(retry_delays[attempts - 1]), payload, outgoing))
+        else:
+            publications.append((DEAD_LETTER_QUEUE_NAME, payload, outgoing))
+    return publications
 
 class ManagedConnection(object):
     def __init__(self, connection_string):
@@ -11,17 +80,21 @@ class ManagedConnection(object):
         self.connection_string = connection_string
         self.connection = None
         self.channel = None
+        self.confirm_channel = None
+        self.confirmations = {}
+        self.last_publish_tag = 0
         self.connect()
 
     def connect(self):
         self.lock.acquire(blocking=True)
         try:
-            for closeable in [self.channel, self.connection]:
+            for closeable in [self.confirm_channel, self.channel, self.connection]:
                 if closeable is not None and closeable.is_open:
                     try:
                         closeable.close()
                     except Exception:
                         pass
+            self.confirm_channel = None
             self.create_connection(self.connection_string)
             self.create_channel()
         except Exception as e:
@@ -35,9 +108,53 @@ class ManagedConnection(object):
     def create_channel(self):
         self.channel = self.connection.channel()
 
-    def declare(self, queue_name):
+    def create_confirm_channel(self, timeout=30):
+        # BlockingChannel.confirm_delivery() makes every basic_publish wait for
+        # its own confirm. Enabling confirms on the underlying channel instead
+        # lets a whole batch be written before waiting for the acks once.
+        channel = self.connection.channel()
+        selected = []
+        channel._impl.confirm_delivery(self.on_delivery_confirmation, callback=selected.append)
+        deadline = time.monotonic() + timeout
+        while len(selected) == 0:
+            if time.monotonic() >= deadline:
+                try:
+                    channel.close()
+                except Exception:
+                    pass
+                raise TimeoutError('The broker did not enable publisher confirms within {}s'.format(timeout))
+            self.connection.process_data_events(time_limit=0.01)
+        self.confirmations = {}
+        self.last_publish_tag = 0
+        self.confirm_channel = channel
+
+    def on_delivery_confirmation(self, method_frame):
+        method = method_frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        tags = [method.delivery_tag]
+        if method.multiple:
+            tags = [tag for tag in self.confirmations if tag <= method.delivery_tag]
+        for tag in tags:
+            if tag in self.confirmations and self.confirmations[tag] is None:
+                self.confirmations[tag] = acked
+
+    def publish_confirmed(self, routing_key, bodies, properties=None, timeout=30):
+        if self.confirm_channel is None or not self.confirm_channel.is_open:
+            self.create_confirm_channel(timeout)
+        tags = []
+        for body in bodies:
+            self.confirm_channel._impl.basic_publish(exchange='', routing_key=routing_key, body=body, properties=properties)
+            self.last_publish_tag += 1
+            self.confirmations[self.last_publish_tag] = None
+            tags.append(self.last_publish_tag)
+        deadline = time.monotonic() + timeout
+        while any(self.confirmations[tag] is None for tag in tags) and time.monotonic() < deadline:
+            self.connection.process_data_events(time_limit=0.01)
+        return [self.confirmations.pop(tag) == True for tag in tags]
+
+    def declare(self, queue_name, arguments=None):
         def _declare():
-            self.channel.queue_declare(queue_name, durable=True)
+            self.channel.queue_declare(queue_name, durable=True, arguments=arguments)
         self._with_reconnect_loop(_declare)
 
     def _with_reconnect_loop(self, callback):
@@ -57,21 +174,103 @@ class ManagedConnection(object):
 
 class MessagingService(object):
     def __init__(self):
-        self.queue_name = 'photo-processor'
+        self.queue_name = QUEUE_NAME
+        self.retry_delays = parse_retry_delays(os.environ.get('RETRY_DELAYS'))
+        # The web process publishes from several request threads at once.
+        self.lock = threading.RLock()
         self.socket = ManagedConnection(os.environ['AMQP_URI'])
         self.socket.declare(self.queue_name)
+        for queue_name, arguments in retry_topology(self.retry_delays):
+            self.socket.declare(queue_name, arguments)
 
     def push(self, msg):
         def _send():
             self.socket.channel.basic_publish(exchange='', routing_key=self.queue_name, body=json.dumps(msg))
-        self.socket._with_reconnect_loop(_send)
+        with self.lock:
+            self.socket._with_reconnect_loop(_send)
+
+    def push_many(self, msgs, batch_size=1000, timeout=30):
+        properties = pika.BasicProperties(delivery_mode=2)
+        confirmed = []
+        for start in range(0, len(msgs), batch_size):
+            bodies = [json.dumps(msg) for msg in msgs[start:start + batch_size]]
+            result = []
+            def _send():
+                result[:] = self.socket.publish_confirmed(self.queue_name, bodies, properties, timeout)
+            with self.lock:
+                self.socket._with_reconnect_loop(_send)
+            confirmed.extend(result)
+        return confirmed
+
+    def push_uuids(self, uuids, per_message=1, force=False, batch_size=1000, timeout=30):
+        # With per_message > 1 each message carries { 'uuids': [...] }, which
+        # consumers claim and complete as a unit. The result is aligned to
+        # uuids: each one is confirmed when the message carrying it is.
+        if per_message <= 1:
+            msgs = [{ 'uuid': uuid, 'force': True } for uuid in uuids] if force else list(uuids)
+            return self.push_many(msgs, batch_size, timeout)
+        chunks = [uuids[start:start + per_message] for start in range(0, len(uuids), per_message)]
+        msgs = [{ 'uuids': list(chunk), 'force': True } if force else { 'uuids': list(chunk) } for chunk in chunks]
+        confirmed = self.push_many(msgs, max(1, batch_size // per_message), timeout)
+        return [is_confirmed for chunk, is_confirmed in zip(chunks, confirmed) for _ in chunk]
+
+    def settle(self, channel, delivery_tag, properties, body, result):
+        # Failures are never nacked back onto the main queue, which would
+        # redeliver them at once; they are republished through a retry queue
+        # (or the dead-letter queue) and the delivery acked. Publishing first
+        # means a crash in between duplicates the message rather than losing
+        # it.
+        headers = getattr(properties, 'headers', None)
+        for routing_key, payload, outgoing in republications(result, body, headers, self.retry_delays):
+            channel.basic_publish(exchange='', routing_key=routing_key, body=payload,
+                properties=pika.BasicProperties(delivery_mode=2, headers=outgoing))
+        channel.basic_ack(delivery_tag)
+
+    def parse(self, channel, method_frame, properties, body):
+        # Returns (True, message), or (False, None) for a body that is not
+        # JSON: no retry will fix that, so it is dead-lettered at once.
+        try:
+            return (True, json.loads(body))
+        except ValueError as ex:
+            print('[messaging_service] Dead-lettering a message that is not JSON: {}'.format(ex))
+            self.settle(channel, method_frame.delivery_tag, properties, body, Reject(error_class='malformed'))
+            return (False, None)
 
     def consume(self, callback):
         def _consume():
-            for method_frame, properties, body in self.socket.channel.consume(self.queue_name):
-                parsed = json.loads(body)
-                if callback(parsed) == True:
-                    self.socket.channel.basic_ack(method_frame.delivery_tag)
-                else:
-                    self.socket.channel.basic_nack(method_frame.delivery_tag)
+            channel = self.socket.channel
+            for method_frame, properties, body in channel.consume(self.queue_name):
+                parsed, message = self.parse(channel, method_frame, properties, body)
+                if not parsed:
+                    continue
+                try:
+                    result = callback(message)
+                except Exception as ex:
+                    # Settled as a failure, through the retry queues, as
+                    # WorkerPool.result_of does for the concurrent modes.
+                    print('[messaging_service] Callback raised: {}'.format(ex))
+                    result = False
+                self.settle(channel, method_frame.delivery_tag, properties, body, result)
+        self.socket._with_reconnect_loop(_consume)
+
+    def consume_concurrently(self, dispatch, prefetch_count):
+        def _settle(channel, delivery_tag, properties, body, result):
+            if not channel.is_open:
+                return
+            self.settle(channel, delivery_tag, properties, body, result)
+
+        def _consume():
+            connection = self.socket.connection
+            channel = self.socket.channel
+            channel.basic_qos(prefetch_count=prefetch_count)
+            for method_frame, properties, body in channel.consume(self.queue_name):
+                parsed, message = self.parse(channel, method_frame, properties, body)
+                if not parsed:
+                    continue
+                # Workers settle from their own threads, but the channel may
+                # only be touched from the connection's thread.
+                def done(result, delivery_tag=method_frame.delivery_tag, properties=properties, body=body):
+                    connection.add_callback_threadsafe(
+                        functools.partial(_settle, channel, delivery_tag, properties, body, result))
+                dispatch(message, done)
         self.socket._with_reconnect_loop(_consume)
@@ -0,0 +1,281 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# Seconds; wide enough for a 304 from the source cache and a 40MP decode.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def format_labels(names, values):
+    if len(names) == 0:
+        return ''
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join('{}="{}"'.format(name, escape(value)) for name, value in zip(names, values)) + '}'
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('{} expects labels {}, got {}'.format(self.name, self.labelnames, tuple(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        with self.lock:
+            return sorted(self.values.items())
+
+    def add_sample(self, key, value):
+        # Used by merge() to sum the same sample from several processes.
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.kind)]
+        for key, value in self.samples():
+            lines.extend(self.render_sample(key, value))
+        return lines
+
+    def render_sample(self, key, value):
+        return ['{}{} {}'.format(self.name, format_labels(self.labelnames, key), format_value(value))]
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class CallbackGauge(Metric):
+    # Sampled when rendered, for values another object already tracks
+    # (e.g. queue depths); collect() returns { label values tuple: value }.
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames, collect):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def samples(self):
+        values = dict((tuple(str(value) for value in key), sample) for key, sample in self.collect().items())
+        with self.lock:
+            self.values = values
+        return super().samples()
+
+class CallbackCounter(CallbackGauge):
+    # For counts another object keeps (e.g. a cache's hits and misses).
+    kind = 'counter'
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        # Counts are kept per bucket and only made cumulative when rendered,
+        # so an observation is one bisect and three additions.
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        # Copies, since observe() updates the state in place.
+        with self.lock:
+            return sorted((key, [list(counts), total, count]) for key, (counts, total, count) in self.values.items())
+
+    def add_sample(self, key, value):
+        counts, total, count = value
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0] = [mine + theirs for mine, theirs in zip(state[0], counts)]
+            state[1] += total
+            state[2] += count
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render_sample(self, key, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            labels = format_labels(self.labelnames + ('le',), key + (format_value(bound),))
+            lines.append('{}_bucket{} {}'.format(self.name, labels, cumulative))
+        labels = format_labels(self.labelnames, key)
+        lines.append('{}_sum{} {}'.format(self.name, labels, format_value(total)))
+        lines.append('{}_count{} {}'.format(self.name, labels, count))
+        return lines
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def callback_gauge(self, name, documentation, labelnames, collect):
+        return self.register(CallbackGauge(name, documentation, labelnames, collect))
+
+    def callback_counter(self, name, documentation, labelnames, collect):
+        return self.register(CallbackCounter(name, documentation, labelnames, collect))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def snapshot(self):
+        # Every metric and its samples as plain lists, for write_snapshot().
+        with self.lock:
+            metrics = list(self.metrics)
+        return [{
+            'name': metric.name,
+            'kind': metric.kind,
+            'documentation': metric.documentation,
+            'labelnames': list(metric.labelnames),
+            'buckets': list(getattr(metric, 'buckets', ())),
+            'samples': [[list(key), value] for key, value in metric.samples()],
+        } for metric in metrics]
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+def merge(snapshots):
+    # A Registry holding the sum of each sample across snapshots, e.g. one
+    # per gunicorn worker. Summing suits counters and histograms, and the
+    # gauges here, which count things in use or waiting.
+    registry = Registry()
+    metrics = {}
+    for snapshot in snapshots:
+        for entry in snapshot:
+            metric = metrics.get(entry['name'])
+            if metric is None:
+                if entry['kind'] == 'histogram':
+                    metric = registry.histogram(entry['name'], entry['documentation'], entry['labelnames'], entry['buckets'])
+                elif entry['kind'] == 'counter':
+                    metric = registry.counter(entry['name'], entry['documentation'], entry['labelnames'])
+                else:
+                    metric = registry.gauge(entry['name'], entry['documentation'], entry['labelnames'])
+                metrics[entry['name']] = metric
+            for key, value in entry['samples']:
+                metric.add_sample(tuple(key), value)
+    return registry
+
+def write_snapshot(registry, directory, name=None):
+    # One file per process, replaced whole so readers never see half of it.
+    path = os.path.join(directory, '{}.json'.format(name or os.getpid()))
+    with open(path + '.tmp', 'w') as f:
+        json.dump(registry.snapshot(), f)
+    os.replace(path + '.tmp', path)
+
+def read_snapshots(directory):
+    snapshots = []
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, filename)) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError) as ex:
+            print('[metrics] Skipping snapshot {}: {}'.format(filename, ex))
+    return snapshots
+
+def start_snapshot_writer(registry, directory, interval=5.0):
+    # Writes this process' snapshot every interval seconds, so that whichever
+    # process answers a scrape can merge the others' in.
+    def run():
+        while True:
+            try:
+                write_snapshot(registry, directory)
+            except OSError as ex:
+                print('[metrics] Could not write a snapshot to {}: {}'.format(directory, ex))
+            time.sleep(interval)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def start_http_server(port, registry, host='0.0.0.0'):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = MetricsServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
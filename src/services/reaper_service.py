@@ -0,0 +1,73 @@
+import threading
+import time
+
+class ReaperService(object):
+    # Re-enqueues photos left in `processing` by a consumer that died: every
+    # interval, photos whose lease has expired are published again, a batch
+    # at a time, and those the broker confirmed go back to `pending`.
+    # Recovery after a crash therefore only redoes the work that was in
+    # flight.
+    def __init__(self, db_service, messaging_service, interval=60, batch_size=1000, uuids_per_message=1):
+        self.db_service = db_service
+        self.messaging_service = messaging_service
+        self.interval = interval
+        self.batch_size = batch_size
+        self.uuids_per_message = uuids_per_message
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.state = { 'running': False, 'reaped': 0 }
+
+    def reap_once(self):
+        reaped = 0
+        while True:
+            rows, confirmed = self.db_service.reap_expired(self.batch_size, self.publish)
+            reaped += confirmed.count(True)
+            if not all(confirmed):
+                # Those are still `processing` with an expired lease, so the
+                # next pass publishes them again.
+                print('[reaper_service] The message broker did not confirm {} of {} photos'.format(confirmed.count(False), len(rows)))
+                break
+            if len(rows) < self.batch_size:
+                break
+        if reaped > 0:
+            print('[reaper_service] Re-enqueued {} photos with expired leases'.format(reaped))
+        return reaped
+
+    def publish(self, rows):
+        ids = [str(row['uuid']) for row in rows]
+        return self.messaging_service.push_uuids(ids, self.uuids_per_message, batch_size=self.batch_size)
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                reaped = self.reap_once()
+                with self.lock:
+                    self.state.update(reaped=self.state['reaped'] + reaped, last_run_at=time.time(), error=None)
+            except Exception as ex:
+                print('[reaper_service] Reaping failed: {}'.format(ex))
+                self.update(error=str(ex))
+
+    def start(self):
+        with self.lock:
+            if self.state['running']:
+                return False
+            self.state['running'] = True
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name='reaper', daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.update(running=False)
+
+    def update(self, **changes):
+        with self.lock:
+            self.state.update(changes)
+
+    def status(self):
+        with self.lock:
+            return dict(self.state)
@@ -0,0 +1,56 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+CachedResponse = namedtuple('CachedResponse', ['version', 'stored_at', 'etag', 'body'])
+
+def etag_for(body):
+    # Unquoted, as Werkzeug's set_etag expects.
+    return hashlib.sha1(body).hexdigest()
+
+class ResponseCache(object):
+    # Serialized response bodies by request, each stored with the version
+    # token its rows were read under. An entry is served while the token is
+    # unchanged and it is younger than ttl: the token is bumped before the
+    # write that bumped it commits, so the ttl bounds how long a response
+    # read in between can be served. Least recently used entries are evicted
+    # once the bodies add up to more than max_bytes.
+    def __init__(self, max_bytes, ttl, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.version != version or self.clock() - entry.stored_at >= self.ttl:
+                self.remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, version, body):
+        entry = CachedResponse(version, self.clock(), etag_for(body), body)
+        if self.ttl <= 0 or len(body) > self.max_bytes:
+            return entry
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = entry
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+        return entry
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry.body)
+
+    def __len__(self):
+        return len(self.entries)
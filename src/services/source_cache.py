@@ -0,0 +1,141 @@
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+class SourceCache(object):
+    def __init__(self, directory, max_bytes, fresh_for=0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.fresh_for = fresh_for
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.counters = { 'hits': 0, 'revalidations': 0, 'misses': 0, 'evictions': 0 }
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def key(self, url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def data_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def meta_path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def load(self):
+        # Rebuild the index from disk, least recently used first.
+        found = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            key = name[:-len('.json')]
+            try:
+                with open(self.meta_path(key)) as meta_file:
+                    meta = json.load(meta_file)
+                used_at = os.stat(self.data_path(key)).st_mtime
+            except (OSError, ValueError):
+                self.remove_files(key)
+                continue
+            found.append((used_at, key, meta))
+        for used_at, key, meta in sorted(found, key=lambda item: item[0]):
+            self.entries[key] = meta
+            self.total_bytes += meta['size']
+        with self.lock:
+            self.evict()
+
+    def validators(self, url):
+        with self.lock:
+            meta = self.entries.get(self.key(url))
+        headers = {}
+        if meta is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def fresh(self, url):
+        if not self.fresh_for:
+            return None
+        key = self.key(url)
+        with self.lock:
+            meta = self.entries.get(key)
+            if meta is None or time.time() - meta['validated_at'] > self.fresh_for:
+                return None
+        return self.read(key, 'hits')
+
+    def not_modified(self, url):
+        key = self.key(url)
+        with self.lock:
+            meta = self.entries.get(key)
+            if meta is None:
+                return None
+            meta['validated_at'] = time.time()
+        self.write_meta(key, meta)
+        return self.read(key, 'revalidations')
+
+    def read(self, key, counter):
+        try:
+            with open(self.data_path(key), 'rb') as data_file:
+                stream = io.BytesIO(data_file.read())
+            os.utime(self.data_path(key))
+        except OSError:
+            # Evicted by another worker between the lookup and the read.
+            return None
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            self.counters[counter] += 1
+        return stream
+
+    def store(self, url, data, etag=None, last_modified=None):
+        key = self.key(url)
+        with self.lock:
+            self.counters['misses'] += 1
+        if len(data) > self.max_bytes or (not etag and not last_modified and not self.fresh_for):
+            # Too big to keep, or nothing to revalidate it with later.
+            return
+        meta = { 'url': url, 'size': len(data), 'etag': etag, 'last_modified': last_modified, 'validated_at': time.time() }
+        temporary_path = '{}.{}.tmp'.format(self.data_path(key), threading.get_ident())
+        with open(temporary_path, 'wb') as data_file:
+            data_file.write(data)
+        os.replace(temporary_path, self.data_path(key))
+        self.write_meta(key, meta)
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= previous['size']
+            self.entries[key] = meta
+            self.total_bytes += meta['size']
+            self.evict()
+
+    def write_meta(self, key, meta):
+        temporary_path = '{}.{}.tmp'.format(self.meta_path(key), threading.get_ident())
+        with open(temporary_path, 'w') as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(temporary_path, self.meta_path(key))
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 0:
+            key, meta = self.entries.popitem(last=False)
+            self.total_bytes -= meta['size']
+            self.counters['evictions'] += 1
+            self.remove_files(key)
+
+    def remove_files(self, key):
+        for path in (self.meta_path(key), self.data_path(key)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update({ 'entries': len(self.entries), 'bytes': self.total_bytes })
+        return stats
@@ -0,0 +1,80 @@
+import threading
+from queue import Queue
+
+STOP = object()
+
+class StagedPipeline(object):
+    # Runs each message through a sequence of stages, each with its own
+    # threads, connected by bounded queues: while one message is being
+    # resized the next one is already downloading. A full queue blocks the
+    # stage feeding it. Results are settled in dispatch order whatever order
+    # the messages finish in.
+    def __init__(self, stages, capacity=2):
+        self.lock = threading.Lock()
+        self.next_sequence = 0
+        self.next_settle = 0
+        self.finished = {}
+        self.names = [name for name, work, workers in stages]
+        self.queues = [Queue(maxsize=capacity) for _ in stages]
+        self.threads = []
+        for index, (name, work, workers) in enumerate(stages):
+            for _ in range(workers):
+                thread = threading.Thread(target=self.run_stage, args=(index, work), name='{}-stage'.format(name), daemon=True)
+                thread.start()
+                self.threads.append((index, thread))
+
+    def dispatch(self, parsed, done):
+        with self.lock:
+            sequence = self.next_sequence
+            self.next_sequence += 1
+        self.queues[0].put((sequence, parsed, done))
+
+    def run_stage(self, index, work):
+        queue = self.queues[index]
+        while True:
+            entry = queue.get()
+            if entry is STOP:
+                return
+            sequence, item, done = entry
+            try:
+                output = work(item)
+            except Exception as ex:
+                print('[staged_pipeline] Stage {} raised: {}'.format(self.names[index], ex))
+                self.settle(sequence, done, False)
+                continue
+            if index == len(self.queues) - 1:
+                self.settle(sequence, done, output)
+            else:
+                self.queues[index + 1].put((sequence, output, done))
+
+    def settle(self, sequence, done, result):
+        with self.lock:
+            self.finished[sequence] = (done, result)
+            # done() only schedules the ack, so calling it under the lock is
+            # cheap and keeps the acks in order. It raises once the
+            # connection it acks on has closed; the broker redelivers that
+            # message, and the rest must still drain or the stages stall.
+            while self.next_settle in self.finished:
+                done, result = self.finished.pop(self.next_settle)
+                self.next_settle += 1
+                try:
+                    done(result)
+                except Exception as ex:
+                    print('[staged_pipeline] Could not settle message {}: {}'.format(self.next_settle - 1, ex))
+
+    def depths(self):
+        return dict((name, queue.qsize()) for name, queue in zip(self.names, self.queues))
+
+    def in_flight(self):
+        with self.lock:
+            return self.next_sequence - self.next_settle
+
+    def shutdown(self):
+        # Stages are stopped in order, so everything already dispatched
+        # drains through the later stages first.
+        for index, queue in enumerate(self.queues):
+            stage_threads = [thread for stage, thread in self.threads if stage == index]
+            for _ in stage_threads:
+                queue.put(STOP)
+            for thread in stage_threads:
+                thread.join()
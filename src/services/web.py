@@ -1,21 +1,85 @@
+import os
+import time
+from collections import namedtuple
 from uuid import UUID
-from flask import Flask, jsonify, request, make_response, g
-from db_service import DbService
+from flask import Flask, Blueprint, Response, current_app, request, stream_with_context, g
+from db_service import DbService, decode_after
 from messaging_service import MessagingService
+from backfill_service import BackfillService, parse_args
+from reaper_service import ReaperService
+from response_cache import ResponseCache
+from json_encoding import select_dumps
+from metrics import Registry, CONTENT_TYPE, merge, read_snapshots, start_snapshot_writer, write_snapshot
 
-app = Flask(__name__)
-db_service = DbService()
-messaging_service = MessagingService()
+routes = Blueprint('photos', __name__)
+registry = Registry()
+request_seconds = registry.histogram('photo_processor_http_request_seconds', 'Web handler latency.', ('method', 'endpoint', 'status'))
+publish_seconds = registry.histogram('photo_processor_publish_seconds', 'Time to publish a request\'s photos and receive broker confirms.')
+published_total = registry.counter('photo_processor_published_total', 'Photos submitted for processing, by broker outcome.', ('outcome',))
+pending_cache_total = registry.counter('photo_processor_pending_cache_total', 'GET /photos/pending responses, by cache outcome.', ('outcome',))
+
+MAX_PAGE_SIZE = 1000
+uuids_per_message = int(os.environ.get('UUIDS_PER_MESSAGE') or 1)
+reaper_interval = int(os.environ.get('REAPER_INTERVAL') or 60)
+pending_cache_ttl = float(os.environ.get('PENDING_CACHE_TTL') or 10)
+pending_cache_max_bytes = int(os.environ.get('PENDING_CACHE_MAX_BYTES') or 16 * 1024 * 1024)
+# Where each gunicorn worker writes its metrics, for GET /metrics to sum.
+# Unset, /metrics describes only the process that answered it.
+metrics_dir = os.environ.get('WEB_METRICS_DIR')
+# orjson when installed; JSON_ENCODER=stdlib forces the standard library.
+dumps = select_dumps(os.environ.get('JSON_ENCODER'))
+
+Services = namedtuple('Services', ['db', 'messaging', 'backfill', 'reaper', 'pending_cache'])
+
+def create_app(db_service=None, messaging_service=None):
+    # Everything holding a connection or a thread is built here rather than
+    # at import time: gunicorn calls this in each worker after the fork
+    # ("web:create_app()"), so workers share no sockets. Metrics are
+    # per process too, and summed through WEB_METRICS_DIR.
+    app = Flask(__name__)
+    db_service = db_service or DbService()
+    messaging_service = messaging_service or MessagingService()
+    backfill_args = parse_args([])
+    backfill_service = BackfillService(db_service, messaging_service, backfill_args.batch_size, backfill_args.rate, backfill_args.checkpoint, backfill_args.uuids_per_message)
+    # With several workers there is a reaper in each; they take disjoint
+    # rows, see ReaperService.
+    reaper_service = ReaperService(db_service, messaging_service, reaper_interval, backfill_args.batch_size, uuids_per_message)
+    if reaper_interval > 0:
+        reaper_service.start()
+    if metrics_dir:
+        os.makedirs(metrics_dir, exist_ok=True)
+        start_snapshot_writer(registry, metrics_dir)
+    pending_cache = ResponseCache(pending_cache_max_bytes, pending_cache_ttl)
+    app.extensions['photo_processor'] = Services(db_service, messaging_service, backfill_service, reaper_service, pending_cache)
+    app.register_blueprint(routes)
+    return app
+
+def services():
+    return current_app.extensions['photo_processor']
+
+def json_response(value, code = 200):
+    return Response(dumps(value), status=code, mimetype='application/json')
 
 def create_error_response(msg, code = 400):
-    message = jsonify({ 'message': msg })
-    return make_response(message, code)
+    return json_response({ 'message': msg }, code)
 
 def empty():
-    return jsonify({})
+    return json_response({})
 
 def index():
-    return jsonify(success=True)
+    return json_response({ 'success': True })
+
+@routes.before_app_request
+def start_timer():
+    g.started_at = time.perf_counter()
+
+@routes.after_app_request
+def record_latency(response):
+    if 'started_at' in g:
+        # Label by route rule rather than path so UUIDs don't explode cardinality.
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        request_seconds.observe(time.perf_counter() - g.started_at, method=request.method, endpoint=endpoint, status=response.status_code)
+    return response
 
 def is_uuid(val):
     try:
@@ -24,15 +88,98 @@ def is_uuid(val):
     except ValueError:
         return False
 
-@app.route('/photos/pending')
+def stream_json_array(first, rows):
+    # Rows arrive as JSON text built by Postgres (see PHOTO_JSON).
+    yield '[' + first
+    try:
+        for row in rows:
+            yield ',' + row
+    except Exception as ex:
+        # The status line is already sent; the truncated array tells the client.
+        print('[web] Streaming aborted: {}'.format(ex))
+        return
+    yield ']'
+
+def pending_version():
+    # None leaves the request uncached: caching is off, or the database
+    # predates photos_version_seq.
+    if services().pending_cache.ttl <= 0:
+        return None
+    try:
+        return services().db.get_version()
+    except Exception as ex:
+        print('[web] Not caching, could not read the version token: {}'.format(ex))
+        return None
+
+def cached_response(entry, outcome):
+    response = Response(entry.body, mimetype='application/json')
+    response.set_etag(entry.etag)
+    # Clients may keep the body but must revalidate before reusing it.
+    response.cache_control.no_cache = True
+    response = response.make_conditional(request)
+    pending_cache_total.inc(outcome='not_modified' if response.status_code == 304 else outcome)
+    return response
+
+def cache_stream(chunks, key, version):
+    # Streams the array as before and, if it completes within the cache's
+    # size limit, keeps it: the next poll is then served with an ETag.
+    cache = services().pending_cache
+    body = []
+    size = 0
+    for chunk in chunks:
+        yield chunk
+        if body is not None:
+            size += len(chunk)
+            if size <= cache.max_bytes:
+                body.append(chunk)
+            else:
+                body = None
+    if body is not None and body[-1] == ']':
+        cache.put(key, version, ''.join(body).encode('utf-8'))
+
+@routes.route('/photos/pending')
 def get_photos_pending():
     try:
-        results = db_service.get_by_status('pending')
-        return jsonify(results)
+        after = decode_after(request.args['after']) if request.args.get('after') else None
+        limit = int(request.args['limit']) if request.args.get('limit') else None
+        if limit is not None and not 0 < limit <= MAX_PAGE_SIZE:
+            raise ValueError('limit must be between 1 and {}'.format(MAX_PAGE_SIZE))
+    except ValueError as ex:
+        return create_error_response('Invalid pagination parameters: {}'.format(str(ex)))
+
+    # Polls while nothing has changed cost one sequence read, and a 304
+    # when the client sends the ETag back in If-None-Match. The version is
+    # read before the rows, so a cached body is never newer than its token.
+    key = (limit, request.args.get('after'))
+    version = pending_version()
+    if version is not None:
+        entry = services().pending_cache.get(key, version)
+        if entry is not None:
+            return cached_response(entry, 'hit')
+    try:
+        if limit is not None:
+            rows, next_after = services().db.get_page_json_by_status('pending', limit, after)
+            body = '{{"next":{},"photos":[{}]}}'.format(dumps(next_after).decode('utf-8'), ','.join(rows))
+            response = Response(body, mimetype='application/json')
+        else:
+            # Without a limit the whole set is streamed from a server-side cursor.
+            # The first row is read up front so a database error still gets a 500.
+            rows = services().db.stream_json_by_status('pending', after)
+            first = next(rows, None)
+            if first is not None:
+                chunks = stream_json_array(first, rows)
+                if version is not None:
+                    pending_cache_total.inc(outcome='miss')
+                    chunks = cache_stream(chunks, key, version)
+                return Response(stream_with_context(chunks), mimetype='application/json')
+            response = json_response([])
+        if version is None:
+            return response
+        return cached_response(services().pending_cache.put(key, version, response.get_data()), 'miss')
     except Exception as ex:
         return create_error_response('Internal Server Error: {}'.format(str(ex)), 500)
 
-@app.route('/photos/process', methods = ['POST'])
+@routes.route('/photos/process', methods = ['POST'])
 def process_photo():
     input = request.get_json(force=True)
     response = None
@@ -43,16 +190,28 @@ def process_photo():
 
     try:
         if isinstance(input, type([])):
+            valid = []
             for uuid in input:
                 if not is_uuid(uuid):
                     response_payload['rejected'].append(uuid)
                 else:
-                    messaging_service.push(uuid)
+                    valid.append(uuid)
+            force = request.args.get('force', '').lower() in ('1', 'true', 'yes')
+            with publish_seconds.time():
+                confirmed = services().messaging.push_uuids(valid, uuids_per_message, force)
+            published_total.inc(confirmed.count(True), outcome='confirmed')
+            published_total.inc(confirmed.count(False), outcome='unconfirmed')
+            for uuid, is_confirmed in zip(valid, confirmed):
+                if is_confirmed:
                     response_payload['accepted'].append(uuid)
-            if len(response_payload['rejected']) == len(input) and len(input) > 0:
+                else:
+                    response_payload['rejected'].append(uuid)
+            if len(valid) == 0 and len(input) > 0:
                 response = create_error_response('None of the provided inputs could be parsed as a UUID')
+            elif len(valid) > 0 and len(response_payload['accepted']) == 0:
+                response = create_error_response('The message broker did not confirm any of the provided photos', 503)
             else:
-                response = make_response(jsonify(response_payload), 201)
+                response = json_response(response_payload, 201)
         else:
             response = create_error_response('Invalid payload format', 406)
     except Exception as ex:
@@ -60,5 +219,28 @@ def process_photo():
 
     return response
 
+@routes.route('/photos/process/pending', methods = ['POST'])
+def process_pending_photos():
+    # Runs in a background thread of this process; poll the GET endpoint.
+    backfill_service = services().backfill
+    if not backfill_service.start('pending'):
+        return json_response(backfill_service.status(), 409)
+    return json_response(backfill_service.status(), 202)
+
+@routes.route('/photos/process/pending')
+def get_pending_backfill():
+    return json_response(services().backfill.status())
+
+@routes.route('/metrics')
+def get_metrics():
+    if not metrics_dir:
+        return Response(registry.render(), content_type=CONTENT_TYPE)
+    # The other workers' snapshots are up to a few seconds old; this one's
+    # is brought up to date first.
+    write_snapshot(registry, metrics_dir)
+    return Response(merge(read_snapshots(metrics_dir)).render(), content_type=CONTENT_TYPE)
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=3000)
+    # Werkzeug's development server; production runs gunicorn, see
+    # supervisord.conf.
+    create_app().run(host='0.0.0.0', port=3000)
@@ -0,0 +1,20 @@
+from concurrent.futures import ThreadPoolExecutor
+
+class WorkerPool(object):
+    def __init__(self, callback, workers):
+        self.callback = callback
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def dispatch(self, parsed, done):
+        future = self.executor.submit(self.callback, parsed)
+        future.add_done_callback(lambda f: done(self.result_of(f)))
+
+    def result_of(self, future):
+        try:
+            return future.result()
+        except Exception as ex:
+            print('[worker_pool] Callback raised: {}'.format(ex))
+            return False
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,45 @@
+import threading
+import unittest
+from nose.tools import assert_true
+from src.services.admission_controller import AdmissionController
+
+class TestAdmissionController(unittest.TestCase):
+    def test_admit(self):
+        admission = AdmissionController(100)
+        with admission.admit(60):
+            assert_true(admission.stats() == { 'in_flight': 60, 'waiting': 0, 'budget': 100 })
+            with admission.admit(40):
+                assert_true(admission.stats()['in_flight'] == 100)
+        assert_true(admission.stats()['in_flight'] == 0)
+
+    def test_released_on_exception(self):
+        admission = AdmissionController(100)
+        try:
+            with admission.admit(60):
+                raise Exception('exception:work')
+        except Exception:
+            pass
+        assert_true(admission.stats()['in_flight'] == 0)
+
+    def test_waits_for_budget(self):
+        admission = AdmissionController(100)
+        admitted = threading.Event()
+        def second():
+            with admission.admit(50):
+                admitted.set()
+        with admission.admit(60):
+            thread = threading.Thread(target=second)
+            thread.start()
+            assert_true(not admitted.wait(0.2))
+            assert_true(admission.stats()['waiting'] == 1)
+        assert_true(admitted.wait(5))
+        thread.join(5)
+        assert_true(admission.stats() == { 'in_flight': 0, 'waiting': 0, 'budget': 100 })
+
+    def test_oversized_runs_alone(self):
+        admission = AdmissionController(100)
+        with admission.admit(150):
+            assert_true(admission.stats()['in_flight'] == 150)
+
+if __name__ == '__main__':
+    unittest.main()
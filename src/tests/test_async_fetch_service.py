@@ -0,0 +1,192 @@
+import asyncio
+import tempfile
+import time
+import unittest
+from nose.tools import assert_true
+from benchmarks import fakes
+from src.tests.stand_in_server import StandInServer
+from src.tests.test_fetch_service import create_etag_route
+
+PHOTO = b'\xff\xd8' + b'x' * 100000
+
+def setUpModule():
+    # async_fetch_service imports fetch_service flat, as the consumers run
+    # it. That puts src/services on sys.path, which is done here rather than
+    # at import so that other test modules still import the src.services
+    # ones. DownloadTooLarge comes from the same flat module the service
+    # raises it from.
+    global AsyncFetchService, HttpStatusError, DownloadTooLarge, SourceCache
+    fakes.install({}, [])
+    from async_fetch_service import AsyncFetchService, HttpStatusError
+    from fetch_service import DownloadTooLarge
+    from source_cache import SourceCache
+
+def photo(handler):
+    handler.send_body(PHOTO)
+
+def chunked(handler):
+    handler.send_response(200)
+    handler.send_header('Transfer-Encoding', 'chunked')
+    handler.end_headers()
+    for chunk in (PHOTO[:50000], PHOTO[50000:]):
+        handler.wfile.write('{:x}\r\n'.format(len(chunk)).encode() + chunk + b'\r\n')
+    handler.wfile.write(b'0\r\n\r\n')
+
+def closing(handler):
+    handler.send_body(PHOTO, headers={ 'Connection': 'close' })
+    handler.close_connection = True
+
+def redirect(handler):
+    handler.send_body(b'', status=302, headers={ 'Location': '/photo.jpg' })
+
+def slow(handler):
+    time.sleep(0.5)
+    handler.send_body(PHOTO)
+
+def create_flaky(failures):
+    state = { 'remaining': failures }
+    def flaky(handler):
+        if state['remaining'] > 0:
+            state['remaining'] -= 1
+            handler.send_body(b'', status=503)
+        else:
+            handler.send_body(PHOTO)
+    return flaky
+
+class TestAsyncFetchService(unittest.TestCase):
+    def run_fetches(self, service, urls):
+        async def _fetch_all():
+            try:
+                return await asyncio.gather(*[service.fetch_bytes(url) for url in urls])
+            finally:
+                await service.close()
+        return asyncio.run(_fetch_all())
+
+    def run_fetch(self, service, url):
+        async def _fetch():
+            try:
+                return await service.fetch(url)
+            finally:
+                await service.close()
+        return asyncio.run(_fetch())
+
+    def test_fetch(self):
+        with StandInServer({ '/photo.jpg': photo }) as server:
+            body = self.run_fetch(AsyncFetchService(), server.url('/photo.jpg'))
+            assert_true(body.tell() == 0)
+            assert_true(body.read() == PHOTO)
+
+    def test_userinfo_not_sent(self):
+        with StandInServer({ '/photo.jpg': photo }) as server:
+            url = server.url('/photo.jpg').replace('http://', 'http://user:secret@')
+            assert_true(self.run_fetch(AsyncFetchService(), url).read() == PHOTO)
+            host = server.requests[0][1]['Host']
+            assert_true(host == url.split('@')[1].split('/')[0])
+
+    def test_connection_reuse(self):
+        with StandInServer({ '/photo.jpg': photo }) as server:
+            service = AsyncFetchService()
+            async def _sequential():
+                try:
+                    bodies = [await service.fetch_bytes(server.url('/photo.jpg')) for _ in range(10)]
+                    return bodies, service.connections_opened()
+                finally:
+                    await service.close()
+            bodies, connections_opened = asyncio.run(_sequential())
+            assert_true(bodies == [PHOTO] * 10)
+            assert_true(connections_opened == 1)
+            assert_true(server.connections == 1)
+
+    def test_per_host_limit(self):
+        with StandInServer({ '/photo.jpg': photo }) as server:
+            service = AsyncFetchService(per_host_limit=2)
+            bodies = self.run_fetches(service, [server.url('/photo.jpg')] * 10)
+            assert_true(bodies == [PHOTO] * 10)
+            assert_true(server.connections <= 2)
+
+    def test_chunked(self):
+        with StandInServer({ '/chunked': chunked }) as server:
+            service = AsyncFetchService(per_host_limit=1)
+            assert_true(self.run_fetches(service, [server.url('/chunked')] * 2) == [PHOTO] * 2)
+            assert_true(server.connections == 1)
+
+    def test_connection_close(self):
+        with StandInServer({ '/close': closing }) as server:
+            service = AsyncFetchService(per_host_limit=1)
+            assert_true(self.run_fetches(service, [server.url('/close')] * 3) == [PHOTO] * 3)
+            assert_true(server.connections == 3)
+
+    def test_redirect(self):
+        with StandInServer({ '/redirect': redirect, '/photo.jpg': photo }) as server:
+            assert_true(self.run_fetches(AsyncFetchService(), [server.url('/redirect')]) == [PHOTO])
+
+    def test_retry_with_backoff(self):
+        with StandInServer({ '/flaky': create_flaky(2) }) as server:
+            service = AsyncFetchService(retries=2, backoff=0.01)
+            assert_true(self.run_fetches(service, [server.url('/flaky')]) == [PHOTO])
+            assert_true(len(server.requests) == 3)
+
+    def test_retries_exhausted(self):
+        with StandInServer({ '/flaky': create_flaky(5) }) as server:
+            service = AsyncFetchService(retries=1, backoff=0.01)
+            try:
+                self.run_fetch(service, server.url('/flaky'))
+                assert_true(False)
+            except HttpStatusError as ex:
+                assert_true(ex.status == 503)
+            assert_true(len(server.requests) == 2)
+
+    def test_not_found_is_not_retried(self):
+        with StandInServer({}) as server:
+            service = AsyncFetchService(retries=3, backoff=0.01)
+            try:
+                self.run_fetch(service, server.url('/missing.jpg'))
+                assert_true(False)
+            except HttpStatusError as ex:
+                assert_true(ex.status == 404)
+            assert_true(len(server.requests) == 1)
+
+    def test_read_timeout(self):
+        with StandInServer({ '/slow': slow }) as server:
+            service = AsyncFetchService(read_timeout=0.1, retries=0)
+            try:
+                self.run_fetch(service, server.url('/slow'))
+                assert_true(False)
+            except asyncio.TimeoutError:
+                assert_true(True)
+
+    def test_max_bytes(self):
+        with StandInServer({ '/photo.jpg': photo, '/chunked': chunked }) as server:
+            for path in ('/photo.jpg', '/chunked'):
+                try:
+                    self.run_fetch(AsyncFetchService(max_bytes=1000), server.url(path))
+                    assert_true(False)
+                except DownloadTooLarge:
+                    assert_true(True)
+
+    def test_connect_failure(self):
+        with StandInServer({}) as server:
+            url = server.url('/photo.jpg')
+        try:
+            self.run_fetch(AsyncFetchService(retries=1, backoff=0.01), url)
+            assert_true(False)
+        except OSError:
+            assert_true(True)
+
+    def test_fetch_revalidates_with_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = SourceCache(directory, 1000000)
+            with StandInServer({ '/photo.jpg': create_etag_route(PHOTO, '"v1"') }) as server:
+                service = AsyncFetchService(cache=cache)
+                async def _fetch_twice():
+                    try:
+                        return [await service.fetch_bytes(server.url('/photo.jpg')) for _ in range(2)]
+                    finally:
+                        await service.close()
+                assert_true(asyncio.run(_fetch_twice()) == [PHOTO, PHOTO])
+                assert_true(server.requests[1][1].get('If-None-Match') == '"v1"')
+            stats = cache.stats()
+            assert_true(stats['misses'] == 1 and stats['revalidations'] == 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+from nose.tools import assert_true
+from benchmarks import fakes
+
+def setUpModule():
+    # backfill_service imports db_service flat, as web runs it. That puts
+    # src/services on sys.path, which is done here rather than at import so
+    # that other test modules still import the src.services ones.
+    global BackfillService, BackfillInterrupted, BackfillRunning, TokenBucket, encode_after, decode_after
+    fakes.install({}, [])
+    from backfill_service import BackfillService, BackfillInterrupted, BackfillRunning, TokenBucket
+    from db_service import encode_after, decode_after
+
+CREATED_AT = datetime(2019, 4, 22, 10, 32, 52, tzinfo=timezone.utc)
+
+def create_rows(count):
+    return [{ 'uuid': '00000000-0000-4000-8000-{:012d}'.format(i), 'created_at': CREATED_AT + timedelta(seconds=i) } for i in range(count)]
+
+class MockDbService(object):
+    def __init__(self, rows):
+        self.rows = rows
+        self.streams = []
+
+    def stream_by_status(self, status, after=None, chunk_size=1000):
+        self.streams.append((status, after))
+        for row in self.rows:
+            if after is None or (row['created_at'], row['uuid']) > after:
+                yield row
+
+class MockMessagingService(object):
+    def __init__(self, unconfirmed_batches=()):
+        self.batches = []
+        self.unconfirmed_batches = unconfirmed_batches
+
+    def push_uuids(self, uuids, per_message=1, force=False, batch_size=1000):
+        self.batches.append(uuids)
+        self.per_message = per_message
+        confirmed = len(self.batches) not in self.unconfirmed_batches
+        return [confirmed] * len(uuids)
+
+class TestBackfillService(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.checkpoint_path = os.path.join(self.directory.name, 'backfill.json')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_run(self):
+        rows = create_rows(25)
+        messaging_service = MockMessagingService()
+        service = BackfillService(MockDbService(rows), messaging_service, batch_size=10, checkpoint_path=self.checkpoint_path)
+        assert_true(service.run() == 25)
+        assert_true([len(batch) for batch in messaging_service.batches] == [10, 10, 5])
+        assert_true([uuid for batch in messaging_service.batches for uuid in batch] == [row['uuid'] for row in rows])
+        assert_true(not os.path.exists(self.checkpoint_path))
+        assert_true(service.status()['published'] == 25)
+
+    def test_run_batched_messages(self):
+        messaging_service = MockMessagingService()
+        service = BackfillService(MockDbService(create_rows(5)), messaging_service, batch_size=10, checkpoint_path=self.checkpoint_path, uuids_per_message=50)
+        assert_true(service.run() == 5)
+        assert_true(messaging_service.per_message == 50)
+
+    def test_resumes_from_checkpoint(self):
+        rows = create_rows(25)
+        db_service = MockDbService(rows)
+        service = BackfillService(db_service, MockMessagingService(unconfirmed_batches=(2,)), batch_size=10, checkpoint_path=self.checkpoint_path)
+        try:
+            service.run()
+            assert_true(False)
+        except BackfillInterrupted:
+            pass
+        assert_true(os.path.exists(self.checkpoint_path))
+        messaging_service = MockMessagingService()
+        resumed = BackfillService(db_service, messaging_service, batch_size=10, checkpoint_path=self.checkpoint_path)
+        assert_true(resumed.run() == 25)
+        assert_true(db_service.streams[1] == ('pending', (rows[9]['created_at'], rows[9]['uuid'])))
+        assert_true(messaging_service.batches[0][0] == rows[10]['uuid'])
+
+    def test_checkpoint_for_other_status_ignored(self):
+        rows = create_rows(5)
+        service = BackfillService(MockDbService(rows), MockMessagingService(unconfirmed_batches=(1,)), batch_size=2, checkpoint_path=self.checkpoint_path)
+        try:
+            service.run('failed')
+        except BackfillInterrupted:
+            pass
+        db_service = MockDbService(rows)
+        BackfillService(db_service, MockMessagingService(), batch_size=2, checkpoint_path=self.checkpoint_path).run('pending')
+        assert_true(db_service.streams == [('pending', None)])
+
+    def test_stop(self):
+        service = BackfillService(MockDbService(create_rows(5)), MockMessagingService(), batch_size=2, checkpoint_path=self.checkpoint_path)
+        service.stop()
+        try:
+            service.run()
+            assert_true(False)
+        except BackfillInterrupted:
+            pass
+
+    def test_start_in_background(self):
+        service = BackfillService(MockDbService(create_rows(5)), MockMessagingService(), batch_size=2, checkpoint_path=self.checkpoint_path)
+        assert_true(service.start())
+        service.thread.join(5)
+        state = service.status()
+        assert_true(not state['running'] and state['published'] == 5 and state['error'] is None)
+        assert_true(decode_after(state['after'])[1] == create_rows(5)[4]['uuid'])
+
+    def test_start_reports_failure(self):
+        service = BackfillService(MockDbService(create_rows(5)), MockMessagingService(unconfirmed_batches=(1,)), batch_size=2, checkpoint_path=self.checkpoint_path)
+        service.start()
+        service.thread.join(5)
+        state = service.status()
+        assert_true(not state['running'] and 'did not confirm' in state['error'])
+
+    def test_start_refused_while_another_process_runs(self):
+        # Web workers each have their own service sharing the checkpoint.
+        running = BackfillService(MockDbService(create_rows(5)), MockMessagingService(), batch_size=2, checkpoint_path=self.checkpoint_path)
+        other = BackfillService(MockDbService(create_rows(5)), MockMessagingService(), batch_size=2, checkpoint_path=self.checkpoint_path)
+        assert_true(running.run_lock.acquire())
+        running.checkpoint.save('pending', encode_after(create_rows(5)[3]), 4)
+        assert_true(not other.start())
+        state = other.status()
+        assert_true(state['running'] and state['elsewhere'] and state['published'] == 4)
+        running.run_lock.release()
+        assert_true(other.start())
+        other.thread.join(5)
+        state = other.status()
+        assert_true(not state['running'] and state['published'] == 5 and state['error'] is None)
+
+    def test_run_exclusively(self):
+        # The command line refuses to run alongside a web worker's backfill,
+        # and leaves its checkpoint alone.
+        running = BackfillService(MockDbService(create_rows(5)), MockMessagingService(), batch_size=2, checkpoint_path=self.checkpoint_path)
+        messaging_service = MockMessagingService()
+        command = BackfillService(MockDbService(create_rows(5)), messaging_service, batch_size=2, checkpoint_path=self.checkpoint_path)
+        assert_true(running.run_lock.acquire())
+        running.checkpoint.save('pending', encode_after(create_rows(5)[1]), 2)
+        try:
+            command.run_exclusively(restart=True)
+            assert_true(False)
+        except BackfillRunning:
+            pass
+        assert_true(messaging_service.batches == [] and os.path.exists(self.checkpoint_path))
+        running.run_lock.release()
+        assert_true(command.run_exclusively() == 5)
+        assert_true([len(batch) for batch in messaging_service.batches] == [2, 1])
+        # The lock is released afterwards.
+        assert_true(running.start())
+        running.thread.join(5)
+
+class TestTokenBucket(unittest.TestCase):
+    def test_take_limits_rate(self):
+        now = [0.0]
+        def sleep(seconds):
+            now[0] += seconds
+        bucket = TokenBucket(100, clock=lambda: now[0], sleep=sleep)
+        for _ in range(5):
+            bucket.take(100)
+        assert_true(abs(now[0] - 4.0) < 0.001)
+
+    def test_take_batch_larger_than_burst(self):
+        now = [0.0]
+        def sleep(seconds):
+            now[0] += seconds
+        bucket = TokenBucket(100, clock=lambda: now[0], sleep=sleep)
+        bucket.take(1000)
+        bucket.take(1000)
+        assert_true(abs(now[0] - 10.0) < 0.001)
+
+    def test_unlimited(self):
+        def sleep(seconds):
+            assert_true(False)
+        bucket = TokenBucket(None, sleep=sleep)
+        bucket.take(1000000)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import unittest
+from nose.tools import assert_true
+from src.services.completion_cache import CompletionCache
+
+class TestCompletionCache(unittest.TestCase):
+    def test_add_and_contains(self):
+        cache = CompletionCache(2)
+        assert_true(not cache.contains('asdf'))
+        cache.add('asdf')
+        assert_true(cache.contains('asdf'))
+
+    def test_evicts_least_recently_used(self):
+        cache = CompletionCache(2)
+        cache.add('a')
+        cache.add('b')
+        assert_true(cache.contains('a'))
+        cache.add('c')
+        assert_true(cache.contains('a') and cache.contains('c'))
+        assert_true(not cache.contains('b'))
+        assert_true(len(cache) == 2)
+
+    def test_discard(self):
+        cache = CompletionCache(2)
+        cache.add('a')
+        cache.discard('a')
+        cache.discard('missing')
+        assert_true(not cache.contains('a'))
+
+    def test_disabled(self):
+        cache = CompletionCache(0)
+        cache.add('a')
+        assert_true(not cache.contains('a'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,261 @@
+import errno
+import io
+import os
+import socket
+import tempfile
+import unittest
+from concurrent.futures.process import BrokenProcessPool
+from unittest.mock import Mock, patch
+from urllib.error import HTTPError, URLError
+from nose.tools import assert_true
+from PIL import Image
+from benchmarks import fakes
+
+ID = '6f1c4a3e-8c1b-4a43-9e0f-0c1a6f1e2d3b'
+URL = 'http://127.0.0.1/a.jpg'
+BATCH = {
+    '0b6f4c61-8a43-4c1f-9f2e-3a1d6c9e7b5a': 'http://127.0.0.1/b.jpg',
+    '6f1c4a3e-8c1b-4a43-9e0f-0c1a6f1e2d3b': 'http://127.0.0.1/a.jpg',
+    '9d2e7f10-3c4b-4a5d-8e6f-7a8b9c0d1e2f': 'http://127.0.0.1/c.jpg',
+}
+
+def setUpModule():
+    # consumer builds its services on import, so the fakes go in first. That
+    # puts src/services on sys.path, which is done here rather than at import
+    # so that other test modules still import the src.services ones. The
+    # exception classes come from the same flat modules the consumer uses.
+    global consumer, CompletionCache, Registry, Retry, Reject, ImageRejected, ImageUndecodable, DownloadTooLarge, HttpStatusError
+    fakes.install({}, [])
+    import consumer
+    from completion_cache import CompletionCache
+    from metrics import Registry
+    from messaging_service import Retry, Reject
+    from image_service import ImageRejected, ImageUndecodable
+    from fetch_service import DownloadTooLarge
+    from async_fetch_service import HttpStatusError
+
+class TestClassifyFailure(unittest.TestCase):
+    def classify(self, error, stage='fetch'):
+        failure = consumer.classify_failure(error, stage)
+        assert_true(failure.error is error)
+        return (failure.error_class, failure.transient)
+
+    def test_http(self):
+        url = 'http://127.0.0.1/a.jpg'
+        assert_true(self.classify(HTTPError(url, 404, 'Not Found', {}, None)) == ('http_404', False))
+        assert_true(self.classify(HTTPError(url, 503, 'Service Unavailable', {}, None)) == ('http_503', True))
+        assert_true(self.classify(HttpStatusError(url, 429)) == ('http_429', True))
+        assert_true(self.classify(HttpStatusError(url, 408)) == ('http_408', True))
+        assert_true(self.classify(HttpStatusError(url, 403)) == ('http_403', False))
+
+    def test_timeout(self):
+        assert_true(self.classify(socket.timeout('timed out')) == ('timeout', True))
+        assert_true(self.classify(URLError(socket.timeout('timed out'))) == ('timeout', True))
+
+    def test_network(self):
+        assert_true(self.classify(URLError(ConnectionRefusedError(errno.ECONNREFUSED, 'Connection refused'))) == ('network', True))
+        assert_true(self.classify(ConnectionResetError(errno.ECONNRESET, 'Connection reset by peer')) == ('network', True))
+
+    def test_too_large(self):
+        assert_true(self.classify(DownloadTooLarge('response exceeded the 1000 byte limit')) == ('too_large', False))
+
+    def test_rejected(self):
+        assert_true(self.classify(ImageRejected('too many pixels'), 'resize') == ('rejected', False))
+
+    def test_resize(self):
+        # Only bytes that cannot be decoded fail for good.
+        assert_true(self.classify(ImageUndecodable('cannot identify image file'), 'resize') == ('decode', False))
+        assert_true(self.classify(MemoryError(), 'resize') == ('resize', True))
+        assert_true(self.classify(BrokenProcessPool('a worker died'), 'resize') == ('resize', True))
+        assert_true(self.classify(FileNotFoundError(errno.ENOENT, 'No such file'), 'resize') == ('resize', True))
+
+    def test_write(self):
+        assert_true(self.classify(OSError(errno.ENOSPC, 'No space left on device'), 'write') == ('write', True))
+
+class TestVerdict(unittest.TestCase):
+    def test_retry_message(self):
+        assert_true(consumer.retry_message(['a'], False) == 'a')
+        assert_true(consumer.retry_message(['a'], True) == { 'uuid': 'a', 'force': True })
+        assert_true(consumer.retry_message(['a', 'b'], False) == { 'uuids': ['a', 'b'] })
+        assert_true(consumer.retry_message(['a', 'b'], True) == { 'uuids': ['a', 'b'], 'force': True })
+
+    def test_success(self):
+        assert_true(consumer.verdict({}, False) == True)
+
+    def test_splits_batch(self):
+        # The transient failures are retried together and the permanent ones
+        # dead-lettered; photos that succeeded appear in neither.
+        failures = {
+            'd': consumer.Failure('timeout', True, None),
+            'b': consumer.Failure('http_503', True, None),
+            'c': consumer.Failure('decode', False, None),
+        }
+        retry, reject = consumer.verdict(failures, False)
+        assert_true(type(retry) is Retry and retry.message == { 'uuids': ['b', 'd'] } and retry.error_class == 'http_503,timeout')
+        assert_true(type(reject) is Reject and reject.message == 'c' and reject.error_class == 'decode')
+
+    def test_permanent_only(self):
+        result = consumer.verdict({ 'a': consumer.Failure('too_large', False, None) }, True)
+        assert_true(len(result) == 1 and type(result[0]) is Reject)
+        assert_true(result[0].message == { 'uuid': 'a', 'force': True } and result[0].error_class == 'too_large')
+
+class TestSourceCacheMetrics(unittest.TestCase):
+    def test_exported(self):
+        registry = Registry()
+        with tempfile.TemporaryDirectory() as directory:
+            with patch.dict(os.environ, { 'SOURCE_CACHE_DIR': directory }), patch.object(consumer, 'registry', registry):
+                cache = consumer.build_source_cache()
+            cache.store(URL, b'original', etag='"a"')
+            cache.not_modified(URL)
+            lines = registry.render().splitlines()
+        assert_true('photo_processor_source_cache_total{outcome="misses"} 1' in lines)
+        assert_true('photo_processor_source_cache_total{outcome="revalidations"} 1' in lines)
+        assert_true('photo_processor_source_cache_total{outcome="evictions"} 0' in lines)
+        assert_true('photo_processor_source_cache_bytes 8' in lines)
+
+    def test_disabled(self):
+        registry = Registry()
+        with patch.dict(os.environ, { 'SOURCE_CACHE_DIR': '' }), patch.object(consumer, 'registry', registry):
+            assert_true(consumer.build_source_cache() is None)
+        assert_true('source_cache' not in registry.render())
+
+class ConsumerTestCase(unittest.TestCase):
+    # Thumbnails go to a temporary directory, with an empty completion cache
+    # and a fresh fake database.
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db_service = fakes.FakeDbService()
+        self.db_service.urls = { ID: URL }
+        self.completion_cache = CompletionCache(10)
+        self.patches = [
+            patch.object(consumer, 'thumbnail_dir', self.directory.name),
+            patch.object(consumer, 'db_service', self.db_service),
+            patch.object(consumer, 'completion_cache', self.completion_cache),
+        ]
+        for patcher in self.patches:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in reversed(self.patches):
+            patcher.stop()
+        self.directory.cleanup()
+
+    def render(self, id):
+        # As if the photo had been processed with the current profile.
+        rows = []
+        for (width, height), path in zip(consumer.thumbnail_sizes, consumer.build_thumbnail_paths(id)):
+            with open(path, 'wb') as thumbnail:
+                thumbnail.write(b'thumbnail')
+            rows.append((width, height, path))
+        self.db_service.thumbnails[id] = rows
+        return rows
+
+class TestAlreadyProcessed(ConsumerTestCase):
+    def test_skipped(self):
+        self.render(ID)
+        assert_true(consumer.find_already_processed([ID]) == set([ID]))
+        assert_true(consumer.claim_records([ID], False) == [])
+        # Remembered, so the next check does not ask the database.
+        self.db_service.thumbnails = {}
+        assert_true(self.completion_cache.contains(ID) and consumer.find_already_processed([ID]) == set([ID]))
+
+    def test_not_processed(self):
+        assert_true(consumer.find_already_processed([ID]) == set())
+        assert_true([record['uuid'] for record in consumer.claim_records([ID], False)] == [ID])
+
+    def test_missing_file(self):
+        rows = self.render(ID)
+        os.remove(rows[0][2])
+        assert_true(consumer.find_already_processed([ID]) == set() and not self.completion_cache.contains(ID))
+
+    def test_profile_changed(self):
+        # Rendered as JPEG; a WebP profile writes other paths.
+        self.render(ID)
+        with patch.object(consumer.image_service, 'profile', Mock(extension='webp')):
+            assert_true(consumer.find_already_processed([ID]) == set())
+
+    def test_force(self):
+        self.render(ID)
+        self.completion_cache.add(ID)
+        assert_true([record['uuid'] for record in consumer.claim_records([ID], True)] == [ID])
+        assert_true(not self.completion_cache.contains(ID))
+
+    def test_uppercase_id(self):
+        self.render(ID)
+        ids, force = consumer.parse_message(ID.upper())
+        assert_true(ids == [ID] and consumer.find_already_processed(ids) == set([ID]))
+
+class TestFinishRecords(ConsumerTestCase):
+    def fail_calls(self, completed, failures):
+        stage_seconds = Mock(wraps=consumer.stage_seconds)
+        with patch.object(consumer, 'stage_seconds', stage_seconds), patch.object(self.db_service, 'fail', wraps=self.db_service.fail) as fail:
+            consumer.finish_records(completed, failures)
+        stages = [call[1]['stage'] for call in stage_seconds.time.call_args_list]
+        return (fail.call_count, stages)
+
+    def test_no_failures(self):
+        assert_true(self.fail_calls({ ID: [] }, {}) == (0, ['db_complete']))
+
+    def test_failures(self):
+        failures = { ID: consumer.Failure('timeout', True, None) }
+        assert_true(self.fail_calls({}, failures) == (1, ['db_complete', 'db_fail']))
+        assert_true(self.db_service.failed == [ID])
+
+class TestBatch(ConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db_service.urls = dict(BATCH)
+        self.claims = []
+        claim = self.db_service.claim
+        def counted_claim(ids, **kwargs):
+            self.claims.append(list(ids))
+            return claim(ids, **kwargs)
+        self.db_service.claim = counted_claim
+        # The first photo times out, the second is not an image and the third
+        # is resized and written for real.
+        self.timed_out, self.undecodable, self.processed = sorted(BATCH)
+        original = io.BytesIO()
+        Image.new('RGB', (640, 480)).save(original, 'JPEG')
+        sources = {
+            self.undecodable: b'not an image',
+            self.processed: original.getvalue(),
+        }
+        def fetch_record(record):
+            if record['uuid'] == self.timed_out:
+                raise socket.timeout('timed out')
+            return io.BytesIO(sources[record['uuid']])
+        self.patches.append(patch.object(consumer, 'fetch_record', fetch_record))
+        self.patches[-1].start()
+
+    def test_parse_message(self):
+        assert_true(consumer.parse_message(ID) == ([ID], False))
+        assert_true(consumer.parse_message({ 'uuid': ID, 'force': True }) == ([ID], True))
+        assert_true(consumer.parse_message({ 'uuids': sorted(BATCH) }) == (sorted(BATCH), False))
+        assert_true(consumer.parse_message({ 'uuids': [id.upper() for id in sorted(BATCH)], 'force': True }) == (sorted(BATCH), True))
+
+    def check_outcome(self, result, force=False):
+        assert_true(self.claims == [sorted(BATCH)])
+        retry, reject = result
+        assert_true(type(retry) is Retry and retry.message == consumer.retry_message([self.timed_out], force) and retry.error_class == 'timeout')
+        assert_true(type(reject) is Reject and reject.message == consumer.retry_message([self.undecodable], force) and reject.error_class == 'decode')
+        assert_true(list(self.db_service.completed) == [self.processed])
+        assert_true(sorted(self.db_service.failed) == [self.timed_out, self.undecodable])
+        assert_true(all(os.path.exists(path) for path in consumer.build_thumbnail_paths(self.processed)))
+
+    def test_callback(self):
+        self.check_outcome(consumer.callback({ 'uuids': sorted(BATCH) }))
+
+    def test_stages(self):
+        # The pipeline's stages, one after the other, settle it the same way.
+        batch = consumer.fetch_stage({ 'uuids': sorted(BATCH), 'force': True })
+        self.check_outcome(consumer.write_stage(consumer.resize_stage(batch)), True)
+
+    def test_retry_skips_processed(self):
+        # Redelivered, the batch does not claim the processed photo again.
+        consumer.callback({ 'uuids': sorted(BATCH) })
+        self.claims = []
+        consumer.callback({ 'uuids': sorted(BATCH) })
+        assert_true(self.claims == [[self.timed_out, self.undecodable]])
+
+if __name__ == '__main__':
+    unittest.main()
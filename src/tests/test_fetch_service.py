@@ -1,7 +1,21 @@
+import os
+import tempfile
 import unittest
 from unittest.mock import Mock, patch
 from nose.tools import assert_true
-from src.services.fetch_service import FetchService
+from src.services.fetch_service import FetchService, DownloadTooLarge
+from src.services.source_cache import SourceCache
+from src.tests.stand_in_server import StandInServer
+
+def create_etag_route(body, etag):
+    def route(handler):
+        if handler.headers.get('If-None-Match') == etag:
+            handler.send_response(304)
+            handler.send_header('ETag', etag)
+            handler.end_headers()
+        else:
+            handler.send_body(body, headers={ 'ETag': etag })
+    return route
 
 class MockUrllibRequest(object):
     def __init__(self, behavior = {}):
@@ -12,6 +26,20 @@ class MockUrllibRequest(object):
         if self._do_throw('urlretrieve'):
             raise Exception('exception:urlretrieve')
 
+class MockHttpResponse(object):
+    def __init__(self, body, headers = {}):
+        self.body = body
+        self.position = 0
+        self.headers = headers
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        return False
+    def read(self, size):
+        chunk = self.body[self.position:self.position + size]
+        self.position += len(chunk)
+        return chunk
+
 class TestFetchService(unittest.TestCase):
     @patch('src.services.fetch_service.urllib.request')
     def test_success(self, mock_urllib_request):
@@ -34,5 +62,89 @@ class TestFetchService(unittest.TestCase):
         except Exception as ex:
             assert_true(str(ex) == 'exception:urlretrieve')
 
+    @patch('src.services.fetch_service.urllib.request')
+    def test_fetch(self, mock_urllib_request):
+        body = b'x' * 200000
+        mock_urllib_request.urlopen.return_value = MockHttpResponse(body, { 'Content-Length': str(len(body)) })
+        fetch_service = FetchService()
+        response = fetch_service.fetch('www.google.com')
+        assert_true(response.tell() == 0)
+        assert_true(response.read() == body)
+
+    @patch('src.services.fetch_service.urllib.request')
+    def test_fetch_rejects_content_length(self, mock_urllib_request):
+        response = MockHttpResponse(b'x' * 100, { 'Content-Length': '100' })
+        mock_urllib_request.urlopen.return_value = response
+        fetch_service = FetchService(max_bytes=10)
+        try:
+            fetch_service.fetch('www.google.com')
+            assert_true(False)
+        except DownloadTooLarge:
+            assert_true(response.position == 0)
+
+    @patch('src.services.fetch_service.urllib.request')
+    def test_fetch_rejects_streamed_size(self, mock_urllib_request):
+        mock_urllib_request.urlopen.return_value = MockHttpResponse(b'x' * 200000)
+        fetch_service = FetchService(max_bytes=100000)
+        try:
+            fetch_service.fetch('www.google.com')
+            assert_true(False)
+        except DownloadTooLarge:
+            assert_true(True)
+
+    @patch('src.services.fetch_service.urllib.request')
+    def test_fetch_failure(self, mock_urllib_request):
+        mock_urllib_request.urlopen.side_effect = Exception('exception:urlopen')
+        fetch_service = FetchService()
+        try:
+            fetch_service.fetch('www.google.com')
+            assert_true(False)
+        except Exception as ex:
+            assert_true(str(ex) == 'exception:urlopen')
+
+class TestFetchServiceCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_fetch_revalidates(self):
+        cache = SourceCache(self.directory.name, 1000000)
+        with StandInServer({ '/photo.jpg': create_etag_route(b'photo', '"v1"') }) as server:
+            fetch_service = FetchService(cache=cache)
+            assert_true(fetch_service.fetch(server.url('/photo.jpg')).read() == b'photo')
+            assert_true(fetch_service.fetch(server.url('/photo.jpg')).read() == b'photo')
+            assert_true(server.requests[1][1].get('If-None-Match') == '"v1"')
+        stats = cache.stats()
+        assert_true(stats['misses'] == 1 and stats['revalidations'] == 1)
+
+    def test_fetch_fresh_skips_origin(self):
+        cache = SourceCache(self.directory.name, 1000000, fresh_for=60)
+        with StandInServer({ '/photo.jpg': create_etag_route(b'photo', '"v1"') }) as server:
+            fetch_service = FetchService(cache=cache)
+            fetch_service.fetch(server.url('/photo.jpg'))
+            assert_true(fetch_service.fetch(server.url('/photo.jpg')).read() == b'photo')
+            assert_true(len(server.requests) == 1)
+        assert_true(cache.stats()['hits'] == 1)
+
+    def test_fetch_changed(self):
+        cache = SourceCache(self.directory.name, 1000000)
+        routes = { '/photo.jpg': create_etag_route(b'photo', '"v1"') }
+        with StandInServer(routes) as server:
+            fetch_service = FetchService(cache=cache)
+            fetch_service.fetch(server.url('/photo.jpg'))
+            routes['/photo.jpg'] = create_etag_route(b'new photo', '"v2"')
+            assert_true(fetch_service.fetch(server.url('/photo.jpg')).read() == b'new photo')
+        assert_true(cache.validators(server.url('/photo.jpg')) == { 'If-None-Match': '"v2"' })
+
+    def test_download_with_cache(self):
+        cache = SourceCache(os.path.join(self.directory.name, 'cache'), 1000000)
+        destination = os.path.join(self.directory.name, 'photo.jpg')
+        with StandInServer({ '/photo.jpg': create_etag_route(b'photo', '"v1"') }) as server:
+            FetchService(cache=cache).download(server.url('/photo.jpg'), destination)
+        with open(destination, 'rb') as downloaded:
+            assert_true(downloaded.read() == b'photo')
+
 if __name__ == '__main__':
     unittest.main()
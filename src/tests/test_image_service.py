@@ -1,14 +1,32 @@
+import io
+import os
+import tempfile
 import unittest
 from pprint import pprint
 from unittest.mock import Mock, patch
 from nose.tools import assert_true
-from src.services.image_service import ImageService
+from PIL import Image
+from src.services.image_service import ImageService, ProcessPoolImageService, ImageRejected, ImageUndecodable, resize_bytes, open_for_thumbnail, render_thumbnails, resize_all_bytes, inspect, EncoderProfile, parse_profile, write_atomically
+from src.services.admission_controller import AdmissionController
+
+def create_image_bytes(size, format='JPEG'):
+    output = io.BytesIO()
+    Image.new('RGB', size, (200, 40, 40)).save(output, format)
+    return output.getvalue()
+
+def create_jpeg_bytes(size):
+    return create_image_bytes(size, 'JPEG')
 
 class MockImageOperator(object):
     def __init__(self, behavior = {}):
         self._behavior = behavior
+        self.format = 'JPEG'
+        self.mode = 'RGB'
+        self.draft_size = None
     def _do_throw(self, method_name):
         return method_name in self._behavior and self._behavior[method_name] is 'throw'
+    def draft(self, mode, size):
+        self.draft_size = size
     def thumbnail(self, dimensions, alias_type):
         if self._do_throw('thumbnail'):
             raise Exception('exception:thumbnail')
@@ -28,13 +46,23 @@ class MockImage(object):
             raise Exception('exception:open')
         return MockImageOperator(self._behavior)
 
-class TestImageService(unittest.TestCase):
+class TemporaryOutputTestCase(unittest.TestCase):
+    # The mocked Image writes nothing, but the (empty) result is still
+    # renamed into place.
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.output_path = os.path.join(self.directory.name, 'bar.txt')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+class TestImageService(TemporaryOutputTestCase):
     @patch('src.services.image_service.Image')
     def test_success(self, mock_pil):
         mock_pil.return_value = MockImage()
         image_service = ImageService()
         try:
-            response = image_service.resize((1,2), '/foo.txt', '/bar.txt')
+            response = image_service.resize((1,2), '/foo.txt', self.output_path)
             assert_true(response is None)
         except:
             assert_true(False)
@@ -47,7 +75,7 @@ class TestImageService(unittest.TestCase):
 
         image_service = ImageService()
         try:
-            response = image_service.resize((1,2), '/foo.txt', '/bar.txt')
+            response = image_service.resize((1,2), '/foo.txt', self.output_path)
             assert_true(False)
         except Exception as ex:
             assert_true(str(ex) == 'exception:open')
@@ -60,7 +88,7 @@ class TestImageService(unittest.TestCase):
 
         image_service = ImageService()
         try:
-            response = image_service.resize((1,2), '/foo.txt', '/bar.txt')
+            response = image_service.resize((1,2), '/foo.txt', self.output_path)
             assert_true(False)
         except Exception as ex:
             assert_true(str(ex) == 'exception:thumbnail')
@@ -73,10 +101,326 @@ class TestImageService(unittest.TestCase):
 
         image_service = ImageService()
         try:
-            response = image_service.resize((1,2), '/foo.txt', '/bar.txt')
+            response = image_service.resize((1,2), '/foo.txt', self.output_path)
             assert_true(False)
         except Exception as ex:
             assert_true(str(ex) == 'exception:save')
 
+class TestDraftDecode(TemporaryOutputTestCase):
+    @patch('src.services.image_service.Image')
+    def test_draft_for_jpeg(self, mock_pil):
+        operator = MockImageOperator()
+        mock_pil.open.return_value = operator
+        ImageService().resize((320, 240), '/foo.txt', self.output_path)
+        assert_true(operator.draft_size == (640, 480))
+
+    @patch('src.services.image_service.Image')
+    def test_no_draft_for_other_formats(self, mock_pil):
+        operator = MockImageOperator()
+        operator.format = 'PNG'
+        mock_pil.open.return_value = operator
+        ImageService().resize((320, 240), '/foo.txt', self.output_path)
+        assert_true(operator.draft_size is None)
+
+    @patch('src.services.image_service.Image')
+    def test_draft_disabled(self, mock_pil):
+        operator = MockImageOperator()
+        mock_pil.open.return_value = operator
+        ImageService(reducing_gap=None).resize((320, 240), '/foo.txt', self.output_path)
+        assert_true(operator.draft_size is None)
+
+    def test_invalid_reducing_gap(self):
+        try:
+            ImageService(reducing_gap=0.5)
+            assert_true(False)
+        except ValueError:
+            assert_true(True)
+
+    def test_draft_keeps_reducing_gap(self):
+        img = open_for_thumbnail(io.BytesIO(create_jpeg_bytes((2000, 1600))), (320, 320), 2.0)
+        assert_true(img.size == (1000, 800))
+        img = open_for_thumbnail(io.BytesIO(create_jpeg_bytes((2000, 1600))), (320, 320), 4.0)
+        assert_true(img.size == (2000, 1600))
+
+    def test_draft_output_matches_full_decode(self):
+        source = create_jpeg_bytes((2000, 1600))
+        drafted = Image.open(io.BytesIO(resize_bytes((320, 320), source)))
+        full = Image.open(io.BytesIO(resize_bytes((320, 320), source, reducing_gap=None)))
+        assert_true(drafted.size == full.size == (320, 256))
+        assert_true(max(abs(a - b) for a, b in zip(drafted.getpixel((160, 128)), full.getpixel((160, 128)))) <= 4)
+
+    def test_png_is_not_drafted(self):
+        img = open_for_thumbnail(io.BytesIO(create_image_bytes((2000, 1600), 'PNG')), (320, 320), 2.0)
+        assert_true(img.size == (2000, 1600))
+
+class TestResizeStream(unittest.TestCase):
+    def test_resize_stream(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output_path = os.path.join(directory, 'output.jpeg')
+            ImageService().resize((10, 10), io.BytesIO(create_jpeg_bytes((50, 100))), output_path)
+            assert_true(Image.open(output_path).size == (5, 10))
+
+class TestRenditions(unittest.TestCase):
+    def test_render_thumbnails(self):
+        img = Image.new('RGB', (1000, 500))
+        renditions = render_thumbnails(img, [(320, 320), (640, 640), (64, 64)])
+        assert_true([rendition.size for rendition in renditions] == [(320, 160), (640, 320), (64, 32)])
+
+    def test_render_thumbnails_orders_by_scale(self):
+        # 640x100 needs more of a wide source than 320x320 does, despite its
+        # smaller area, so it must not be derived from the 320x320 rendition.
+        img = Image.new('RGB', (2000, 200))
+        renditions = render_thumbnails(img, [(320, 320), (640, 100)])
+        assert_true([rendition.size for rendition in renditions] == [(320, 32), (640, 64)])
+
+    def test_render_thumbnails_small_source(self):
+        img = Image.new('RGB', (100, 100))
+        renditions = render_thumbnails(img, [(320, 320), (64, 64)])
+        assert_true([rendition.size for rendition in renditions] == [(100, 100), (64, 64)])
+
+    def test_resize_all(self):
+        with tempfile.TemporaryDirectory() as directory:
+            renditions = [((320, 320), os.path.join(directory, 'a.jpeg')), ((32, 32), os.path.join(directory, 'b.jpeg'))]
+            response = ImageService().resize_all(renditions, io.BytesIO(create_jpeg_bytes((1280, 640))))
+            assert_true(response is None)
+            assert_true(Image.open(renditions[0][1]).size == (320, 160))
+            assert_true(Image.open(renditions[1][1]).size == (32, 16))
+
+    @patch('src.services.image_service.Image')
+    def test_resize_all_decodes_once(self, mock_pil):
+        mock_pil.open.return_value.size = (1000, 1000)
+        with tempfile.TemporaryDirectory() as directory:
+            ImageService().resize_all([((320, 320), os.path.join(directory, 'a.jpeg')), ((32, 32), os.path.join(directory, 'b.jpeg'))], '/foo.txt')
+        mock_pil.open.assert_called_once_with('/foo.txt')
+
+    def test_resize_all_reports_stages(self):
+        observed = []
+        with tempfile.TemporaryDirectory() as directory:
+            renditions = [((32, 32), os.path.join(directory, 'a.jpeg'))]
+            ImageService(observe=lambda stage, seconds: observed.append((stage, seconds))).resize_all(renditions, io.BytesIO(create_jpeg_bytes((256, 128))))
+        assert_true(sorted(stage for stage, seconds in observed) == ['decode', 'encode', 'resize', 'write'])
+        assert_true(all(seconds >= 0 for stage, seconds in observed))
+
+    def test_resize_all_bytes(self):
+        thumbnails = resize_all_bytes([(64, 64), (16, 16)], create_jpeg_bytes((256, 128)))
+        assert_true([Image.open(io.BytesIO(thumbnail)).size for thumbnail in thumbnails] == [(64, 32), (16, 8)])
+
+class TestAtomicWrites(unittest.TestCase):
+    def test_write_replaces(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output_path = os.path.join(directory, 'a.jpeg')
+            write_atomically(output_path, b'old')
+            write_atomically(output_path, b'new')
+            with open(output_path, 'rb') as output_file:
+                assert_true(output_file.read() == b'new')
+            assert_true(os.listdir(directory) == ['a.jpeg'])
+
+    def test_failed_write_keeps_previous(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output_path = os.path.join(directory, 'a.jpeg')
+            write_atomically(output_path, b'old')
+            try:
+                write_atomically(output_path, 'not bytes')
+                assert_true(False)
+            except TypeError:
+                pass
+            with open(output_path, 'rb') as output_file:
+                assert_true(output_file.read() == b'old')
+            assert_true(os.listdir(directory) == ['a.jpeg'])
+
+class TestResizeBytes(unittest.TestCase):
+    def test_resize_bytes(self):
+        thumbnail = Image.open(io.BytesIO(resize_bytes((32, 32), create_jpeg_bytes((128, 64)))))
+        assert_true(thumbnail.format == 'JPEG')
+        assert_true(thumbnail.size == (32, 16))
+
+    def test_resize_bytes_fails(self):
+        try:
+            resize_bytes((32, 32), b'not an image')
+            assert_true(False)
+        except ImageUndecodable:
+            pass
+
+    def test_truncated_source(self):
+        data = create_image_bytes((256, 128), 'PNG')
+        try:
+            ImageService().encode_renditions([(32, 32)], io.BytesIO(data[:len(data) // 2]))
+            assert_true(False)
+        except ImageUndecodable:
+            pass
+
+    def test_missing_source_is_not_undecodable(self):
+        # Only bytes Pillow cannot decode are; a missing file is an OSError.
+        try:
+            ImageService().encode_renditions([(32, 32)], '/nonexistent/source.jpg')
+            assert_true(False)
+        except FileNotFoundError:
+            pass
+
+class TestEncoderProfile(unittest.TestCase):
+    def test_default_matches_plain_save(self):
+        img = Image.open(io.BytesIO(create_jpeg_bytes((64, 64))))
+        output = io.BytesIO()
+        EncoderProfile().save(img, output)
+        plain = io.BytesIO()
+        img.save(plain, 'JPEG')
+        assert_true(output.getvalue() == plain.getvalue())
+
+    def test_parse_named(self):
+        profile = parse_profile('small')
+        assert_true(profile.format == 'JPEG' and profile.optimize and profile.progressive)
+        assert_true(parse_profile('small:quality=60,progressive=0').quality == 60)
+        assert_true(not parse_profile('small:progressive=0').progressive)
+
+    def test_parse_format(self):
+        profile = parse_profile('jpeg:quality=85,optimize,subsampling=4:4:4,keep_icc')
+        assert_true(profile.quality == 85 and profile.optimize and profile.subsampling == '4:4:4' and profile.keep_icc)
+        assert_true(parse_profile('webp').extension == 'webp')
+
+    def test_parse_invalid(self):
+        for value in ('gif', 'jpeg:quality=101', 'jpeg:subsampling=4:1:1', 'jpeg:colour=red'):
+            try:
+                parse_profile(value)
+                assert_true(False)
+            except ValueError:
+                pass
+
+    def test_progressive(self):
+        image_service = ImageService(profile=parse_profile('small'))
+        thumbnail = Image.open(io.BytesIO(image_service.resize_bytes((32, 32), create_jpeg_bytes((100, 100)))))
+        assert_true(thumbnail.info.get('progressive') == 1)
+
+    def test_webp(self):
+        image_service = ImageService(profile=parse_profile('webp'))
+        thumbnails = image_service.encode_renditions([(32, 32), (16, 16)], io.BytesIO(create_jpeg_bytes((100, 100))))
+        assert_true([Image.open(io.BytesIO(thumbnail)).format for thumbnail in thumbnails] == ['WEBP', 'WEBP'])
+
+    def test_icc_stripped_unless_kept(self):
+        source = io.BytesIO()
+        Image.new('RGB', (100, 100)).save(source, 'JPEG', icc_profile=b'not really a profile')
+        stripped = ImageService().resize_bytes((32, 32), source.getvalue())
+        kept = ImageService(profile=parse_profile('jpeg:keep_icc')).resize_bytes((32, 32), source.getvalue())
+        assert_true(Image.open(io.BytesIO(stripped)).info.get('icc_profile') is None)
+        assert_true(Image.open(io.BytesIO(kept)).info.get('icc_profile') == b'not really a profile')
+
+    def test_process_pool_profile(self):
+        image_service = ProcessPoolImageService(1, profile=parse_profile('webp'))
+        try:
+            thumbnail = image_service.resize_bytes((32, 32), create_jpeg_bytes((100, 100)))
+            assert_true(Image.open(io.BytesIO(thumbnail)).format == 'WEBP')
+        finally:
+            image_service.shutdown()
+
+class TestAdmission(unittest.TestCase):
+    def test_inspect_reads_header_only(self):
+        source = io.BytesIO(create_image_bytes((400, 300), 'PNG'))
+        pixels, cost = inspect(source, [(40, 40)])
+        assert_true(pixels == 400 * 300)
+        assert_true(cost == 400 * 300 * 4 + 40 * 30 * 4)
+        assert_true(source.tell() == 0)
+
+    def test_inspect_accounts_for_draft(self):
+        pixels, cost = inspect(io.BytesIO(create_jpeg_bytes((800, 800))), [(40, 40)])
+        assert_true(pixels == 800 * 800)
+        assert_true(cost == 100 * 100 * 4 + 40 * 40 * 4)
+
+    def test_rejects_over_max_pixels(self):
+        image_service = ImageService(max_pixels=100 * 100)
+        try:
+            image_service.encode_renditions([(10, 10)], io.BytesIO(create_jpeg_bytes((101, 100))))
+            assert_true(False)
+        except ImageRejected:
+            pass
+        assert_true(len(image_service.encode_renditions([(10, 10)], io.BytesIO(create_jpeg_bytes((100, 100))))) == 1)
+
+    def test_rejects_over_budget(self):
+        image_service = ImageService(admission=AdmissionController(1000))
+        try:
+            image_service.encode_renditions([(10, 10)], io.BytesIO(create_image_bytes((100, 100), 'PNG')))
+            assert_true(False)
+        except ImageRejected:
+            pass
+
+    def test_admitted_within_budget(self):
+        admission = AdmissionController(1024 * 1024)
+        observed = []
+        image_service = ImageService(observe=lambda stage, seconds: observed.append(stage), admission=admission)
+        thumbnails = image_service.encode_renditions([(10, 10)], io.BytesIO(create_image_bytes((100, 100), 'PNG')))
+        assert_true(len(thumbnails) == 1)
+        assert_true('admit' in observed)
+        assert_true(admission.stats()['in_flight'] == 0)
+
+    def test_process_pool_rejects(self):
+        image_service = ProcessPoolImageService(1, max_pixels=100 * 100)
+        try:
+            image_service.encode_renditions([(10, 10)], io.BytesIO(create_jpeg_bytes((200, 200))))
+            assert_true(False)
+        except ImageRejected:
+            pass
+        finally:
+            image_service.shutdown()
+
+class TestProcessPoolImageService(unittest.TestCase):
+    def setUp(self):
+        self.image_service = ProcessPoolImageService(2)
+
+    def tearDown(self):
+        self.image_service.shutdown()
+
+    def test_sized_to_cores(self):
+        image_service = ProcessPoolImageService()
+        try:
+            assert_true(image_service.processes == os.cpu_count())
+        finally:
+            image_service.shutdown()
+
+    def test_resize_bytes(self):
+        thumbnail = self.image_service.resize_bytes((32, 32), create_jpeg_bytes((64, 128)))
+        assert_true(Image.open(io.BytesIO(thumbnail)).size == (16, 32))
+
+    def test_resize(self):
+        with tempfile.TemporaryDirectory() as directory:
+            input_path = os.path.join(directory, 'input.jpg')
+            output_path = os.path.join(directory, 'output.jpeg')
+            with open(input_path, 'wb') as source:
+                source.write(create_jpeg_bytes((100, 100)))
+            response = self.image_service.resize((10, 10), input_path, output_path)
+            assert_true(response is None)
+            assert_true(Image.open(output_path).size == (10, 10))
+
+    def test_resize_stream(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output_path = os.path.join(directory, 'output.jpeg')
+            self.image_service.resize((10, 10), io.BytesIO(create_jpeg_bytes((100, 50))), output_path)
+            assert_true(Image.open(output_path).size == (10, 5))
+
+    def test_resize_all(self):
+        with tempfile.TemporaryDirectory() as directory:
+            renditions = [((20, 20), os.path.join(directory, 'a.jpeg')), ((10, 10), os.path.join(directory, 'b.jpeg'))]
+            self.image_service.resize_all(renditions, io.BytesIO(create_jpeg_bytes((100, 100))))
+            assert_true(Image.open(renditions[0][1]).size == (20, 20))
+            assert_true(Image.open(renditions[1][1]).size == (10, 10))
+
+    def test_resize_all_reports_stages(self):
+        observed = []
+        self.image_service.observe = lambda stage, seconds: observed.append(stage)
+        with tempfile.TemporaryDirectory() as directory:
+            self.image_service.resize_all([((10, 10), os.path.join(directory, 'a.jpeg'))], io.BytesIO(create_jpeg_bytes((100, 100))))
+        assert_true(sorted(observed) == ['decode', 'encode', 'resize', 'write'])
+
+    def test_resize_fails(self):
+        try:
+            self.image_service.resize_bytes((10, 10), b'not an image')
+            assert_true(False)
+        except ImageUndecodable:
+            pass
+
+    def test_encode_renditions_fails(self):
+        try:
+            self.image_service.encode_renditions([(10, 10)], io.BytesIO(b'not an image'))
+            assert_true(False)
+        except ImageUndecodable:
+            pass
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,61 @@
+import json
+import unittest
+from datetime import datetime, timezone, timedelta
+from uuid import UUID
+from unittest.mock import patch
+from nose.tools import assert_true
+from src.services import json_encoding
+from src.services.json_encoding import http_date, stdlib_dumps, orjson_dumps, select_dumps
+
+ROW = {
+    'uuid': UUID('6f1c4a3e-8c1b-4a43-9e0f-0c1a6f1e2d3b'),
+    'url': 'http://a/0.jpg',
+    'status': 'pending',
+    'created_at': datetime(2019, 4, 22, 10, 32, 52, 123456, tzinfo=timezone.utc),
+}
+
+class TestJsonEncoding(unittest.TestCase):
+    def test_http_date(self):
+        assert_true(http_date(ROW['created_at']) == 'Mon, 22 Apr 2019 10:32:52 GMT')
+        eastern = ROW['created_at'].astimezone(timezone(timedelta(hours=-4)))
+        assert_true(http_date(eastern) == 'Mon, 22 Apr 2019 10:32:52 GMT')
+        assert_true(http_date(datetime(2019, 4, 22, 10, 32, 52)) == 'Mon, 22 Apr 2019 10:32:52 GMT')
+
+    def test_stdlib_dumps(self):
+        encoded = json.loads(stdlib_dumps([ROW]).decode('utf-8'))
+        assert_true(encoded == [{
+            'uuid': '6f1c4a3e-8c1b-4a43-9e0f-0c1a6f1e2d3b',
+            'url': 'http://a/0.jpg',
+            'status': 'pending',
+            'created_at': 'Mon, 22 Apr 2019 10:32:52 GMT',
+        }])
+
+    def test_unsupported_type(self):
+        try:
+            stdlib_dumps({ 'value': object() })
+            assert_true(False)
+        except TypeError:
+            pass
+
+    @unittest.skipIf(json_encoding.orjson is None, 'orjson is not installed')
+    def test_orjson_matches_stdlib(self):
+        assert_true(json.loads(orjson_dumps([ROW])) == json.loads(stdlib_dumps([ROW])))
+
+    def test_select_dumps(self):
+        assert_true(select_dumps('stdlib') is stdlib_dumps)
+        expected = stdlib_dumps if json_encoding.orjson is None else orjson_dumps
+        assert_true(select_dumps(None) is expected and select_dumps('auto') is expected)
+        try:
+            select_dumps('simplejson')
+            assert_true(False)
+        except ValueError:
+            pass
+
+    def test_select_orjson_when_missing(self):
+        with patch.object(json_encoding, 'orjson', None):
+            assert_true(select_dumps('auto') is stdlib_dumps)
+            try:
+                select_dumps('orjson')
+                assert_true(False)
+            except ValueError:
+                pass
@@ -0,0 +1,40 @@
+import unittest
+from nose.tools import assert_true
+from src.services.lease_keeper import LeaseKeeper
+
+class TestLeaseKeeper(unittest.TestCase):
+    def test_renews_held(self):
+        renewed = []
+        keeper = LeaseKeeper(lambda ids, lease_seconds: renewed.append((ids, lease_seconds)), 90)
+        assert_true(keeper.interval == 30)
+        assert_true(keeper.renew_once() == 0)
+        keeper.hold(['b', 'a'])
+        keeper.hold(['c'])
+        keeper.release(['b'])
+        assert_true(keeper.renew_once() == 2)
+        assert_true(renewed == [(['a', 'c'], 90)])
+
+    def test_renew_fails(self):
+        def renew(ids, lease_seconds):
+            raise Exception('exception:renew')
+        keeper = LeaseKeeper(renew, 90)
+        keeper.hold(['a'])
+        assert_true(keeper.renew_once() == 0)
+        assert_true(len(keeper) == 1)
+
+    def test_background(self):
+        renewed = []
+        keeper = LeaseKeeper(lambda ids, lease_seconds: renewed.append(ids), 90, interval=0.01)
+        keeper.hold(['a'])
+        keeper.start()
+        try:
+            for _ in range(500):
+                if len(renewed) >= 2:
+                    break
+                keeper.stopping.wait(0.01)
+        finally:
+            keeper.stop()
+        assert_true(renewed[:2] == [['a'], ['a']])
+
+if __name__ == '__main__':
+    unittest.main()
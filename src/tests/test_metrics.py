@@ -0,0 +1,127 @@
+import os
+import tempfile
+import unittest
+from urllib.request import urlopen
+from nose.tools import assert_true
+from src.services.metrics import Registry, merge, read_snapshots, start_http_server, write_snapshot
+
+class TestMetrics(unittest.TestCase):
+    def test_counter(self):
+        registry = Registry()
+        counter = registry.counter('photos_total', 'Photos.', ('outcome',))
+        counter.inc(outcome='processed')
+        counter.inc(2, outcome='processed')
+        counter.inc(outcome='failed')
+        lines = registry.render().splitlines()
+        assert_true(lines[:2] == ['# HELP photos_total Photos.', '# TYPE photos_total counter'])
+        assert_true('photos_total{outcome="processed"} 3' in lines)
+        assert_true('photos_total{outcome="failed"} 1' in lines)
+
+    def test_counter_requires_labels(self):
+        counter = Registry().counter('photos_total', 'Photos.', ('outcome',))
+        try:
+            counter.inc()
+            assert_true(False)
+        except ValueError:
+            pass
+
+    def test_gauge(self):
+        registry = Registry()
+        gauge = registry.gauge('in_flight', 'In flight.')
+        gauge.inc(3)
+        gauge.dec()
+        assert_true('in_flight 2' in registry.render().splitlines())
+
+    def test_callback_gauge(self):
+        registry = Registry()
+        depths = { 'fetch': 1, 'resize': 0 }
+        registry.callback_gauge('depth', 'Depth.', ('stage',), lambda: dict(((stage,), depth) for stage, depth in depths.items()))
+        assert_true('depth{stage="fetch"} 1' in registry.render().splitlines())
+        depths['fetch'] = 2
+        lines = registry.render().splitlines()
+        assert_true('depth{stage="fetch"} 2' in lines)
+        assert_true('depth{stage="resize"} 0' in lines)
+
+    def test_callback_counter(self):
+        registry = Registry()
+        counts = { 'hits': 0 }
+        registry.callback_counter('cache_total', 'Cache.', ('outcome',), lambda: dict(((outcome,), count) for outcome, count in counts.items()))
+        counts['hits'] = 3
+        lines = registry.render().splitlines()
+        assert_true('# TYPE cache_total counter' in lines and 'cache_total{outcome="hits"} 3' in lines)
+
+    def test_histogram(self):
+        registry = Registry()
+        histogram = registry.histogram('stage_seconds', 'Stages.', ('stage',), buckets=(0.1, 1.0))
+        histogram.observe(0.05, stage='fetch')
+        histogram.observe(0.1, stage='fetch')
+        histogram.observe(5, stage='fetch')
+        lines = registry.render().splitlines()
+        assert_true('stage_seconds_bucket{stage="fetch",le="0.1"} 2' in lines)
+        assert_true('stage_seconds_bucket{stage="fetch",le="1"} 2' in lines)
+        assert_true('stage_seconds_bucket{stage="fetch",le="+Inf"} 3' in lines)
+        assert_true('stage_seconds_sum{stage="fetch"} 5.15' in lines)
+        assert_true('stage_seconds_count{stage="fetch"} 3' in lines)
+
+    def test_histogram_time(self):
+        registry = Registry()
+        histogram = registry.histogram('message_seconds', 'Messages.')
+        try:
+            with histogram.time():
+                raise Exception('exception:work')
+        except Exception:
+            pass
+        assert_true('message_seconds_count 1' in registry.render().splitlines())
+
+    def test_escapes_label_values(self):
+        registry = Registry()
+        registry.counter('errors_total', 'Errors.', ('reason',)).inc(reason='say "hi"\n')
+        assert_true('errors_total{reason="say \\"hi\\"\\n"} 1' in registry.render().splitlines())
+
+    def worker_registry(self, processed, seconds):
+        registry = Registry()
+        registry.counter('photos_total', 'Photos.', ('outcome',)).inc(processed, outcome='processed')
+        histogram = registry.histogram('request_seconds', 'Requests.', ('endpoint',), buckets=(0.1, 1.0))
+        for value in seconds:
+            histogram.observe(value, endpoint='/photos/pending')
+        registry.gauge('in_flight', 'In flight.').set(processed)
+        return registry
+
+    def test_merge(self):
+        # As if two gunicorn workers had each served part of the traffic.
+        merged = merge([self.worker_registry(2, [0.05]).snapshot(), self.worker_registry(3, [0.5, 5]).snapshot()])
+        lines = merged.render().splitlines()
+        assert_true('# TYPE photos_total counter' in lines and '# TYPE request_seconds histogram' in lines)
+        assert_true('photos_total{outcome="processed"} 5' in lines)
+        assert_true('request_seconds_bucket{endpoint="/photos/pending",le="0.1"} 1' in lines)
+        assert_true('request_seconds_bucket{endpoint="/photos/pending",le="1"} 2' in lines)
+        assert_true('request_seconds_bucket{endpoint="/photos/pending",le="+Inf"} 3' in lines)
+        assert_true('request_seconds_count{endpoint="/photos/pending"} 3' in lines)
+        assert_true('in_flight 5' in lines)
+
+    def test_snapshot_directory(self):
+        with tempfile.TemporaryDirectory() as directory:
+            write_snapshot(self.worker_registry(2, [0.05]), directory, name='101')
+            write_snapshot(self.worker_registry(3, [0.5]), directory, name='102')
+            with open(os.path.join(directory, 'notes.txt'), 'w') as f:
+                f.write('not a snapshot')
+            assert_true(sorted(os.listdir(directory)) == ['101.json', '102.json', 'notes.txt'])
+            assert_true('photos_total{outcome="processed"} 5' in merge(read_snapshots(directory)).render().splitlines())
+            # A later snapshot replaces the process' earlier one.
+            write_snapshot(self.worker_registry(4, []), directory, name='102')
+            assert_true('photos_total{outcome="processed"} 6' in merge(read_snapshots(directory)).render().splitlines())
+
+    def test_http_server(self):
+        registry = Registry()
+        registry.counter('photos_total', 'Photos.').inc()
+        server = start_http_server(0, registry, host='127.0.0.1')
+        try:
+            response = urlopen('http://127.0.0.1:{}/metrics'.format(server.server_address[1]))
+            assert_true(response.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+            assert_true('photos_total 1' in response.read().decode('utf-8').splitlines())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+from nose.tools import assert_true
+from src.services.reaper_service import ReaperService
+
+class MockDbService(object):
+    def __init__(self, expired):
+        self.expired = list(expired)
+        self.limits = []
+
+    def reap_expired(self, limit, publish):
+        # Like the transaction: only confirmed photos leave `expired`.
+        self.limits.append(limit)
+        rows = [{ 'uuid': id } for id in self.expired[:limit]]
+        confirmed = publish(rows) if len(rows) > 0 else []
+        requeued = [row['uuid'] for row, ok in zip(rows, confirmed) if ok]
+        self.expired = [id for id in self.expired if id not in requeued]
+        return rows, confirmed
+
+class MockMessagingService(object):
+    def __init__(self, confirm=True, error=None):
+        self.batches = []
+        self.confirm = confirm
+        self.error = error
+
+    def push_uuids(self, uuids, per_message=1, force=False, batch_size=1000):
+        self.batches.append((uuids, per_message))
+        if self.error is not None:
+            raise self.error
+        if callable(self.confirm):
+            return [self.confirm(id) for id in uuids]
+        return [self.confirm] * len(uuids)
+
+class TestReaperService(unittest.TestCase):
+    def test_reap_once(self):
+        db_service = MockDbService(['a', 'b', 'c', 'd', 'e'])
+        messaging_service = MockMessagingService()
+        reaper = ReaperService(db_service, messaging_service, batch_size=2, uuids_per_message=2)
+        assert_true(reaper.reap_once() == 5)
+        assert_true(messaging_service.batches == [(['a', 'b'], 2), (['c', 'd'], 2), (['e'], 2)])
+        assert_true(db_service.limits == [2, 2, 2])
+
+    def test_reap_once_nothing_expired(self):
+        messaging_service = MockMessagingService()
+        reaper = ReaperService(MockDbService([]), messaging_service)
+        assert_true(reaper.reap_once() == 0)
+        assert_true(messaging_service.batches == [])
+
+    def test_reap_once_unconfirmed(self):
+        # Unconfirmed photos keep their expired lease for the next pass.
+        db_service = MockDbService(['a', 'b', 'c'])
+        messaging_service = MockMessagingService(confirm=lambda id: id != 'b')
+        reaper = ReaperService(db_service, messaging_service, batch_size=2)
+        assert_true(reaper.reap_once() == 1)
+        assert_true(db_service.expired == ['b', 'c'])
+        assert_true(db_service.limits == [2])
+        messaging_service.confirm = True
+        assert_true(reaper.reap_once() == 2)
+        assert_true(db_service.expired == [])
+
+    def test_reap_once_publish_fails(self):
+        db_service = MockDbService(['a', 'b'])
+        reaper = ReaperService(db_service, MockMessagingService(error=ConnectionError('broker down')))
+        try:
+            reaper.reap_once()
+            assert_true(False)
+        except ConnectionError:
+            pass
+        assert_true(db_service.expired == ['a', 'b'])
+
+    def test_background(self):
+        reaper = ReaperService(MockDbService(['a']), MockMessagingService(), interval=0.01)
+        assert_true(reaper.start())
+        assert_true(not reaper.start())
+        try:
+            for _ in range(500):
+                if reaper.status()['reaped'] == 1:
+                    break
+                reaper.stopping.wait(0.01)
+        finally:
+            reaper.stop()
+        assert_true(reaper.status()['reaped'] == 1 and not reaper.status()['running'])
+
+if __name__ == '__main__':
+    unittest.main()
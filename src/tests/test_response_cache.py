@@ -0,0 +1,63 @@
+import unittest
+from nose.tools import assert_true
+from src.services.response_cache import ResponseCache, etag_for
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_put_and_get(self):
+        cache = ResponseCache(1024, 10, self.clock)
+        stored = cache.put(('pending', 10, None), 7, b'[]')
+        assert_true(stored.etag == etag_for(b'[]'))
+        entry = cache.get(('pending', 10, None), 7)
+        assert_true(entry.body == b'[]' and entry.etag == stored.etag)
+        assert_true(cache.get(('pending', 20, None), 7) is None)
+
+    def test_new_version_misses(self):
+        cache = ResponseCache(1024, 10, self.clock)
+        cache.put('key', 7, b'[]')
+        assert_true(cache.get('key', 8) is None)
+        assert_true(len(cache) == 0)
+
+    def test_expires_after_ttl(self):
+        cache = ResponseCache(1024, 10, self.clock)
+        cache.put('key', 7, b'[]')
+        self.clock.now = 9.9
+        assert_true(cache.get('key', 7) is not None)
+        self.clock.now = 10.0
+        assert_true(cache.get('key', 7) is None)
+
+    def test_evicts_least_recently_used_past_max_bytes(self):
+        cache = ResponseCache(10, 10, self.clock)
+        cache.put('a', 1, b'aaaa')
+        cache.put('b', 1, b'bbbb')
+        assert_true(cache.get('a', 1) is not None)
+        cache.put('c', 1, b'cccc')
+        assert_true(cache.get('b', 1) is None)
+        assert_true(cache.get('a', 1) is not None and cache.get('c', 1) is not None)
+        assert_true(cache.size == 8)
+
+    def test_oversized_body_not_stored(self):
+        cache = ResponseCache(4, 10, self.clock)
+        entry = cache.put('key', 1, b'too large')
+        assert_true(entry.etag == etag_for(b'too large'))
+        assert_true(len(cache) == 0 and cache.size == 0)
+
+    def test_replacing_entry_keeps_size(self):
+        cache = ResponseCache(10, 10, self.clock)
+        cache.put('key', 1, b'aaaa')
+        cache.put('key', 2, b'bb')
+        assert_true(cache.size == 2 and cache.get('key', 2).body == b'bb')
+
+    def test_disabled(self):
+        cache = ResponseCache(1024, 0, self.clock)
+        cache.put('key', 1, b'[]')
+        assert_true(cache.get('key', 1) is None)
@@ -0,0 +1,74 @@
+import os
+import tempfile
+import time
+import unittest
+from nose.tools import assert_true
+from src.services.source_cache import SourceCache
+
+class TestSourceCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_store_and_revalidate(self):
+        cache = SourceCache(self.directory.name, 1000)
+        assert_true(cache.validators('http://a/1.jpg') == {})
+        cache.store('http://a/1.jpg', b'abc', '"etag-1"', 'Mon, 22 Apr 2019 10:32:52 GMT')
+        assert_true(cache.validators('http://a/1.jpg') == { 'If-None-Match': '"etag-1"', 'If-Modified-Since': 'Mon, 22 Apr 2019 10:32:52 GMT' })
+        assert_true(cache.fresh('http://a/1.jpg') is None)
+        assert_true(cache.not_modified('http://a/1.jpg').read() == b'abc')
+        assert_true(cache.not_modified('http://a/2.jpg') is None)
+        stats = cache.stats()
+        assert_true(stats['misses'] == 1 and stats['revalidations'] == 1 and stats['hits'] == 0)
+        assert_true(stats['entries'] == 1 and stats['bytes'] == 3)
+
+    def test_fresh(self):
+        cache = SourceCache(self.directory.name, 1000, fresh_for=60)
+        cache.store('http://a/1.jpg', b'abc')
+        assert_true(cache.fresh('http://a/1.jpg').read() == b'abc')
+        assert_true(cache.stats()['hits'] == 1)
+
+    def test_not_stored_without_validators(self):
+        cache = SourceCache(self.directory.name, 1000)
+        cache.store('http://a/1.jpg', b'abc')
+        assert_true(cache.stats()['entries'] == 0)
+
+    def test_not_stored_when_too_big(self):
+        cache = SourceCache(self.directory.name, 2)
+        cache.store('http://a/1.jpg', b'abc', '"etag"')
+        assert_true(cache.stats()['entries'] == 0 and os.listdir(self.directory.name) == [])
+
+    def test_evicts_least_recently_used(self):
+        cache = SourceCache(self.directory.name, 6)
+        cache.store('http://a/1.jpg', b'111', '"1"')
+        cache.store('http://a/2.jpg', b'222', '"2"')
+        cache.not_modified('http://a/1.jpg')
+        cache.store('http://a/3.jpg', b'333', '"3"')
+        assert_true(cache.validators('http://a/2.jpg') == {})
+        assert_true(cache.not_modified('http://a/1.jpg').read() == b'111')
+        assert_true(cache.not_modified('http://a/3.jpg').read() == b'333')
+        stats = cache.stats()
+        assert_true(stats['evictions'] == 1 and stats['bytes'] == 6)
+        assert_true(len(os.listdir(self.directory.name)) == 4)
+
+    def test_reloads_from_disk(self):
+        cache = SourceCache(self.directory.name, 1000)
+        cache.store('http://a/1.jpg', b'111', '"1"')
+        cache.store('http://a/2.jpg', b'222', '"2"')
+        reloaded = SourceCache(self.directory.name, 1000)
+        assert_true(reloaded.stats()['entries'] == 2 and reloaded.stats()['bytes'] == 6)
+        assert_true(reloaded.not_modified('http://a/2.jpg').read() == b'222')
+
+    def test_reload_enforces_smaller_limit(self):
+        cache = SourceCache(self.directory.name, 1000)
+        cache.store('http://a/1.jpg', b'111', '"1"')
+        os.utime(os.path.join(self.directory.name, cache.key('http://a/1.jpg')), (time.time() - 60, time.time() - 60))
+        cache.store('http://a/2.jpg', b'222', '"2"')
+        reloaded = SourceCache(self.directory.name, 4)
+        assert_true(reloaded.validators('http://a/1.jpg') == {})
+        assert_true(reloaded.validators('http://a/2.jpg') == { 'If-None-Match': '"2"' })
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import threading
+import unittest
+from nose.tools import assert_true
+from src.services.staged_pipeline import StagedPipeline
+
+class TestStagedPipeline(unittest.TestCase):
+    def collect(self):
+        lock = threading.Lock()
+        settled = []
+        def done(parsed):
+            def _done(result):
+                with lock:
+                    settled.append((parsed, result))
+            return _done
+        return settled, done
+
+    def test_dispatch(self):
+        pipeline = StagedPipeline([('double', lambda item: item * 2, 1), ('check', lambda item: item == 4, 1)])
+        settled, done = self.collect()
+        try:
+            pipeline.dispatch(2, done(2))
+            pipeline.dispatch(3, done(3))
+        finally:
+            pipeline.shutdown()
+        assert_true(settled == [(2, True), (3, False)])
+
+    def test_stage_raises(self):
+        def raising_stage(item):
+            if item == 'bad':
+                raise Exception('exception:stage')
+            return item
+        pipeline = StagedPipeline([('first', raising_stage, 1), ('second', lambda item: True, 1)])
+        settled, done = self.collect()
+        try:
+            pipeline.dispatch('bad', done('bad'))
+            pipeline.dispatch('good', done('good'))
+        finally:
+            pipeline.shutdown()
+        assert_true(settled == [('bad', False), ('good', True)])
+
+    def test_done_raises(self):
+        # As after a reconnect, when done() acks on the closed connection:
+        # the stage threads survive and later messages still settle, from
+        # the last stage and from a failing first one alike.
+        def raising_stage(item):
+            if item == 'bad':
+                raise Exception('exception:stage')
+            return item
+        pipeline = StagedPipeline([('first', raising_stage, 1), ('second', lambda item: True, 1)])
+        settled, done = self.collect()
+        def closed(result):
+            raise Exception('exception:done')
+        try:
+            pipeline.dispatch('stale', closed)
+            pipeline.dispatch('good', done('good'))
+            pipeline.dispatch('bad', closed)
+            pipeline.dispatch('bad', done('bad'))
+            pipeline.dispatch('last', done('last'))
+        finally:
+            pipeline.shutdown()
+        assert_true(settled == [('good', True), ('bad', False), ('last', True)])
+        assert_true(pipeline.in_flight() == 0)
+
+    def test_settles_in_dispatch_order(self):
+        # The first message is held in the stage until the second has
+        # finished, but must still be settled first.
+        release = threading.Event()
+        second_finished = threading.Event()
+        def stage(item):
+            if item == 0:
+                release.wait(5)
+            return item
+        def last(item):
+            if item == 1:
+                second_finished.set()
+            return True
+        pipeline = StagedPipeline([('slow', stage, 2), ('last', last, 1)])
+        settled, done = self.collect()
+        try:
+            pipeline.dispatch(0, done(0))
+            pipeline.dispatch(1, done(1))
+            assert_true(second_finished.wait(5))
+            assert_true(settled == [])
+            assert_true(pipeline.in_flight() == 2)
+            release.set()
+        finally:
+            pipeline.shutdown()
+        assert_true(settled == [(0, True), (1, True)])
+        assert_true(pipeline.in_flight() == 0)
+
+    def test_stages_overlap(self):
+        # The barrier only opens once the second message is being fetched
+        # while the first is being resized.
+        barrier = threading.Barrier(2, timeout=5)
+        def fetch(item):
+            if item == 'second':
+                barrier.wait()
+            return item
+        def resize(item):
+            if item == 'first':
+                barrier.wait()
+            return True
+        pipeline = StagedPipeline([('fetch', fetch, 1), ('resize', resize, 1)])
+        settled, done = self.collect()
+        try:
+            pipeline.dispatch('first', done('first'))
+            pipeline.dispatch('second', done('second'))
+        finally:
+            pipeline.shutdown()
+        assert_true(settled == [('first', True), ('second', True)])
+
+    def test_bounded_queues(self):
+        release = threading.Event()
+        pipeline = StagedPipeline([('blocked', lambda item: release.wait(5), 1)], capacity=1)
+        settled, done = self.collect()
+        dispatched = []
+        def dispatch_all():
+            for item in range(3):
+                pipeline.dispatch(item, done(item))
+                dispatched.append(item)
+        thread = threading.Thread(target=dispatch_all)
+        try:
+            thread.start()
+            # One item in the stage and one in its queue; the third waits.
+            thread.join(0.2)
+            assert_true(thread.is_alive())
+            assert_true(dispatched == [0, 1])
+            assert_true(pipeline.depths() == { 'blocked': 1 })
+        finally:
+            release.set()
+            thread.join(5)
+            pipeline.shutdown()
+        assert_true(len(settled) == 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import json
+import os
+import unittest
+from nose.tools import assert_true
+from benchmarks import fakes
+
+PHOTOS = {
+    '6f1c4a3e-8c1b-4a43-9e0f-0c1a6f1e2d3b': 'http://127.0.0.1/a.jpg',
+    '0b6f4c61-8a43-4c1f-9f2e-3a1d6c9e7b5a': 'http://127.0.0.1/b.jpg',
+    '9d2e7f10-3c4b-4a5d-8e6f-7a8b9c0d1e2f': 'http://127.0.0.1/c.jpg',
+}
+
+def setUpModule():
+    # web imports its services from the flat modules, and reads its settings
+    # on import. That puts src/services on sys.path, which is done here
+    # rather than at import so that other test modules still import the
+    # src.services ones.
+    global web
+    os.environ['REAPER_INTERVAL'] = '0'
+    fakes.install(PHOTOS, [])
+    import web
+
+class TestPendingCache(unittest.TestCase):
+    def setUp(self):
+        self.db_service = fakes.FakeDbService()
+        self.db_service.urls = dict(PHOTOS)
+        self.client = web.create_app(self.db_service, fakes.FakeMessagingService()).test_client()
+
+    def served_from(self, response):
+        return [photo['uuid'] for photo in json.loads(response.get_data(as_text=True))['photos']]
+
+    def test_etag_and_not_modified(self):
+        response = self.client.get('/photos/pending?limit=2')
+        assert_true(response.status_code == 200 and response.headers['ETag'])
+        assert_true(self.served_from(response) == sorted(PHOTOS)[:2])
+        etag = response.headers['ETag']
+        # While the version is unchanged the rows are not read again.
+        self.db_service.urls = {}
+        response = self.client.get('/photos/pending?limit=2', headers={ 'If-None-Match': etag })
+        assert_true(response.status_code == 304 and response.get_data() == b'')
+        response = self.client.get('/photos/pending?limit=2')
+        assert_true(response.status_code == 200 and response.headers['ETag'] == etag)
+        assert_true(self.served_from(response) == sorted(PHOTOS)[:2])
+
+    def test_version_change_invalidates(self):
+        etag = self.client.get('/photos/pending?limit=2').headers['ETag']
+        del self.db_service.urls[sorted(PHOTOS)[0]]
+        self.db_service.version = (2, True)
+        response = self.client.get('/photos/pending?limit=2', headers={ 'If-None-Match': etag })
+        assert_true(response.status_code == 200 and response.headers['ETag'] != etag)
+        assert_true(self.served_from(response) == sorted(PHOTOS)[1:3])
+
+    def test_keyed_by_page(self):
+        first = self.client.get('/photos/pending?limit=1')
+        second = self.client.get('/photos/pending?limit=2')
+        assert_true(self.served_from(first) == sorted(PHOTOS)[:1] and self.served_from(second) == sorted(PHOTOS)[:2])
+        assert_true(first.headers['ETag'] != second.headers['ETag'])
+
+    def test_streamed_listing(self):
+        # Streamed without an ETag; the poll after it is served from the cache.
+        response = self.client.get('/photos/pending')
+        assert_true(response.status_code == 200 and 'ETag' not in response.headers)
+        photos = json.loads(response.get_data(as_text=True))
+        assert_true([photo['uuid'] for photo in photos] == sorted(PHOTOS))
+        response = self.client.get('/photos/pending')
+        assert_true(response.status_code == 200 and response.headers['ETag'])
+        assert_true(json.loads(response.get_data(as_text=True)) == photos)
+        response = self.client.get('/photos/pending', headers={ 'If-None-Match': response.headers['ETag'] })
+        assert_true(response.status_code == 304)
+
+if __name__ == '__main__':
+    unittest.main()
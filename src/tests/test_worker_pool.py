@@ -0,0 +1,53 @@
+import threading
+import unittest
+from nose.tools import assert_true
+from src.services.worker_pool import WorkerPool
+
+class TestWorkerPool(unittest.TestCase):
+    def dispatch_and_wait(self, pool, parsed):
+        settled = threading.Event()
+        results = []
+        def done(result):
+            results.append(result)
+            settled.set()
+        pool.dispatch(parsed, done)
+        settled.wait(5)
+        return results
+
+    def test_dispatch(self):
+        pool = WorkerPool(lambda parsed: parsed == 'asdf', 2)
+        try:
+            assert_true(self.dispatch_and_wait(pool, 'asdf') == [True])
+            assert_true(self.dispatch_and_wait(pool, 'uiop') == [False])
+        finally:
+            pool.shutdown()
+
+    def test_dispatch_callback_raises(self):
+        def raising_callback(parsed):
+            raise Exception('exception:callback')
+        pool = WorkerPool(raising_callback, 1)
+        try:
+            assert_true(self.dispatch_and_wait(pool, 'asdf') == [False])
+        finally:
+            pool.shutdown()
+
+    def test_dispatch_is_concurrent(self):
+        barrier = threading.Barrier(3, timeout=5)
+        def blocking_callback(parsed):
+            barrier.wait()
+            return True
+        pool = WorkerPool(blocking_callback, 3)
+        settled = []
+        lock = threading.Lock()
+        def done(result):
+            with lock:
+                settled.append(result)
+        try:
+            for i in range(3):
+                pool.dispatch(i, done)
+        finally:
+            pool.shutdown()
+        assert_true(settled == [True, True, True])
+
+if __name__ == '__main__':
+    unittest.main()